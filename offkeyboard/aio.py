@@ -0,0 +1,174 @@
+"""asyncio front-end to the audio pipeline
+
+Frame providers are async iterators of frames, and AsyncAudioProcessor turns one into an async stream of detected
+notes. Pitch estimation is pushed to an executor, so a single event loop can serve several instruments.
+"""
+import asyncio
+import time
+import wave
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from concurrent.futures import Executor
+from typing import AsyncIterator, Optional
+
+import numpy as np
+
+from config import SAMPLE_RATE, SAMPLES_PER_FRAME, DECIMATION_FACTOR
+from dsp import Decimator
+from note_detector import NoteDetector
+from note_utils import SILENCE_NOTE, format_note
+
+
+class NoteEvent(namedtuple('NoteEvent', ['note', 'freq', 'confidence', 'timestamp'])):
+    """A note number (or SILENCE_NOTE) detected at `timestamp`, in time.monotonic() seconds
+    """
+    __slots__ = ()
+
+    @property
+    def name(self) -> str:
+        return format_note(self.note)
+
+
+class AsyncFrameProvider(ABC):
+    """Protocol to read an audio buffer from within an event loop
+    Implementations are async iterators of int16 frames, which stop once the source is exhausted.
+    """
+    def __init__(self, sample_rate=0, samples_per_frame=0):
+        self.sample_rate = sample_rate
+        self.samples_per_frame = samples_per_frame
+
+    def __aiter__(self) -> 'AsyncFrameProvider':
+        return self
+
+    @abstractmethod
+    async def __anext__(self) -> np.ndarray:
+        """Retrieve the next frame of audio data, raising StopAsyncIteration at the end of the stream
+        """
+        pass
+
+    def close(self) -> None:
+        pass
+
+
+class AsyncMicrophoneFrameProvider(AsyncFrameProvider):
+    """Microphone input delivered by PyAudio's callback thread onto the event loop
+
+    If the loop falls more than `queue_frames` frames behind, the newest frames are dropped and counted in
+    `dropped_frames`, rather than blocking capture.
+    """
+    def __init__(self, sample_rate: int, samples_per_frame: int, queue_frames: int = 32) -> None:
+        super(AsyncMicrophoneFrameProvider, self).__init__(sample_rate, samples_per_frame)
+        import pyaudio
+
+        self.loop = asyncio.get_event_loop()
+        self.frames: asyncio.Queue = asyncio.Queue(queue_frames)
+        self.dropped_frames = 0
+        self.stream = pyaudio.PyAudio().open(
+            format=pyaudio.paInt16,
+            channels=1,
+            rate=sample_rate,
+            input=True,
+            frames_per_buffer=samples_per_frame,
+            stream_callback=self._on_audio)
+        self._continue = pyaudio.paContinue
+        self.stream.start_stream()
+
+    def _on_audio(self, in_data, frame_count, time_info, status_flags):
+        self.loop.call_soon_threadsafe(self._enqueue, in_data)
+        return None, self._continue
+
+    def _enqueue(self, data: bytes) -> None:
+        try:
+            self.frames.put_nowait(data)
+        except asyncio.QueueFull:
+            self.dropped_frames += 1
+
+    async def __anext__(self) -> np.ndarray:
+        if not self.stream.is_active() and self.frames.empty():
+            raise StopAsyncIteration
+        return np.frombuffer(await self.frames.get(), np.int16)
+
+    def close(self) -> None:
+        self.stream.stop_stream()
+        self.stream.close()
+
+
+class AsyncWavFileFrameProvider(AsyncFrameProvider):
+    """Frames read from a WAV file, with the file reads done in an executor
+    """
+    def __init__(self, filename: str, samples_per_frame: int) -> None:
+        self.wav = wave.open(filename, 'rb')
+        super(AsyncWavFileFrameProvider, self).__init__(self.wav.getframerate(), samples_per_frame)
+
+    async def __anext__(self) -> np.ndarray:
+        data = await asyncio.get_event_loop().run_in_executor(None, self.wav.readframes, self.samples_per_frame)
+        if not data:
+            raise StopAsyncIteration
+        return np.frombuffer(data, np.int16)
+
+    def close(self) -> None:
+        self.wav.close()
+
+
+class AsyncArrayFrameProvider(AsyncFrameProvider):
+    """Frames sliced out of audio already in memory
+
+    With `realtime` set, frames are handed out no faster than they would arrive from a microphone.
+    """
+    def __init__(self, samples: np.ndarray, sample_rate: int, samples_per_frame: int, realtime: bool = False) -> None:
+        super(AsyncArrayFrameProvider, self).__init__(sample_rate, samples_per_frame)
+        self.samples = samples
+        self.position = 0
+        self.realtime = realtime
+
+    async def __anext__(self) -> np.ndarray:
+        if self.position >= len(self.samples):
+            raise StopAsyncIteration
+        frame = self.samples[self.position:self.position + self.samples_per_frame]
+        self.position += self.samples_per_frame
+        # Always yield to the loop, so other instruments get a turn
+        await asyncio.sleep(self.samples_per_frame / self.sample_rate if self.realtime else 0)
+        return frame
+
+
+class AsyncAudioProcessor:
+    """Async counterpart of AudioProcessor, which yields detected notes instead of pressing keys
+
+    Usage:
+        async for event in AsyncAudioProcessor(provider).note_events():
+            ...
+    """
+    def __init__(self, frame_provider: AsyncFrameProvider, executor: Optional[Executor] = None) -> None:
+        self.frame_provider = frame_provider
+        # None means the event loop's default executor
+        self.executor = executor
+        self.note_detector = NoteDetector()
+        self.decimator = Decimator(DECIMATION_FACTOR) if DECIMATION_FACTOR > 1 else None
+
+    def _analyze(self, audio_frame: np.ndarray) -> Optional[int]:
+        if self.decimator:
+            audio_frame = self.decimator.process(audio_frame)
+        return self.note_detector.process_frame(audio_frame)
+
+    async def note_events(self, changes_only: bool = False) -> AsyncIterator[NoteEvent]:
+        """Yield a NoteEvent for every analyzed frame, or with `changes_only`, only when the detected note changes
+        """
+        loop = asyncio.get_event_loop()
+        last_note = None
+        async for audio_frame in self.frame_provider:
+            note = await loop.run_in_executor(self.executor, self._analyze, audio_frame)
+            if note is None or (changes_only and note == last_note):
+                continue
+            last_note = note
+            voiced = note != SILENCE_NOTE
+            yield NoteEvent(note,
+                            self.note_detector.freq if voiced else 0.0,
+                            self.note_detector.pitch_estimator.confidence if voiced else 0.0,
+                            time.monotonic())
+
+
+def microphone_notes(executor: Optional[Executor] = None) -> AsyncIterator[NoteEvent]:
+    """Convenience for the common case: an async stream of note changes played into the microphone
+    """
+    provider = AsyncMicrophoneFrameProvider(SAMPLE_RATE, SAMPLES_PER_FRAME)
+    return AsyncAudioProcessor(provider, executor).note_events(changes_only=True)
@@ -0,0 +1,143 @@
+import atexit
+from typing import Optional
+
+import numpy as np
+
+from config import (
+    SAMPLE_RATE,
+    SAMPLES_PER_FRAME,
+    DECIMATION_FACTOR,
+    LATENCY_STATS,
+    LATENCY_STATS_INTERVAL,
+    LATENCY_STATS_FILE,
+    SESSION_LOG,
+    SESSION_LOG_DIR,
+    SESSION_LOG_MAX_MB,
+    SESSION_LOG_SEGMENT_MB,
+)
+from latency import LatencyStats
+from session_log import SessionRecorder, RecordingFrameProvider
+from note_reader import NoteReader
+from note_detector import NoteDetector
+from note_utils import SILENCE_NOTE
+from frame_provider import (
+    FrameProvider,
+    WavFileFrameProvider,
+    MicrophoneFrameProvider,
+    CallbackMicrophoneFrameProvider,
+    DecimatingFrameProvider,
+)
+
+
+def open_audio_source(microphone=True, threaded=False, filename: str = None) -> FrameProvider:
+    """The microphone, or without it, the WAV file `filename`
+    """
+    if microphone:
+        if threaded:
+            return CallbackMicrophoneFrameProvider(SAMPLE_RATE, SAMPLES_PER_FRAME)
+        return MicrophoneFrameProvider(SAMPLE_RATE, SAMPLES_PER_FRAME)
+    if filename is None:
+        raise ValueError('A WAV file to read from is needed when not using the microphone')
+    return WavFileFrameProvider(filename, SAMPLES_PER_FRAME)
+
+
+def open_session_recorder() -> Optional[SessionRecorder]:
+    """The session log live audio is recorded to, if SESSION_LOG is on
+    """
+    if not SESSION_LOG:
+        return None
+    return SessionRecorder(SESSION_LOG_DIR, SAMPLE_RATE, SESSION_LOG_MAX_MB * 2**20, SESSION_LOG_SEGMENT_MB * 2**20)
+
+
+def get_frame_provider(microphone=True,
+                       source: FrameProvider = None,
+                       filename: str = None,
+                       recorder: SessionRecorder = None) -> FrameProvider:
+    """Set up the chain of frame providers AudioProcessor reads from
+    With a `recorder`, the source's raw frames are recorded to the session log before anything else is done to them.
+    """
+    provider = source or open_audio_source(microphone, filename=filename)
+    if recorder is not None:
+        provider = RecordingFrameProvider(provider, recorder)
+    if DECIMATION_FACTOR > 1:
+        # Everything we care about lies far below Nyquist, so analyze the audio at a reduced rate
+        provider = DecimatingFrameProvider(provider, DECIMATION_FACTOR)
+    return provider
+
+
+def hand_off_note(note_detector: NoteDetector, note_reader: NoteReader, note: int) -> None:
+    """Give a note a NoteDetector just detected, and everything else it found out about the frame, to a NoteReader
+    """
+    if note_detector.polyphonic:
+        note_reader.process_notes(note_detector.notes, note_detector.commit_confidence, note_detector.onset,
+                                  note_detector.attack_note)
+    else:
+        note_reader.process_note(note, note_detector.commit_confidence, note_detector.onset, note_detector.attack_note)
+
+
+class AudioProcessor:
+    def __init__(self,
+                 microphone=True,
+                 frame_provider: FrameProvider = None,
+                 note_reader: NoteReader = None,
+                 recorder: SessionRecorder = None,
+                 filename: str = None,
+                 latency_stats: bool = LATENCY_STATS):
+        """Reads audio from `frame_provider` if given, otherwise the microphone, or the WAV file `filename`
+        """
+        self.note_detector = NoteDetector()
+        self.audio_frame_count = 0
+        # Live microphone sessions are recorded by default. Anything else (e.g. replaying the session log) is only
+        # recorded when given a recorder, which must already be recording the frame provider's frames
+        if recorder is None and microphone and frame_provider is None:
+            recorder = open_session_recorder()
+        self.recorder = recorder
+        self.audio_frame_provider = frame_provider or get_frame_provider(microphone, filename=filename,
+                                                                          recorder=recorder)
+        self.note_reader = note_reader or NoteReader()
+        if recorder is not None:
+            self.note_reader.output = recorder.wrap_output(self.note_reader.output)
+            atexit.register(recorder.close)
+        # Per-stage timings, when enabled
+        self.latency: Optional[LatencyStats] = None
+        if latency_stats:
+            self.latency = LatencyStats(LATENCY_STATS_INTERVAL)
+            self.note_reader.output = self.latency.wrap_output(self.note_reader.output)
+            atexit.register(self.latency.dump, LATENCY_STATS_FILE)
+
+    def process_audio_forever(self):
+        while self.audio_frame_provider.has_frames():
+            # The frame provider converts its samples straight into the ring buffer
+            samples_written = self.audio_frame_provider.read_into(self.note_detector.ring_buffer,
+                                                                  self.note_detector.frame_filter)
+            self.process_buffered_frame(samples_written, self.audio_frame_provider.last_capture_time)
+
+    def process_audio_frame(self, audio_frame: np.ndarray):
+        self.note_detector.write_frame(audio_frame)
+        self.process_buffered_frame(len(audio_frame))
+
+    def process_buffered_frame(self, frame_len: int, capture_time: Optional[float] = None):
+        """Run analysis once a new frame of `frame_len` samples has been committed to the ring buffer
+        `capture_time` is when the frame finished arriving, if known, for latency stats.
+        """
+        self.audio_frame_count += 1
+        latency = self.latency
+        if latency is not None:
+            latency.start_frame(capture_time)
+        note = self.note_detector.detect(frame_len)
+        # Not enough audio to analyze yet
+        if note is None:
+            if self.recorder is not None:
+                self.recorder.end_frame(None)
+            return
+        if latency is not None:
+            latency.lap('estimate')
+
+        # We've detected a note - hand it off to the note consumer
+        hand_off_note(self.note_detector, self.note_reader, note)
+        if latency is not None:
+            latency.lap('reader')
+            latency.maybe_report(self.note_reader.output)
+        if self.recorder is not None:
+            voiced = note != SILENCE_NOTE
+            self.recorder.end_frame(note, self.note_detector.freq if voiced else 0.0, self.note_detector.confidence)
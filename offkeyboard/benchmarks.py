@@ -0,0 +1,897 @@
+"""Micro-benchmarks for the audio pipeline
+
+Run all of them with `python offkeyboard/benchmarks.py`, or name the ones you want:
+`python offkeyboard/benchmarks.py ring_buffer`
+
+Benchmarks which check an optimized path against the code it replaced exit non-zero if they disagree.
+"""
+import sys
+import time
+import tracemalloc
+from typing import Callable, Dict, Tuple
+
+import numpy as np
+
+from config import NOTE_MIN, NOTE_MAX, SAMPLE_RATE, SAMPLES_PER_FRAME, FRAMES_PER_FFT, DECIMATION_FACTOR
+from dsp import Decimator, BandpassFilter, butter_bandpass_filter
+from keymaps import MarioMap, compile_keymap
+from note_utils import number_to_freq, nearest_note_number, note_number
+from pitch_engine import (
+    PITCH_ESTIMATORS,
+    AutocorrEstimator,
+    LagWindowAutocorrelator,
+    SlidingAutocorrelator,
+    make_pitch_estimator,
+)
+from ring_buffer import AudioRingBuffer
+
+
+# The benchmarks always run at the full sample rate, whatever DECIMATION_FACTOR is set to
+SAMPLES_PER_FFT = SAMPLES_PER_FRAME * FRAMES_PER_FFT
+
+BENCHMARKS: Dict[str, Callable[[], None]] = {}
+
+# The sliding autocorrelator's lag sums drift from a full recompute by float32 rounding, well below this fraction of
+# the zero-lag energy, unless its bookkeeping is wrong
+LAG_SUM_TOLERANCE = 1e-4
+
+
+class RegressionError(Exception):
+    """An optimized path no longer matches the reference it's checked against
+    """
+
+
+def benchmark(func: Callable[[], None]) -> Callable[[], None]:
+    """Register a benchmark under its function name, minus the `bench_` prefix
+    """
+    BENCHMARKS[func.__name__[len('bench_'):]] = func
+    return func
+
+
+def time_per_call(func: Callable[[], None], iterations: int) -> float:
+    """Run `func` `iterations` times, returning the mean wall-clock time per call in microseconds
+    """
+    start = time.perf_counter()
+    for _ in range(iterations):
+        func()
+    return (time.perf_counter() - start) / iterations * 1e6
+
+
+def random_int16_frame_bytes() -> bytes:
+    """A frame of audio as it comes out of PyAudio: raw little-endian int16 bytes
+    """
+    return np.random.randint(-2**15, 2**15, SAMPLES_PER_FRAME, dtype=np.int16).tobytes()
+
+
+def synthetic_note(note: float,
+                   num_samples: int,
+                   sample_rate: float = SAMPLE_RATE,
+                   harmonics: int = 6,
+                   noise: float = 0.01,
+                   seed: int = 0) -> np.ndarray:
+    """A plucked-string-like tone: decaying harmonics with 1/h amplitudes, plus some white noise
+    `note` may be fractional, to simulate an out-of-tune string.
+    """
+    rng = np.random.RandomState(seed)
+    t = np.arange(num_samples) / sample_rate
+    f0 = number_to_freq(note)
+    sig = np.zeros(num_samples)
+    for h in range(1, harmonics + 1):
+        if h * f0 >= sample_rate / 2:
+            break
+        # Higher harmonics die out faster
+        sig += np.exp(-t * 1.5 * h) * np.sin(2 * np.pi * h * f0 * t + rng.uniform(0, 2 * np.pi)) / h
+    sig += rng.normal(0, noise, num_samples)
+    return (sig / np.max(np.abs(sig)) * 8000).astype(np.float32)
+
+
+def regression_corpus(num_samples: int = SAMPLES_PER_FFT, sample_rate: float = SAMPLE_RATE):
+    """Windows of every note in the instrument's range, in tune and slightly detuned, with their expected notes
+    """
+    for note in range(NOTE_MIN, NOTE_MAX + 1):
+        for detune in (-0.3, 0.0, 0.3):
+            yield note, synthetic_note(note + detune, num_samples, sample_rate, seed=note)
+
+
+@benchmark
+def bench_ring_buffer():
+    """Compare the old shift-the-whole-buffer frame ingest against the mirrored ring buffer
+    """
+    raw = random_int16_frame_bytes()
+    float_size = np.dtype(np.float32).itemsize
+    int16_size = np.dtype(np.int16).itemsize
+
+    shift_buf = np.zeros(SAMPLES_PER_FFT, dtype=np.float32)
+
+    def shift_ingest():
+        # What AudioProcessor used to do for every frame. np.fromstring copied the bytes it was handed
+        frame = np.frombuffer(raw, np.int16).copy()
+        shift_buf[:-SAMPLES_PER_FRAME] = shift_buf[SAMPLES_PER_FRAME:]
+        shift_buf[-SAMPLES_PER_FRAME:] = frame
+
+    ring = AudioRingBuffer(SAMPLES_PER_FFT)
+
+    def ring_ingest():
+        ring.write(np.frombuffer(raw, np.int16))
+        # The estimator reads a view, so this costs nothing
+        ring.window
+
+    # fromstring copy + memmove of the retained samples + insertion of the new frame
+    shift_bytes = SAMPLES_PER_FRAME * int16_size + (SAMPLES_PER_FFT - SAMPLES_PER_FRAME) * float_size \
+        + SAMPLES_PER_FRAME * float_size
+    # Conversion into the ring slot + the mirrored copy
+    ring_bytes = 2 * SAMPLES_PER_FRAME * float_size
+
+    iterations = 20000
+    print(f'{"ingest":<16}{"bytes copied/frame":>20}{"us/frame":>12}')
+    print(f'{"shift":<16}{shift_bytes:>20}{time_per_call(shift_ingest, iterations):>12.2f}')
+    print(f'{"ring buffer":<16}{ring_bytes:>20}{time_per_call(ring_ingest, iterations):>12.2f}')
+
+
+@benchmark
+def bench_lag_window():
+    """Check the lag-window autocorrelator agrees with the original estimator, and compare their cost
+    """
+    reference = AutocorrEstimator(SAMPLE_RATE, SAMPLES_PER_FFT)
+    engine = LagWindowAutocorrelator(SAMPLE_RATE, SAMPLES_PER_FFT)
+    windows = 0
+    mismatches = 0
+    for _, window in regression_corpus():
+        windows += 1
+        expected = nearest_note_number(reference.estimate(window))
+        if nearest_note_number(engine.estimate(window)) != expected:
+            mismatches += 1
+    print(f'{windows - mismatches}/{windows} windows produced the same note as freq_from_autocorr')
+
+    window = synthetic_note(NOTE_MIN, SAMPLES_PER_FFT)
+    iterations = 200
+    print(f'{"estimator":<16}{"us/frame":>12}')
+    print(f'{"autocorr":<16}{time_per_call(lambda: reference.estimate(window), iterations):>12.1f}')
+    print(f'{"lag_window":<16}{time_per_call(lambda: engine.estimate(window), iterations):>12.1f}')
+    if mismatches:
+        raise RegressionError(f'{mismatches} windows detected a different note to freq_from_autocorr')
+
+
+@benchmark
+def bench_sliding():
+    """Stream notes through the sliding autocorrelator, checking it stays equivalent to a full recompute
+    """
+    reference = AutocorrEstimator(SAMPLE_RATE, SAMPLES_PER_FFT)
+    full = LagWindowAutocorrelator(SAMPLE_RATE, SAMPLES_PER_FFT)
+    sliding = SlidingAutocorrelator(SAMPLE_RATE, SAMPLES_PER_FFT)
+    ring = AudioRingBuffer(SAMPLES_PER_FFT + SAMPLES_PER_FRAME)
+
+    # A melody of every note in the range, each held for a couple of windows
+    stream = np.concatenate([synthetic_note(n, 2 * SAMPLES_PER_FFT, seed=n) for n in range(NOTE_MIN, NOTE_MAX + 1)])
+    frames = len(stream) // SAMPLES_PER_FRAME
+    worst_error = 0.0
+    mismatches = 0
+    estimated = 0
+    for i in range(frames):
+        ring.write(stream[i * SAMPLES_PER_FRAME:(i + 1) * SAMPLES_PER_FRAME])
+        sliding.push_frame(ring.latest(SAMPLES_PER_FFT + SAMPLES_PER_FRAME), SAMPLES_PER_FRAME)
+        if i < SAMPLES_PER_FFT // SAMPLES_PER_FRAME:
+            continue
+        window = ring.latest(SAMPLES_PER_FFT)
+        expected = full.lag_window_autocorr(window)
+        worst_error = max(worst_error, np.max(np.abs(sliding.lag_sums - expected)) / expected[0])
+        estimated += 1
+        if nearest_note_number(sliding.estimate(window)) != nearest_note_number(reference.estimate(window)):
+            mismatches += 1
+    print(f'{estimated - mismatches}/{estimated} windows produced the same note as freq_from_autocorr')
+    print(f'Worst lag-sum error relative to zero-lag energy: {worst_error:.2e}')
+
+    history = ring.latest(SAMPLES_PER_FFT + SAMPLES_PER_FRAME)
+    iterations = 200
+    print(f'{"estimator":<16}{"us/frame":>12}')
+    print(f'{"lag_window":<16}{time_per_call(lambda: full.estimate(window), iterations):>12.1f}')
+
+    def sliding_frame():
+        sliding.push_frame(history, SAMPLES_PER_FRAME)
+        sliding.estimate(window)
+    print(f'{"sliding":<16}{time_per_call(sliding_frame, iterations):>12.1f}')
+    if mismatches:
+        raise RegressionError(f'{mismatches} windows detected a different note to freq_from_autocorr')
+    if worst_error > LAG_SUM_TOLERANCE:
+        raise RegressionError(f'Lag sums drifted {worst_error:.2e} from a full recompute, '
+                              f'more than the {LAG_SUM_TOLERANCE:.0e} allowed')
+
+
+def detection_latency_ms(estimator_name: str, first_note: int, second_note: int) -> float:
+    """Play `first_note` then `second_note`, returning how long after the change the estimator reports the new note
+    """
+    estimator = make_pitch_estimator(estimator_name, SAMPLE_RATE)
+    note_len = 2 * max(SAMPLES_PER_FFT, estimator.window_size)
+    stream = np.concatenate([synthetic_note(first_note, note_len, seed=first_note),
+                             synthetic_note(second_note, note_len, seed=second_note)])
+    ring = AudioRingBuffer(estimator.window_size + SAMPLES_PER_FRAME)
+    for i in range(len(stream) // SAMPLES_PER_FRAME):
+        ring.write(stream[i * SAMPLES_PER_FRAME:(i + 1) * SAMPLES_PER_FRAME])
+        estimator.push_frame(ring.latest(estimator.window_size + SAMPLES_PER_FRAME), SAMPLES_PER_FRAME)
+        samples_since_change = (i + 1) * SAMPLES_PER_FRAME - note_len
+        if samples_since_change <= 0:
+            continue
+        freq = estimator.estimate(ring.latest(estimator.window_size))
+        if freq > 0 and nearest_note_number(freq) == second_note:
+            return samples_since_change / SAMPLE_RATE * 1000
+    return float('inf')
+
+
+@benchmark
+def bench_latency():
+    """How quickly each estimator notices a note change, and how accurate it is on the regression corpus
+    """
+    note_changes = [(NOTE_MIN, NOTE_MIN + 7), (NOTE_MIN + 12, NOTE_MIN + 5), (NOTE_MAX, NOTE_MIN), (NOTE_MIN, NOTE_MAX)]
+    print(f'{"estimator":<16}{"window":>8}{"latency ms":>12}{"accuracy":>10}{"us/frame":>10}')
+    for name in ('lag_window', 'yin'):
+        estimator = make_pitch_estimator(name, SAMPLE_RATE)
+        latency = np.mean([detection_latency_ms(name, a, b) for a, b in note_changes])
+        corpus = list(regression_corpus(estimator.window_size))
+        correct = sum(nearest_note_number(estimator.estimate(window)) == note for note, window in corpus)
+        window = corpus[0][1]
+        cost = time_per_call(lambda: estimator.estimate(window), 200)
+        print(f'{name:<16}{estimator.window_size:>8}{latency:>12.1f}{correct / len(corpus):>10.1%}{cost:>10.1f}')
+
+
+def stream_estimates(estimator_name: str, stream: np.ndarray, trace_allocations: bool = False) -> Tuple[float, float, float]:
+    """Feed `stream` to a fresh estimator a frame at a time, the way NoteDetector does
+    Returns the frequency estimated for the final window, the mean time per analyzed frame in microseconds (including
+    push_frame), and, with `trace_allocations`, the mean peak memory allocated per analyzed frame in bytes.
+    """
+    # Estimators size their default windows for the (possibly decimated) analysis rate
+    window_size = PITCH_ESTIMATORS[estimator_name].DEFAULT_WINDOW_SIZE * DECIMATION_FACTOR
+    estimator = make_pitch_estimator(estimator_name, SAMPLE_RATE, window_size)
+    ring = AudioRingBuffer(estimator.window_size + SAMPLES_PER_FRAME)
+    freq = 0.0
+    elapsed = 0.0
+    allocated = 0
+    analyzed = 0
+    for i in range(len(stream) // SAMPLES_PER_FRAME):
+        ring.write(stream[i * SAMPLES_PER_FRAME:(i + 1) * SAMPLES_PER_FRAME])
+        if ring.samples_written < estimator.window_size:
+            estimator.push_frame(ring.latest(estimator.window_size + SAMPLES_PER_FRAME), SAMPLES_PER_FRAME)
+            continue
+        if trace_allocations:
+            # Start tracing afresh, so the peak traced memory is what this frame allocates at most. Restarting is
+            # the only way to reset the peak before Python 3.9's tracemalloc.reset_peak()
+            tracemalloc.stop()
+            tracemalloc.start()
+        start = time.perf_counter()
+        estimator.push_frame(ring.latest(estimator.window_size + SAMPLES_PER_FRAME), SAMPLES_PER_FRAME)
+        freq = estimator.estimate(ring.latest(estimator.window_size))
+        elapsed += time.perf_counter() - start
+        if trace_allocations:
+            allocated += tracemalloc.get_traced_memory()[1]
+        analyzed += 1
+    return freq, elapsed / analyzed * 1e6, allocated / analyzed
+
+
+@benchmark
+def bench_estimators():
+    """Accuracy, octave errors, cost and allocations of every registered pitch estimator
+
+    Each estimator is streamed plucked-string tones for every note in the instrument's range, in tune and a third of a
+    semitone either way, at three noise levels. Signals are seeded, so runs are comparable with each other.
+    """
+    cases = [(note, detune, noise) for note in range(NOTE_MIN, NOTE_MAX + 1)
+             for detune in (-0.3, 0.0, 0.3) for noise in (0.01, 0.05, 0.2)]
+    print(f'{"estimator":<12}{"window":>8}{"accuracy":>10}{"octave err":>12}{"other err":>11}'
+          f'{"us/frame":>10}{"alloc KB/frame":>16}')
+    for name, estimator_cls in PITCH_ESTIMATORS.items():
+        window_size = estimator_cls.DEFAULT_WINDOW_SIZE * DECIMATION_FACTOR
+        # Enough audio for a full window and two more frames, so the incremental estimators get exercised too
+        num_samples = window_size + 2 * SAMPLES_PER_FRAME
+        octave_errors = 0
+        other_errors = 0
+        costs = []
+        for i, (note, detune, noise) in enumerate(cases):
+            stream = synthetic_note(note + detune, num_samples, noise=noise, seed=i)
+            freq, cost, _ = stream_estimates(name, stream)
+            costs.append(cost)
+            # Measured against the true frequency, in semitones, so nearest_note_number's octave hot-fix isn't involved
+            error = int(round(12 * np.log2(freq / number_to_freq(note + detune)))) if freq > 0 else None
+            if error is None or (error != 0 and error % 12):
+                other_errors += 1
+            elif error:
+                octave_errors += 1
+
+        tracemalloc.start()
+        try:
+            _, _, allocated = stream_estimates(name, synthetic_note(NOTE_MIN, num_samples), trace_allocations=True)
+        finally:
+            tracemalloc.stop()
+
+        correct = len(cases) - octave_errors - other_errors
+        print(f'{name:<12}{window_size:>8}{correct / len(cases):>10.1%}'
+              f'{octave_errors / len(cases):>12.1%}{other_errors / len(cases):>11.1%}'
+              f'{np.median(costs):>10.1f}{allocated / 1024:>16.1f}')
+
+
+@benchmark
+def bench_decimation():
+    """Accuracy and cost of the lag-window autocorrelator when run on decimated audio
+    """
+    print(f'{"factor":<8}{"window":>8}{"accuracy":>10}{"estimate us":>13}{"decimate us":>13}')
+    for factor in (1, 4, 8):
+        rate = SAMPLE_RATE / factor
+        window_size = SAMPLES_PER_FFT // factor
+        estimator = LagWindowAutocorrelator(rate, window_size)
+        correct = 0
+        total = 0
+        for note, full_rate in regression_corpus(SAMPLES_PER_FFT + SAMPLES_PER_FRAME):
+            decimated = Decimator(factor).process(full_rate) if factor > 1 else full_rate
+            total += 1
+            if nearest_note_number(estimator.estimate(decimated[-window_size:])) == note:
+                correct += 1
+        window = decimated[-window_size:]
+        estimate_cost = time_per_call(lambda: estimator.estimate(window), 200)
+        decimator = Decimator(factor)
+        frame = full_rate[:SAMPLES_PER_FRAME]
+        decimate_cost = time_per_call(lambda: decimator.process(frame), 200) if factor > 1 else 0.0
+        print(f'{factor:<8}{window_size:>8}{correct / total:>10.1%}{estimate_cost:>13.1f}{decimate_cost:>13.1f}')
+
+
+@benchmark
+def bench_bandpass():
+    """Compare redesigning the band-pass on every frame with the streaming second-order-sections filter
+    """
+    low, high = number_to_freq(NOTE_MIN - 1), number_to_freq(NOTE_MAX + 1)
+    stream = synthetic_note(NOTE_MIN + 5, 32 * SAMPLES_PER_FRAME).astype(np.float64)
+    reference = BandpassFilter(low, high, SAMPLE_RATE)
+    expected = stream.astype(np.float32)
+    reference.filter_in_place(expected)
+
+    frames = stream.reshape(-1, SAMPLES_PER_FRAME)
+    stateless = np.concatenate([butter_bandpass_filter(frame, low, high, SAMPLE_RATE) for frame in frames])
+    streaming = BandpassFilter(low, high, SAMPLE_RATE)
+    stateful = frames.astype(np.float32)
+    for frame in stateful:
+        streaming.filter_in_place(frame)
+    stateful = stateful.ravel()
+
+    peak = np.max(np.abs(expected))
+    frame = frames[0].astype(np.float32)
+    print(f'{"filter":<12}{"us/frame":>10}{"max error vs. unbroken stream":>32}')
+    stateless_cost = time_per_call(lambda: butter_bandpass_filter(frame, low, high, SAMPLE_RATE), 500)
+    stateful_cost = time_per_call(lambda: streaming.filter_in_place(frame), 500)
+    print(f'{"stateless":<12}{stateless_cost:>10.1f}{np.max(np.abs(stateless - expected)) / peak:>32.2%}')
+    print(f'{"streaming":<12}{stateful_cost:>10.1f}{np.max(np.abs(stateful - expected)) / peak:>32.2%}')
+
+
+@benchmark
+def bench_chords():
+    """How well the harmonic-sum estimator picks out the notes of chords, and what it costs next to the mono path
+    """
+    from pitch_engine import HarmonicSumEstimator
+
+    # Power chords, and major and minor triads, at every root the instrument can play them from
+    shapes = {'power': (0, 7), 'major': (0, 4, 7), 'minor': (0, 3, 7)}
+    print(f'{"chord":<8}{"all notes found":>16}{"extra notes":>13}')
+    estimator = HarmonicSumEstimator(SAMPLE_RATE, SAMPLES_PER_FFT, max_notes=4)
+    for shape, intervals in shapes.items():
+        exact = 0
+        extra = 0
+        roots = range(NOTE_MIN, NOTE_MAX - max(intervals) + 1)
+        for root in roots:
+            chord = {root + interval for interval in intervals}
+            window = sum(synthetic_note(n, SAMPLES_PER_FFT, noise=0.02, seed=n) for n in chord)
+            estimator.estimate(window)
+            exact += chord <= set(estimator.notes)
+            extra += len(set(estimator.notes) - chord)
+        print(f'{shape:<8}{exact / len(roots):>16.0%}{extra:>13}')
+
+    window = sum(synthetic_note(n, SAMPLES_PER_FFT, seed=n) for n in (NOTE_MIN, NOTE_MIN + 4, NOTE_MIN + 7))
+    mono = LagWindowAutocorrelator(SAMPLE_RATE, SAMPLES_PER_FFT)
+    print(f'{"estimator":<24}{"us/frame":>10}')
+    print(f'{"lag_window (mono)":<24}{time_per_call(lambda: mono.estimate(window), 200):>10.1f}')
+    print(f'{"harmonic_sum (4 notes)":<24}{time_per_call(lambda: estimator.estimate(window), 200):>10.1f}')
+
+
+@benchmark
+def bench_onset():
+    """How many re-picks of the same note the onset detector catches within a frame, and what it costs per frame
+    """
+    from dsp import OnsetDetector
+
+    print(f'{"picks apart":<14}{"caught":>8}{"false onsets":>14}')
+    for gap in (0.12, 0.15, 0.25, 0.4):
+        caught = 0
+        false_onsets = 0
+        total = 0
+        for note in range(NOTE_MIN, NOTE_MAX + 1, 3):
+            pick_len = int(gap * SAMPLE_RATE)
+            stream = np.concatenate([synthetic_note(note, pick_len, noise=0.02, seed=k) for k in range(6)])
+            picks = [k * pick_len // SAMPLES_PER_FRAME for k in range(6)]
+            detector = OnsetDetector(SAMPLE_RATE, SAMPLES_PER_FRAME // 4)
+            onsets = [i for i in range(len(stream) // SAMPLES_PER_FRAME)
+                      if detector.process(stream[i * SAMPLES_PER_FRAME:(i + 1) * SAMPLES_PER_FRAME])]
+            # An onset in the frame after the pick still gets the key pressed within a frame
+            caught += sum(1 for frame in picks if frame in onsets or frame + 1 in onsets)
+            false_onsets += sum(1 for frame in onsets if frame not in picks and frame - 1 not in picks)
+            total += len(picks)
+        print(f'{f"{gap:.2f}s":<14}{caught / total:>8.0%}{false_onsets:>14}')
+
+    detector = OnsetDetector(SAMPLE_RATE, SAMPLES_PER_FRAME // 4)
+    frame = synthetic_note(NOTE_MIN, SAMPLES_PER_FRAME)
+    print(f'us/frame: {time_per_call(lambda: detector.process(frame), 2000):.1f}')
+
+    repick_latency()
+
+
+def repick_latency(picks: int = 6, gap: float = 0.4) -> None:
+    """How many frames after each re-pick of the same note its key is pressed again, through every estimator
+    Only notes the keymap presses (rather than holds) are played. A re-pick should be pressed within a frame.
+    """
+    from audio_processor import hand_off_note
+    from keymaps import MarioMap, compile_keymap
+    from note_detector import NoteDetector
+    from note_reader import NoteReader
+    from output import RecorderBackend
+
+    keymap = compile_keymap(MarioMap())
+    notes = [note for note in range(NOTE_MIN, NOTE_MAX + 1)
+             if keymap.by_number[note] is not None and not keymap.by_number[note].hold]
+    pick_len = int(gap * SAMPLE_RATE)
+    print(f'{"estimator":<14}{"re-picks pressed":>18}{"within a frame":>16}{"mean frames":>13}{"worst":>7}')
+    for name in PITCH_ESTIMATORS:
+        latencies = []
+        missed = 0
+        for note in notes:
+            detector = NoteDetector(estimator=name, sample_rate=SAMPLE_RATE, samples_per_frame=SAMPLES_PER_FRAME)
+            # The first pick rings until the analysis window has filled and it's been pressed
+            first_len = detector.window_size + pick_len
+            stream = np.concatenate([synthetic_note(note, first_len if k == 0 else pick_len, noise=0.02, seed=k)
+                                     for k in range(picks)])
+            output = RecorderBackend()
+            note_reader = NoteReader(output=output)
+            for i in range(len(stream) // SAMPLES_PER_FRAME):
+                output.time = i
+                detected = detector.process_frame(stream[i * SAMPLES_PER_FRAME:(i + 1) * SAMPLES_PER_FRAME])
+                if detected is not None:
+                    hand_off_note(detector, note_reader, detected)
+            presses = [event.time for event in output.events if event.kind == 'send']
+            # The first pick is a new note rather than a re-pick, so it isn't counted
+            for k in range(1, picks):
+                pick_frame = (first_len + (k - 1) * pick_len) // SAMPLES_PER_FRAME
+                next_pick = (first_len + k * pick_len) // SAMPLES_PER_FRAME
+                pressed = [t for t in presses if pick_frame <= t < next_pick]
+                if pressed:
+                    latencies.append(pressed[0] - pick_frame)
+                else:
+                    missed += 1
+        total = len(latencies) + missed
+        within = sum(1 for latency in latencies if latency <= 1)
+        mean = np.mean(latencies) if latencies else float('nan')
+        worst = max(latencies) if latencies else 0
+        print(f'{name:<14}{len(latencies) / total:>18.0%}{within / total:>16.0%}{mean:>13.1f}{worst:>7}')
+
+
+@benchmark
+def bench_instrumentation():
+    """What the per-stage latency stats add to each frame, when enabled and when not
+
+    The same audio is run through two AudioProcessors, with the stats off and on, along the real per-frame path from
+    frame provider to NoteReader. They take turns a frame at a time, so drift in the machine's speed affects both
+    alike, and the median time per frame is compared. Quiet audio skips pitch estimation, leaving the pipeline's own
+    bookkeeping, so the stats' cost shows up clearest there.
+    """
+    import atexit
+    from audio_processor import AudioProcessor
+    from frame_provider import ArrayFrameProvider
+    from note_reader import NoteReader
+    from output import NullBackend
+
+    # Plucked notes, so the noise gate stays open and every frame is estimated and handed to the NoteReader
+    pluck = SAMPLE_RATE // 4
+    melody = np.concatenate([synthetic_note(note, pluck, seed=note) for note in range(NOTE_MIN, NOTE_MAX + 1)])
+    frame_count = len(melody) // SAMPLES_PER_FRAME
+    melody = melody[:frame_count * SAMPLES_PER_FRAME].astype(np.int16)
+    quiet = np.random.RandomState(0).normal(0, 1, len(melody)).astype(np.int16)
+
+    print(f'{"audio":<10}{"disabled us/frame":>19}{"enabled us/frame":>18}{"difference":>12}')
+    for name, audio in (('quiet', quiet), ('melody', melody)):
+        processors = [AudioProcessor(frame_provider=ArrayFrameProvider(audio, SAMPLE_RATE, SAMPLES_PER_FRAME),
+                                     note_reader=NoteReader(output=NullBackend()),
+                                     latency_stats=enabled) for enabled in (False, True)]
+        times = [[], []]
+        for i in range(frame_count):
+            for j in ((0, 1) if i % 2 else (1, 0)):
+                processor = processors[j]
+                provider = processor.audio_frame_provider
+                start = time.perf_counter()
+                samples_written = provider.read_into(processor.note_detector.ring_buffer,
+                                                     processor.note_detector.frame_filter)
+                processor.process_buffered_frame(samples_written, provider.last_capture_time)
+                times[j].append(time.perf_counter() - start)
+        # Don't leave a stats file behind
+        atexit.unregister(processors[1].latency.dump)
+        disabled, enabled = (np.median(frame_times) * 1e6 for frame_times in times)
+        print(f'{name:<10}{disabled:>19.1f}{enabled:>18.1f}{enabled - disabled:>12.1f}')
+
+
+@benchmark
+def bench_keymap():
+    """Per-frame cost of resolving a note to a key action, before and after compiling the keymap
+    """
+    keymap = MarioMap()
+    compiled = compile_keymap(keymap)
+    notes = ['F2', 'F3', 'C4', 'E2', 'F#4', 'G#3']
+    numbers = [note_number(note) for note in notes]
+
+    def dynamic_lookup():
+        for note in notes:
+            key_or_key_list = keymap.key_for_note(note)
+            keymap.should_hold_key(key_or_key_list)
+            if isinstance(key_or_key_list, list):
+                "+".join(key_or_key_list)
+
+    def compiled_by_name():
+        for note in notes:
+            compiled.action_for_note(note)
+
+    def compiled_by_number():
+        for n in numbers:
+            compiled.action_for_number(n)
+
+    iterations = 20000
+    print(f'{"lookup":<20}{"us/note":>10}')
+    for name, func in (('key_for_note', dynamic_lookup), ('compiled by name', compiled_by_name),
+                       ('compiled by number', compiled_by_number)):
+        print(f'{name:<20}{time_per_call(func, iterations) / len(notes):>10.3f}')
+
+
+@benchmark
+def bench_noise_gate():
+    """Per-frame cost of steady noise louder than MIN_VOLUME, gated at MIN_VOLUME alone and by the adaptive gate, and
+    of keeping the gate's energy up to date
+    """
+    from note_detector import NoteDetector
+
+    warmup_frames = 300
+    idle_frames = 100
+    frame_count = warmup_frames + idle_frames
+    rng = np.random.RandomState(0)
+    # Hum and hiss from a noisy amp, well above MIN_VOLUME, then a note played over it
+    t = np.arange(SAMPLES_PER_FRAME * frame_count) / SAMPLE_RATE
+    noise = (2000 * np.sin(2 * np.pi * 60 * t) + rng.normal(0, 1000, len(t))).astype(np.float32)
+    note = synthetic_note(NOTE_MIN + 12, len(t)) * 4 + noise
+    print(f'{"gate":<12}{"frames estimated":>18}{"idle us/frame":>15}{"note detected":>15}')
+    for name in ('MIN_VOLUME', 'adaptive'):
+        detector = NoteDetector()
+        if name == 'MIN_VOLUME':
+            detector.noise_gate = None
+        estimated = [0]
+        estimate = detector.pitch_estimator.estimate
+
+        def counting_estimate(sig):
+            estimated[0] += 1
+            return estimate(sig)
+        detector.pitch_estimator.estimate = counting_estimate
+
+        frames = iter(noise.reshape(frame_count, SAMPLES_PER_FRAME))
+        # Give the gate time to learn the noise floor before timing it
+        for _ in range(warmup_frames):
+            detector.process_frame(next(frames))
+        idle_us = time_per_call(lambda: detector.process_frame(next(frames)), idle_frames)
+        noise_estimated = estimated[0]
+        detected = {detector.process_frame(frame) for frame in note.reshape(frame_count, SAMPLES_PER_FRAME)}
+        print(f'{name:<12}{f"{noise_estimated}/{frame_count}":>18}{idle_us:>15.1f}{str(NOTE_MIN + 12 in detected):>15}')
+
+    # The running energy costs the same whatever the window, while a norm has to go over all of it every frame
+    frame = noise[:SAMPLES_PER_FRAME]
+    print(f'{"energy window":<16}{"norm us/frame":>15}{"running us/frame":>18}')
+    for window_frames in (2, 8, FRAMES_PER_FFT):
+        plain = AudioRingBuffer(SAMPLES_PER_FFT + SAMPLES_PER_FRAME)
+        tracked = AudioRingBuffer(SAMPLES_PER_FFT + SAMPLES_PER_FRAME, energy_window=window_frames * SAMPLES_PER_FRAME)
+
+        def norm_of_window():
+            plain.write(frame)
+            np.linalg.norm(plain.latest(window_frames * SAMPLES_PER_FRAME))
+
+        print(f'{f"{window_frames} frames":<16}{time_per_call(norm_of_window, 5000):>15.2f}'
+              f'{time_per_call(lambda: tracked.write(frame), 5000):>18.2f}')
+
+
+@benchmark
+def bench_output():
+    """Headless end-to-end throughput, and what sending key events costs the DSP loop when the OS is slow to take them
+    """
+    from audio_processor import hand_off_note
+    from note_detector import NoteDetector
+    from note_reader import NoteReader
+    from output import OutputBackend, RecorderBackend, ThreadedBackend
+
+    # A melody of plucked notes, a quarter of a second each
+    pluck = SAMPLE_RATE // 4
+    melody = np.concatenate([synthetic_note(note, pluck, seed=note) for note in range(NOTE_MIN, NOTE_MAX + 1)] * 4)
+    frames = melody[:len(melody) // SAMPLES_PER_FRAME * SAMPLES_PER_FRAME].reshape(-1, SAMPLES_PER_FRAME)
+    detector = NoteDetector()
+    recorder = RecorderBackend()
+    note_reader = NoteReader(output=recorder)
+
+    start = time.perf_counter()
+    for frame in frames:
+        note = detector.process_frame(frame)
+        if note is not None:
+            hand_off_note(detector, note_reader, note)
+    elapsed = time.perf_counter() - start
+    print(f'{len(frames) / elapsed:.0f} frames/s ({len(frames) * SAMPLES_PER_FRAME / SAMPLE_RATE / elapsed:.0f}x '
+          f'real time), {len(recorder.events)} events')
+
+    class SlowBackend(OutputBackend):
+        """Stands in for OS input calls which take a millisecond each"""
+        def __init__(self):
+            self.sent = 0
+
+        def emit(self, kind, key=''):
+            time.sleep(0.001)
+            self.sent += 1
+
+    # Taps of different keys, while a held note flickers in and out of silence, so its key is released and pressed
+    # again over and over
+    events = [event for i in range(100) for event in (('send', 'abcde'[i % 5]), ('release', 'left'), ('press', 'left'))]
+    print(f'{"backend":<12}{"us/event":>10}{"events sent":>13}')
+    for name in ('inline', 'threaded'):
+        slow = SlowBackend()
+        backend = slow if name == 'inline' else ThreadedBackend(slow)
+        event_iter = iter(events)
+        us = time_per_call(lambda: backend.emit(*next(event_iter)), len(events))
+        backend.close()
+        print(f'{name:<12}{us:>10.1f}{f"{slow.sent}/{len(events)}":>13}')
+
+
+@benchmark
+def bench_mouse():
+    """How smoothly the mouse moves while frames are being analyzed, moving once per frame as it used to, and on the
+    motion thread
+    """
+    from mouse import MotionEngine
+    from note_detector import NoteDetector
+
+    detector = NoteDetector()
+    frames = synthetic_note(NOTE_MIN, SAMPLES_PER_FRAME * 100).reshape(-1, SAMPLES_PER_FRAME)
+    frame_period = SAMPLES_PER_FRAME / SAMPLE_RATE
+    duration = 2.0
+
+    def analyze_in_real_time(on_frame: Callable[[], None]) -> None:
+        """Analyze frames as they'd arrive from a microphone, with every 20th taking an extra 100ms"""
+        start = time.monotonic()
+        i = 0
+        while time.monotonic() - start < duration:
+            time.sleep(max(0.0, start + (i + 1) * frame_period - time.monotonic()))
+            detector.process_frame(frames[i % len(frames)])
+            if i % 20 == 19:
+                time.sleep(0.1)
+            on_frame()
+            i += 1
+
+    print(f'{"motion":<12}{"moves/s":>9}{"max gap ms":>12}')
+    per_frame = []
+    analyze_in_real_time(lambda: per_frame.append(time.monotonic()))
+    threaded = []
+    engine = MotionEngine(move=lambda dx, dy: threaded.append(time.monotonic()))
+    engine.steer(1, 0)
+    analyze_in_real_time(lambda: None)
+    engine.stop()
+    engine.close()
+    for name, moves in (('per frame', per_frame), ('thread', threaded)):
+        print(f'{name:<12}{len(moves) / duration:>9.0f}{np.max(np.diff(moves)) * 1000:>12.1f}')
+    print(engine.stats_line())
+
+
+@benchmark
+def bench_channels():
+    """Per-frame DSP cost of analyzing several input channels, one after another and in parallel
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from multichannel import Channel
+
+    frame_count = 200
+    print(f'{"channels":<10}{"serial us/frame":>16}{"parallel us/frame":>19}')
+    for channel_count in (1, 2, 4):
+        stream = np.stack([synthetic_note(NOTE_MIN + 5 * c, SAMPLES_PER_FRAME * frame_count, seed=c)
+                           for c in range(channel_count)])
+        frames = [stream[:, i * SAMPLES_PER_FRAME:(i + 1) * SAMPLES_PER_FRAME] for i in range(frame_count)]
+        serial = [Channel(note_reader=None) for _ in range(channel_count)]
+        parallel = [Channel(note_reader=None) for _ in range(channel_count)]
+        pool = ThreadPoolExecutor(channel_count)
+        frame_iter = iter(frames * 2)
+
+        def analyze_serial():
+            for channel, frame in zip(serial, next(frame_iter)):
+                channel.analyze(frame)
+
+        def analyze_parallel():
+            list(pool.map(Channel.analyze, parallel, next(frame_iter)))
+
+        serial_us = time_per_call(analyze_serial, frame_count)
+        parallel_us = time_per_call(analyze_parallel, frame_count)
+        pool.shutdown()
+        print(f'{channel_count:<10}{serial_us:>16.1f}{parallel_us:>19.1f}')
+
+
+@benchmark
+def bench_session_log():
+    """What recording the session log costs the DSP loop per frame, and how fast the log reads back for replay
+    """
+    import tempfile
+    from session_log import SessionRecorder, read_session
+
+    frame_count = 2000
+    frames = synthetic_note(NOTE_MIN, SAMPLES_PER_FRAME * frame_count).astype(np.int16).reshape(-1, SAMPLES_PER_FRAME)
+    with tempfile.TemporaryDirectory() as tmp:
+        recorder = SessionRecorder(tmp, SAMPLE_RATE, max_bytes=2**30, queue_frames=frame_count)
+        frame_iter = iter(frames)
+
+        def record():
+            recorder.start_frame(next(frame_iter), time.monotonic())
+            recorder.add_event('send', 'a')
+            recorder.end_frame(NOTE_MIN, 82.4, 1.0)
+
+        us = time_per_call(record, frame_count)
+        start = time.perf_counter()
+        recorder.close()
+        flush_ms = (time.perf_counter() - start) * 1000
+        print(f'record {us:.1f} us/frame on the DSP thread, then {flush_ms:.0f}ms to finish writing '
+              f'{recorder.bytes_written / 2**20:.1f}MB, {recorder.dropped_frames} frames dropped')
+
+        start = time.perf_counter()
+        read = sum(1 for _ in read_session(tmp))
+        elapsed = time.perf_counter() - start
+        audio_seconds = read * SAMPLES_PER_FRAME / SAMPLE_RATE
+        print(f'read back {read} frames at {read / elapsed:.0f} frames/s ({audio_seconds / elapsed:.0f}x real time)')
+
+
+# Run in a separate process by bench_shared_capture: attaches to the capture ring named on the command line, copies each
+# frame into a ring buffer as a consumer would, then prints the frames read, dropped and torn, a checksum of their
+# samples, and the CPU time spent per frame
+SHARED_CONSUMER_SCRIPT = """
+import sys, time
+import numpy as np
+from ring_buffer import AudioRingBuffer
+from shared_capture import SharedMemoryFrameProvider
+provider = SharedMemoryFrameProvider(sys.argv[1])
+ring_buffer = AudioRingBuffer(provider.samples_per_frame * 16)
+print('ready', flush=True)
+frames = checksum = 0
+start = time.process_time()
+while provider.has_frames():
+    try:
+        provider.read_into(ring_buffer)
+    except EOFError:
+        break
+    frames += 1
+    checksum += int(ring_buffer.latest(provider.samples_per_frame).sum())
+cpu = time.process_time() - start
+print(frames, provider.dropped_frames, provider.torn_frames, checksum, cpu / max(frames, 1))
+"""
+
+
+@benchmark
+def bench_shared_capture():
+    """CPU per frame for several consumers of one instrument, each analyzing the audio itself or sharing a capture
+    server's analysis through shared memory, and whether every frame reaches the consumers intact
+    """
+    import os
+    import subprocess
+    from frame_provider import FrameProvider
+    from note_detector import NoteDetector
+    from shared_capture import CaptureServer
+
+    # A melody of plucked notes, so the noise gate stays open and every frame is analyzed
+    pluck = SAMPLE_RATE // 4
+    melody = np.concatenate([synthetic_note(note, pluck, seed=note) for note in range(NOTE_MIN, NOTE_MAX + 1)])
+    frame_count = len(melody) // SAMPLES_PER_FRAME
+    frames = melody[:frame_count * SAMPLES_PER_FRAME].astype(np.int16).reshape(-1, SAMPLES_PER_FRAME)
+    detector = NoteDetector()
+    frame_iter = iter(frames)
+    own_us = time_per_call(lambda: detector.process_frame(next(frame_iter)), frame_count)
+
+    class Frames(FrameProvider):
+        """Only describes the frames; the benchmark hands them to the server itself"""
+        def has_frames(self):
+            return False
+
+        def get_frame(self):
+            pass
+
+    consumer_count = 3
+    server = CaptureServer(Frames(SAMPLE_RATE, SAMPLES_PER_FRAME), name='offkeyboard-benchmark')
+    here = os.path.dirname(os.path.abspath(__file__))
+    consumers = [subprocess.Popen([sys.executable, '-c', SHARED_CONSUMER_SCRIPT, 'offkeyboard-benchmark'], cwd=here,
+                                  stdout=subprocess.PIPE, text=True) for _ in range(consumer_count)]
+    for consumer in consumers:
+        consumer.stdout.readline()
+    # Publish at four times real time
+    period = SAMPLES_PER_FRAME / SAMPLE_RATE / 4
+    server_cpu = 0.0
+    for frame in frames:
+        start = time.process_time()
+        server.process_frame(frame, time.monotonic())
+        server_cpu += time.process_time() - start
+        time.sleep(max(0.0, period - (time.process_time() - start)))
+    server.close()
+    results = [consumer.communicate()[0].split() for consumer in consumers]
+    server_us = server_cpu / frame_count * 1e6
+    consumer_us = np.mean([float(result[4]) for result in results]) * 1e6
+
+    print(f'{"consumers":<11}{"own analysis us/frame":>23}{"shared us/frame":>17}')
+    for n in (1, 2, consumer_count):
+        print(f'{n:<11}{n * own_us:>23.0f}{server_us + n * consumer_us:>17.0f}')
+    intact = all(int(result[3]) == int(frames.astype(np.int64).sum()) for result in results)
+    print(f'server {server_us:.0f} us/frame, each consumer {consumer_us:.0f} us/frame. '
+          f'Frames read: {", ".join(result[0] for result in results)} of {frame_count}, '
+          f'dropped: {sum(int(result[1]) for result in results)}, torn: {sum(int(result[2]) for result in results)}, '
+          f'samples {"intact" if intact else "CORRUPTED"}')
+
+
+# Run in a fresh interpreter by bench_startup: starts the pipeline the way __init__.main() does, but reads a sound
+# file and sends its events nowhere, then prints the seconds taken to import it and to analyze the first frame
+STARTUP_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import audio_processor, multichannel, pipeline
+from note_reader import NoteReader
+from output import NullBackend
+imported = time.perf_counter()
+provider = audio_processor.get_frame_provider(False, filename=sys.argv[1])
+processor = audio_processor.AudioProcessor(frame_provider=provider, note_reader=NoteReader(output=NullBackend()))
+detector = processor.note_detector
+while detector.detect(provider.read_into(detector.ring_buffer, detector.frame_filter)) is None:
+    pass
+analyzed = time.perf_counter()
+heavy = [name for name in ('pylab', 'scipy.signal', 'pyaudio', 'keyboard', 'foohid', 'Quartz') if name in sys.modules]
+print(imported - start, analyzed - imported, ','.join(heavy))
+"""
+
+
+@benchmark
+def bench_startup():
+    """Cold start: how long a fresh interpreter takes to import the pipeline, and then to analyze its first frame
+    """
+    import os
+    import subprocess
+    import tempfile
+    import wave
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, 'startup.wav')
+        with wave.open(filename, 'wb') as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(SAMPLE_RATE)
+            wav.writeframes(synthetic_note(NOTE_MIN, SAMPLES_PER_FFT * 2).astype(np.int16).tobytes())
+
+        runs = []
+        for _ in range(5):
+            result = subprocess.run([sys.executable, '-c', STARTUP_SCRIPT, filename], cwd=here, check=True,
+                                    capture_output=True, text=True)
+            import_s, first_frame_s, heavy = (result.stdout.split() + [''])[:3]
+            runs.append((float(import_s), float(first_frame_s)))
+    import_ms, first_frame_ms = np.median(runs, axis=0) * 1000
+    print(f'import {import_ms:.0f}ms, first analyzed frame {first_frame_ms:.0f}ms later, '
+          f'{import_ms + first_frame_ms:.0f}ms total (median of {len(runs)})')
+    print(f'optional modules loaded: {heavy or "none"}')
+
+
+def main():
+    names = sys.argv[1:] or list(BENCHMARKS)
+    failed = []
+    for name in names:
+        if name not in BENCHMARKS:
+            print(f'Unknown benchmark {name}, choose from: {", ".join(BENCHMARKS)}')
+            continue
+        print(f'== {name}')
+        try:
+            BENCHMARKS[name]()
+        except RegressionError as e:
+            print(f'FAILED: {e}')
+            failed.append(name)
+    if failed:
+        print(f'Regressions found by: {", ".join(failed)}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
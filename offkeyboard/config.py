@@ -1,3 +1,5 @@
+import os as _os
+
 # #####
 # Settings you should feel free to play around with.
 # #####
@@ -27,8 +29,44 @@ COMBO_KEYS_TO_NOTES = {
     'F#4': ['up', 'right'],
 }
 
+# Chords, and the keys they press, when POLYPHONIC is on. A chord is triggered whenever all of its notes are heard,
+# even alongside others. A note an octave above another in the chord can't be told apart from the lower note's
+# harmonics, so leave octave doublings out
+POLYPHONIC = False
+MAX_CHORD_NOTES = 4
+CHORD_KEYS_TO_NOTES = {
+    ('E2', 'B2'): ['shift', 'right'],
+    ('A2', 'E3'): ['shift', 'left'],
+    ('G2', 'B2', 'D3'): ['up', 'right'],
+}
+
 MIN_VOLUME = 100000  # Any audio below this value is considered silence. Chosen through experimentation
 
+# Rather than comparing each frame against MIN_VOLUME alone, gate out the noise floor, wherever it happens to be. The
+# gate opens once the last NOISE_GATE_WINDOW frames are NOISE_GATE_OPEN_RATIO times louder than the floor (and at
+# least MIN_VOLUME), and closes again below NOISE_GATE_CLOSE_RATIO of that. The floor falls with the audio straight
+# away, but only rises NOISE_FLOOR_RISE dB a second (much slower while notes are ringing). Pitch isn't estimated at
+# all while the gate is closed
+NOISE_GATE = True
+NOISE_GATE_WINDOW = 2
+NOISE_GATE_OPEN_RATIO = 4.0
+NOISE_GATE_CLOSE_RATIO = 0.5
+NOISE_FLOOR_RISE = 3.0
+
+# A note is only pressed once it has been detected in NOTE_VOTES_TO_COMMIT of the last NOTE_VOTE_WINDOW frames.
+# Fewer votes react faster, but let through more stray notes
+NOTE_VOTE_WINDOW = 10
+NOTE_VOTES_TO_COMMIT = 4
+# Notes the pitch estimator is at least this confident of, EARLY_COMMIT_FRAMES frames running, are pressed straight
+# away, without waiting for votes. Set EARLY_COMMIT_CONFIDENCE above 1 to always wait for votes
+EARLY_COMMIT_CONFIDENCE = 0.95
+EARLY_COMMIT_FRAMES = 2
+
+# Re-press a note when its string is picked again, rather than only when the note changes. A pick is spotted by the
+# frame's energy jumping to ONSET_THRESHOLD times what it was
+ONSET_DETECTION = True
+ONSET_THRESHOLD = 2.0
+
 # #####
 # You probably won't need to modify things in this section, as they deal with signal processing
 # #####
@@ -40,6 +78,40 @@ NOTE_MAX = 64        # E4
 SAMPLE_RATE = 22050         # sampling frequency in Hz
 FRAMES_PER_FFT = 16         # run FFT over how many frames?
 SAMPLES_PER_FRAME = 1024    # samples per frame
+DECIMATION_FACTOR = 1       # analyze audio at SAMPLE_RATE / DECIMATION_FACTOR. 4 or 8 is plenty for bass and guitar
+BANDPASS_FILTER = False     # band-pass the audio to the instrument's range before estimating pitch
+THREADED_PIPELINE = False   # capture, analyze and send key events on separate threads
+
+# Capture this many channels from the audio interface, e.g. 2 for a guitar and a bass, each with its own keymap
+# (the name of a class in keymaps.py)
+INPUT_CHANNELS = 1
+CHANNEL_KEYMAPS = ['MarioMap', 'MinecraftMap']
+
+LATENCY_STATS = False                       # time each stage from capture to key event (see latency.py)
+LATENCY_STATS_INTERVAL = 10.0               # print a summary of the stage timings this often, in seconds
+LATENCY_STATS_FILE = 'latency_stats.json'   # where the full timing histograms are written on exit
+
+# Capture and analyze the audio once, in a capture server (`python offkeyboard/shared_capture.py serve`), and share the
+# frames and the notes detected in them with any number of other processes through shared memory (see
+# shared_capture.py). The shared ring holds SHARED_CAPTURE_SLOTS frames, about 3 seconds of audio
+SHARED_CAPTURE_NAME = 'offkeyboard-capture'
+SHARED_CAPTURE_SLOTS = 64
+
+# Keep the last SESSION_LOG_MAX_MB of microphone audio, along with the notes detected and keys sent for it, in
+# SESSION_LOG_DIR, so a missed note can be replayed with `python offkeyboard/session_log.py` (see session_log.py).
+# A megabyte holds about 24 seconds of audio. The log lives next to this file, wherever offkeyboard is run from
+SESSION_LOG = True
+SESSION_LOG_DIR = _os.path.join(_os.path.dirname(_os.path.abspath(__file__)), 'session_log')
+SESSION_LOG_MAX_MB = 64
+SESSION_LOG_SEGMENT_MB = 4
+
+# Which pitch estimator to run on each analysis window (see pitch_engine.PITCH_ESTIMATORS, or compare them all with
+# `python offkeyboard/benchmarks.py estimators`).
+# 'sliding' updates its autocorrelation incrementally as each frame arrives, rather than recomputing it.
+# 'yin' only needs a few periods of audio, so it reacts to note changes much sooner.
+PITCH_ESTIMATOR = 'lag_window'
+FRAMES_PER_YIN_WINDOW = 2   # the YIN estimator looks at this many frames, rather than FRAMES_PER_FFT
+YIN_THRESHOLD = 0.15        # lower values make YIN stricter about what it considers periodic
 
 
 # #####
@@ -51,10 +123,41 @@ MOUSE_DOWN_NOTE = 'E3'
 MOUSE_UP_NOTE = 'F3'
 MOUSE_RIGHT_NOTE = 'F#3'
 MOUSE_CLICK_NOTE = 'G3'
-MOUSE_SPEED = 30
+
+# While a mouse note is held, the mouse moves on a thread of its own, MOUSE_MOTION_RATE times a second. It starts out
+# at MOUSE_MIN_SPEED pixels a second, and speeds up to MOUSE_MAX_SPEED over MOUSE_ACCEL_TIME seconds. An
+# MOUSE_ACCEL_EXPONENT of 1 speeds up evenly, and higher ones stay slow for longer, for finer aiming
+MOUSE_MOTION_RATE = 250
+MOUSE_MIN_SPEED = 300
+MOUSE_MAX_SPEED = 1500
+MOUSE_ACCEL_TIME = 0.5
+MOUSE_ACCEL_EXPONENT = 2.0
 
 CRAFT_NOTE = 'A3'
 ATTACK_NOTE = 'A#3'
 PICK_BLOCK_NOTE = 'B3'
 PLACE_BLOCK_NOTE = 'C3'
 
+
+# #####
+# Values picked by tuner.py for your instrument and room, if you've run it, override the ones above
+# #####
+
+import json as _json
+
+TUNED_CONFIG_FILE = _os.path.join(_os.path.dirname(_os.path.abspath(__file__)), 'tuned_config.json')
+TUNABLE_SETTINGS = (
+    'MIN_VOLUME',
+    'FRAMES_PER_FFT',
+    'NOTE_VOTE_WINDOW',
+    'NOTE_VOTES_TO_COMMIT',
+    'EARLY_COMMIT_CONFIDENCE',
+)
+
+if _os.path.exists(TUNED_CONFIG_FILE):
+    with open(TUNED_CONFIG_FILE) as _f:
+        _tuned = {name: value for name, value in _json.load(_f).items() if name in TUNABLE_SETTINGS}
+    globals().update(_tuned)
+    # Say so, since these quietly take precedence over anything edited above. Delete the file to go back to them
+    print(f'Using tuned settings from {TUNED_CONFIG_FILE}: '
+          + ', '.join(f'{name}={value}' for name, value in _tuned.items()))
@@ -0,0 +1,208 @@
+"""Regression runner over a corpus of labelled recordings
+
+Each WAV file in the corpus directory needs a label file next to it with the same name and a .csv extension. Each row
+of the label file holds the time (in seconds) a note starts and the note's name, e.g. `1.25,A2`. Use `silence` to mark
+where a note stops ringing.
+
+Every recording is played through the full AudioProcessor -> NoteReader path, headless, spread across a process pool.
+The report gives, per file and overall, how many labelled notes were pressed, how many presses didn't match the note
+being played, how long presses took to arrive, and how many frames per second were processed.
+
+Usage:
+    python offkeyboard/corpus.py path/to/corpus [-o report.json] [-j processes]
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import time
+from collections import namedtuple
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from config import SAMPLES_PER_FRAME
+from note_reader import NoteReader
+from note_utils import SILENCE_NOTE, note_number
+from output import NullBackend
+
+
+# A note starting to ring at `time` seconds into a recording
+Label = namedtuple('Label', ['time', 'note'])
+
+# A note the NoteReader committed to (by tapping or holding its key) at `time` seconds into a recording
+Press = namedtuple('Press', ['time', 'note'])
+
+
+def load_labels(filename: str) -> List[Label]:
+    labels = []
+    with open(filename, newline='') as f:
+        for row in csv.reader(f):
+            if not row or row[0].startswith('#'):
+                continue
+            name = row[1].strip()
+            note = SILENCE_NOTE if name in ('silence', 'rest') else note_number(name)
+            labels.append(Label(float(row[0]), note))
+    return sorted(labels)
+
+
+def find_recordings(directory: str) -> List[Tuple[str, str]]:
+    """(wav, label file) pairs for every labelled recording in a directory
+    """
+    pairs = []
+    for name in sorted(os.listdir(directory)):
+        base, ext = os.path.splitext(name)
+        labels = os.path.join(directory, base + '.csv')
+        if ext.lower() == '.wav' and os.path.exists(labels):
+            pairs.append((os.path.join(directory, name), labels))
+    return pairs
+
+
+def score_presses(labels: List[Label], presses: List[Press], duration: float) -> Dict:
+    """Compare the notes a NoteReader pressed against what was actually played
+
+    A labelled note counts as detected if it was pressed before the next label. Any press of a note other than the one
+    ringing at the time is a false press.
+    """
+    detected = 0
+    latencies = []
+    false_presses = 0
+    press_times = np.array([p.time for p in presses])
+    for i, label in enumerate(labels):
+        end = labels[i + 1].time if i + 1 < len(labels) else duration
+        lo, hi = np.searchsorted(press_times, [label.time, end])
+        in_span = presses[lo:hi]
+        false_presses += sum(1 for p in in_span if p.note != label.note)
+        if label.note == SILENCE_NOTE:
+            continue
+        hits = [p.time for p in in_span if p.note == label.note]
+        if hits:
+            detected += 1
+            latencies.append(hits[0] - label.time)
+    # Presses before the first label can't have been right
+    first_label = labels[0].time if labels else duration
+    false_presses += int(np.searchsorted(press_times, first_label))
+
+    notes = sum(1 for label in labels if label.note != SILENCE_NOTE)
+    return {
+        'notes': notes,
+        'detected': detected,
+        'accuracy': detected / notes if notes else 1.0,
+        'presses': len(presses),
+        'false_presses': false_presses,
+        'mean_latency_ms': float(np.mean(latencies) * 1000) if latencies else None,
+        'p95_latency_ms': float(np.percentile(latencies, 95) * 1000) if latencies else None,
+    }
+
+
+def recording_note_reader(presses: List[Press], clock: List[float], **note_reader_kwargs) -> NoteReader:
+    """A NoteReader which sends no key events, but appends a Press to `presses`, stamped with `clock[0]`, for every
+    note it commits to
+    """
+    class RecordingNoteReader(NoteReader):
+        def hold_key(self, note, action):
+            if note != SILENCE_NOTE:
+                presses.append(Press(clock[0], note))
+            super(RecordingNoteReader, self).hold_key(note, action)
+
+        def quick_press_key_for_note(self, note, action):
+            # The reader also commits to silence, but that never presses anything
+            if note != SILENCE_NOTE:
+                presses.append(Press(clock[0], note))
+            super(RecordingNoteReader, self).quick_press_key_for_note(note, action)
+
+    return RecordingNoteReader(output=NullBackend(), **note_reader_kwargs)
+
+
+def run_headless(wav_filename: str, note_reader_kwargs: Optional[Dict] = None) -> Tuple[List[Press], int, float]:
+    """Play a recording through AudioProcessor and a NoteReader which sends no key events
+    Returns the presses the NoteReader made, the number of frames processed, and the recording's duration.
+    """
+    from audio_processor import AudioProcessor, get_frame_provider
+    from frame_provider import WavFileFrameProvider
+
+    presses: List[Press] = []
+    clock = [0.0]
+
+    source = WavFileFrameProvider(wav_filename, SAMPLES_PER_FRAME)
+    provider = get_frame_provider(source=source)
+    note_reader = recording_note_reader(presses, clock, **(note_reader_kwargs or {}))
+    processor = AudioProcessor(frame_provider=provider, note_reader=note_reader)
+
+    frames = 0
+    while provider.has_frames():
+        frames += 1
+        # Stamp presses with the time the frame would have finished arriving from a microphone
+        clock[0] = frames * SAMPLES_PER_FRAME / source.sample_rate
+        samples_written = provider.read_into(processor.note_detector.ring_buffer, processor.note_detector.frame_filter)
+        processor.process_buffered_frame(samples_written)
+    return presses, frames, source.wav.getnframes() / source.sample_rate
+
+
+def evaluate_recording(paths: Tuple[str, str]) -> Dict:
+    wav_filename, labels_filename = paths
+    start = time.perf_counter()
+    presses, frames, duration = run_headless(wav_filename)
+    elapsed = time.perf_counter() - start
+
+    result = score_presses(load_labels(labels_filename), presses, duration)
+    result.update({
+        'file': os.path.basename(wav_filename),
+        'duration_s': duration,
+        'frames': frames,
+        'frames_per_sec': frames / elapsed if elapsed else None,
+    })
+    return result
+
+
+def summarize(results: List[Dict], elapsed: float) -> Dict:
+    notes = sum(r['notes'] for r in results)
+    detected = sum(r['detected'] for r in results)
+    latencies = [(r['mean_latency_ms'], r['detected']) for r in results if r['mean_latency_ms'] is not None]
+    frames = sum(r['frames'] for r in results)
+    return {
+        'files': len(results),
+        'notes': notes,
+        'detected': detected,
+        'accuracy': detected / notes if notes else 1.0,
+        'false_presses': sum(r['false_presses'] for r in results),
+        # Weighted by the number of detected notes in each file
+        'mean_latency_ms': sum(l * n for l, n in latencies) / sum(n for _, n in latencies) if latencies else None,
+        'frames': frames,
+        'frames_per_sec': frames / elapsed if elapsed else None,
+        'wall_time_s': elapsed,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check note detection against a corpus of labelled recordings')
+    parser.add_argument('corpus', help='directory of .wav files, each with a .csv label file')
+    parser.add_argument('-o', '--output', default='corpus_report.json', help='where to write the JSON report')
+    parser.add_argument('-j', '--processes', type=int, default=multiprocessing.cpu_count())
+    args = parser.parse_args(argv)
+
+    recordings = find_recordings(args.corpus)
+    if not recordings:
+        print(f'No labelled recordings found in {args.corpus}')
+        return
+
+    start = time.perf_counter()
+    with multiprocessing.Pool(args.processes) as pool:
+        results = sorted(pool.imap_unordered(evaluate_recording, recordings), key=lambda r: r['file'])
+    summary = summarize(results, time.perf_counter() - start)
+
+    with open(args.output, 'w') as f:
+        json.dump({'summary': summary, 'files': results}, f, indent=2)
+
+    for r in results:
+        print(f'{r["file"]:<40}{r["accuracy"]:>8.1%}{r["false_presses"]:>6} false'
+              f'{r["mean_latency_ms"] or float("nan"):>10.0f} ms{r["frames_per_sec"]:>10.0f} frames/s')
+    print(f'{"total":<40}{summary["accuracy"]:>8.1%}{summary["false_presses"]:>6} false'
+          f'{summary["mean_latency_ms"] or float("nan"):>10.0f} ms{summary["frames_per_sec"]:>10.0f} frames/s')
+    print(f'Wrote {args.output}')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -1,21 +1,36 @@
-import pylab
 import numpy as np
-from scipy.signal import butter, lfilter, fftconvolve
+from numpy.lib.stride_tricks import as_strided
 
 from parabolic import parabolic
 from note_utils import number_to_freq
 from config import (
     SAMPLE_RATE,
     FRAMES_PER_FFT,
-    SAMPLES_PER_FRAME
+    SAMPLES_PER_FRAME,
+    DECIMATION_FACTOR,
 )
 
 # Derived quantities from configuration constants. Note that as
 # SAMPLES_PER_FFT goes up, the frequency step size decreases (sof
 # resolution increases); however, it will incur more delay to process
 # new sounds.
-SAMPLES_PER_FFT = SAMPLES_PER_FRAME * FRAMES_PER_FFT
-FREQ_STEP = float(SAMPLE_RATE) / SAMPLES_PER_FFT
+# Analysis runs on decimated audio, so these are all in terms of the
+# reduced rate. The FFT still spans the same stretch of time.
+ANALYSIS_RATE = float(SAMPLE_RATE) / DECIMATION_FACTOR
+ANALYSIS_SAMPLES_PER_FRAME = SAMPLES_PER_FRAME // DECIMATION_FACTOR
+SAMPLES_PER_FFT = ANALYSIS_SAMPLES_PER_FRAME * FRAMES_PER_FFT
+FREQ_STEP = ANALYSIS_RATE / SAMPLES_PER_FFT
+
+# scipy.signal takes over a second to import, and pylab longer still, so they're only imported by the functions which
+# need them. The default pipeline (no band-pass filter, decimation or 'autocorr' estimator) never does
+
+def strided_windows(signal: np.ndarray, window_size: int, step: int = 1, start: int = 0) -> np.ndarray:
+    """Read-only view of every `step`th `window_size`-sample window of a 1-d signal, the first starting at `start`
+    numpy's sliding_window_view() does this too, but only from numpy 1.20.
+    """
+    count = max(0, (len(signal) - window_size - start) // step + 1)
+    stride = signal.strides[0]
+    return as_strided(signal[start:], shape=(count, window_size), strides=(stride * step, stride), writeable=False)
 
 
 def find(condition):
@@ -28,8 +43,17 @@ def freq_from_autocorr(sig, fs):
     """Estimate fundamental frequency using autocorrelation
     From: https://gist.github.com/endolith/255291
     """
+    px, py, energy = autocorr_peak(sig)
+    return fs / px
+
+
+def autocorr_peak(sig):
+    """Find the autocorrelation peak freq_from_autocorr() takes as the period
+    Returns its interpolated lag and height, and the height of the zero-lag peak (the signal's energy).
+    """
     # Calculate autocorrelation (same thing as convolution, but with
     # one input reversed in time), and throw away the negative lags
+    from scipy.signal import fftconvolve
     corr = fftconvolve(sig, sig[::-1], mode='full')
     corr = corr[len(corr)//2:]
 
@@ -44,28 +68,166 @@ def freq_from_autocorr(sig, fs):
     peak = np.argmax(corr[start:]) + start
     px, py = parabolic(corr, peak)
 
-    return fs / px
+    return px, py, corr[0]
 
 
 def plot(data: np.array, title='') -> None:
+    import pylab
     pylab.plot(np.linspace(0, 1, len(data)), data)
     pylab.title(title)
     pylab.show()
 
 
-def butter_bandpass(lowcut, highcut, fs, order=5):
+def butter_bandpass(lowcut, highcut, fs, order=5, output='ba'):
+    from scipy.signal import butter
     nyq = 0.5 * fs
     low = lowcut / nyq
     high = highcut / nyq
-    b, a = butter(order, [low, high], btype='band')
-    return b, a
+    return butter(order, [low, high], btype='band', output=output)
 
 
 def butter_bandpass_filter(data, lowcut, highcut, fs, order=5):
+    from scipy.signal import lfilter
     b, a = butter_bandpass(lowcut, highcut, fs, order=order)
     y = lfilter(b, a, data)
     return y
 
 
-def note_to_fftbin(n):
-    return number_to_freq(n) / FREQ_STEP
+class BandpassFilter:
+    """Streaming Butterworth band-pass filter
+
+    The filter is designed once, as second-order sections, and its state is carried from one frame to the next so
+    there are no transients at frame boundaries.
+    """
+    def __init__(self, lowcut: float, highcut: float, fs: float, order: int = 5) -> None:
+        self.sos = butter_bandpass(lowcut, highcut, fs, order=order, output='sos').astype(np.float32)
+        self.zi = np.zeros((self.sos.shape[0], 2), dtype=np.float32)
+        # Looked up once here, rather than imported on every frame
+        from scipy.signal import sosfilt
+        self.sosfilt = sosfilt
+
+    def reset(self, initial_value: float = 0.0) -> None:
+        """Forget the filter's history, as if it had been seeing `initial_value` forever
+        """
+        from scipy.signal import sosfilt_zi
+        self.zi[:] = sosfilt_zi(self.sos) * initial_value
+
+    def filter_in_place(self, frame: np.ndarray) -> None:
+        frame[:], self.zi[:] = self.sosfilt(self.sos, frame, zi=self.zi)
+
+
+def note_to_fftbin(n, freq_step=FREQ_STEP):
+    return number_to_freq(n) / freq_step
+
+
+class Decimator:
+    """Anti-aliased decimation by an integer factor, carrying filter state across frames
+
+    Only every `factor`th output of the low-pass FIR is computed, which is equivalent to running a polyphase
+    decimator. Frames don't need to be a multiple of `factor` long.
+    """
+    def __init__(self, factor: int, taps_per_phase: int = 16) -> None:
+        from scipy.signal import firwin
+        self.factor = factor
+        # Cut off a little below the new Nyquist frequency, leaving room for the transition band
+        taps = firwin(factor * taps_per_phase, 0.8 / factor).astype(np.float32)
+        self.reversed_taps = taps[::-1].copy()
+        self.history = np.zeros(len(taps) - 1, dtype=np.float32)
+        # Offset of the next output sample within the next frame
+        self.phase = 0
+
+    def process(self, frame: np.ndarray) -> np.ndarray:
+        buf = np.concatenate((self.history, frame.astype(np.float32, copy=False)))
+        windows = strided_windows(buf, len(self.reversed_taps), self.factor, self.phase)
+        out = windows @ self.reversed_taps
+        self.history = buf[len(buf) - len(self.history):]
+        self.phase = (self.phase - len(frame)) % self.factor
+        return out
+
+
+class NoiseGate:
+    """Silence gate which adapts to the noise floor, with hysteresis
+
+    Levels are on the same scale as MIN_VOLUME. The floor follows the level down straight away, but only rises by
+    `floor_rise` dB a second, so steadier noise (a louder room, the amp turned up) soon becomes the new floor. While the
+    gate is open, a run of notes played without a break would carry the floor up with them, so it only rises a tenth as
+    fast, unless the pitch estimator found no clear pitch (less than `pitched_confidence`) in what the gate let through,
+    in which case it was noise after all.
+
+    The gate opens once the level reaches `open_ratio` times the floor, or `min_level` if that's higher, and closes
+    once it falls below `close_ratio` times that threshold, so notes hovering around it don't make the gate flutter.
+    """
+    def __init__(self,
+                 frame_rate: float,
+                 min_level: float,
+                 open_ratio: float = 4.0,
+                 close_ratio: float = 0.5,
+                 floor_rise: float = 3.0,
+                 pitched_confidence: float = 0.5) -> None:
+        self.min_level = min_level
+        self.open_ratio = open_ratio
+        self.close_ratio = close_ratio
+        self.pitched_confidence = pitched_confidence
+        # Levels are amplitudes, so a rise of `floor_rise` dB a second is this factor per frame
+        self.rise_per_frame = 10 ** (floor_rise / 20 / frame_rate)
+        self.open_rise_per_frame = 10 ** (floor_rise / 200 / frame_rate)
+        # A floor any lower than this leaves the threshold at min_level anyway. It also keeps the floor above zero,
+        # so it can still rise after digital silence
+        self.min_floor = max(1.0, min_level / open_ratio)
+        self.floor = self.min_floor
+        self.is_open = False
+
+    def update(self, level: float, confidence: float = 1.0) -> bool:
+        """Feed in the level of the next frame, returning whether the gate is open
+        `confidence` is how sure the pitch estimator was of the previous frame, if the gate let it through.
+        """
+        noise = not self.is_open or confidence < self.pitched_confidence
+        rise = self.rise_per_frame if noise else self.open_rise_per_frame
+        self.floor = max(self.min_floor, min(level, self.floor * rise))
+        threshold = max(self.min_level, self.floor * self.open_ratio)
+        if self.is_open:
+            self.is_open = level >= threshold * self.close_ratio
+        else:
+            self.is_open = level >= threshold
+        return self.is_open
+
+
+class OnsetDetector:
+    """Spots the attack of a new note, even one at the same pitch as the note already ringing
+
+    Each frame is split into blocks, and the energy of each block's first difference (which emphasizes the broadband
+    transient of a pick or pluck over the steady tone) is compared against a decaying envelope of the blocks before
+    it. A block with `threshold` times the envelope's energy is an onset. A string takes a little while to settle
+    after an attack, so onsets within `refractory` seconds of the last one are ignored.
+    """
+    def __init__(self,
+                 sample_rate: float,
+                 block_size: int,
+                 threshold: float = 2.0,
+                 decay_time: float = 0.05,
+                 refractory: float = 0.1) -> None:
+        self.block_size = block_size
+        self.threshold = threshold
+        # How much of the envelope is left after each block
+        self.decay = float(np.exp(-block_size / (decay_time * sample_rate)))
+        self.refractory_blocks = int(np.ceil(refractory * sample_rate / block_size))
+        self.envelope = 0.0
+        self.blocks_since_onset = self.refractory_blocks
+        self.last_sample = 0.0
+
+    def process(self, frame: np.ndarray) -> bool:
+        """Look for an onset in the next frame of audio
+        """
+        samples = frame.astype(np.float64)
+        diff = np.diff(samples, prepend=self.last_sample)
+        self.last_sample = samples[-1]
+        blocks = diff[:len(diff) // self.block_size * self.block_size].reshape(-1, self.block_size)
+
+        onset = False
+        for energy in np.einsum('ij,ij->i', blocks, blocks).tolist():
+            self.blocks_since_onset += 1
+            if energy > self.threshold * self.envelope and self.blocks_since_onset > self.refractory_blocks:
+                onset = True
+                self.blocks_since_onset = 0
+            self.envelope = max(energy, self.envelope * self.decay)
+        return onset
@@ -1,17 +1,23 @@
+import time
 import wave
 from abc import ABC, abstractmethod
 
-import pyaudio
 import numpy as np
 
+from dsp import Decimator
+from frame_queue import FrameQueue
+
 
 class FrameProvider(ABC):
     """Protocol to read an audio buffer
-    Implementations can be backed by mic input, a sound file, etc.
+    Implementations can be backed by mic input, a sound file, etc. PyAudio is only imported by the microphone
+    providers, so sound files can be read on machines without it.
     """
     def __init__(self, sample_rate=0, samples_per_frame=0):
         self.sample_rate = sample_rate
         self.samples_per_frame = samples_per_frame
+        # time.monotonic() when the frame most recently handed out by get_frame() finished arriving
+        self.last_capture_time = 0.0
 
     @abstractmethod
     def has_frames(self) -> bool:
@@ -25,10 +31,19 @@ class FrameProvider(ABC):
         """
         pass
 
+    def read_into(self, ring_buffer, transform=None) -> int:
+        """Write the next frame of audio data straight into a ring buffer, returning the number of samples written
+        `transform` is handed on to the ring buffer, to run in place over the frame once it's in the buffer.
+        """
+        frame = self.get_frame()
+        ring_buffer.write(frame, transform)
+        return len(frame)
+
 
 class MicrophoneFrameProvider(FrameProvider):
     def __init__(self, sample_rate: int, samples_per_frame: int) -> None:
         super(MicrophoneFrameProvider, self).__init__(sample_rate, samples_per_frame)
+        import pyaudio
 
         self.stream = pyaudio.PyAudio().open(
             format=pyaudio.paInt16,
@@ -43,7 +58,92 @@ class MicrophoneFrameProvider(FrameProvider):
         return self.stream.is_active()
 
     def get_frame(self) -> np.array:
-        return np.fromstring(self.stream.read(self.samples_per_frame, exception_on_overflow=False), np.int16)
+        data = self.stream.read(self.samples_per_frame, exception_on_overflow=False)
+        self.last_capture_time = time.monotonic()
+        # frombuffer wraps the bytes we got from PyAudio without copying them
+        return np.frombuffer(data, np.int16)
+
+
+class CallbackMicrophoneFrameProvider(FrameProvider):
+    """Microphone input captured by PyAudio's callback thread rather than blocking reads
+
+    The callback only timestamps each buffer and appends it to a bounded queue, so a slow consumer can never stall
+    capture. Instead, frames which overflow the queue are dropped, and frames that sat in the queue for longer than
+    `late_after` frame durations are counted as late.
+    """
+    def __init__(self, sample_rate: int, samples_per_frame: int, queue_frames: int = 32, late_after: float = 2.0):
+        super(CallbackMicrophoneFrameProvider, self).__init__(sample_rate, samples_per_frame)
+        import pyaudio
+
+        self.frames = FrameQueue(queue_frames)
+        self.late_threshold = late_after * samples_per_frame / sample_rate
+        self.late_frames = 0
+        self.input_overflows = 0
+        self._overflow = pyaudio.paInputOverflow
+        self._continue = pyaudio.paContinue
+
+        self.stream = pyaudio.PyAudio().open(
+            format=pyaudio.paInt16,
+            channels=1,
+            rate=sample_rate,
+            input=True,
+            frames_per_buffer=samples_per_frame,
+            stream_callback=self._on_audio)
+
+        self.stream.start_stream()
+
+    def _on_audio(self, in_data, frame_count, time_info, status_flags):
+        if status_flags & self._overflow:
+            self.input_overflows += 1
+        self.frames.put((time.monotonic(), in_data))
+        return None, self._continue
+
+    @property
+    def dropped_frames(self) -> int:
+        return self.frames.dropped
+
+    def has_frames(self) -> bool:
+        return self.stream.is_active() or len(self.frames) > 0
+
+    def get_frame(self) -> np.array:
+        self.last_capture_time, data = self.frames.get()
+        if time.monotonic() - self.last_capture_time > self.late_threshold:
+            self.late_frames += 1
+        return np.frombuffer(data, np.int16)
+
+
+def deinterleave(data: bytes, channels: int) -> np.ndarray:
+    """View interleaved int16 audio as a (channels, samples) array, without copying it
+    """
+    return np.frombuffer(data, np.int16).reshape(-1, channels).T
+
+
+class MultiChannelMicrophoneFrameProvider(FrameProvider):
+    """Input from every channel of an audio interface, read as one stream
+    Frames are (channels, samples) arrays.
+    """
+    def __init__(self, sample_rate: int, samples_per_frame: int, channels: int) -> None:
+        super(MultiChannelMicrophoneFrameProvider, self).__init__(sample_rate, samples_per_frame)
+        import pyaudio
+
+        self.channels = channels
+
+        self.stream = pyaudio.PyAudio().open(
+            format=pyaudio.paInt16,
+            channels=channels,
+            rate=sample_rate,
+            input=True,
+            frames_per_buffer=samples_per_frame)
+
+        self.stream.start_stream()
+
+    def has_frames(self) -> bool:
+        return self.stream.is_active()
+
+    def get_frame(self) -> np.array:
+        data = self.stream.read(self.samples_per_frame, exception_on_overflow=False)
+        self.last_capture_time = time.monotonic()
+        return deinterleave(data, self.channels)
 
 
 class WavFileFrameProvider(FrameProvider):
@@ -53,7 +153,55 @@ class WavFileFrameProvider(FrameProvider):
         super(WavFileFrameProvider, self).__init__(self.wav.getframerate(), samples_per_frame)
 
     def has_frames(self) -> bool:
-        return True
+        return self.wav.tell() < self.wav.getnframes()
+
+    def get_frame(self) -> np.array:
+        self.last_capture_time = time.monotonic()
+        return np.frombuffer(self.wav.readframes(self.samples_per_frame), np.int16)
+
+
+class ArrayFrameProvider(FrameProvider):
+    """Frames sliced out of audio already in memory, as fast as they're asked for
+    """
+    def __init__(self, samples: np.ndarray, sample_rate: int, samples_per_frame: int) -> None:
+        super(ArrayFrameProvider, self).__init__(sample_rate, samples_per_frame)
+        self.samples = samples
+        self.position = 0
+
+    def has_frames(self) -> bool:
+        return self.position < len(self.samples)
+
+    def get_frame(self) -> np.array:
+        self.last_capture_time = time.monotonic()
+        frame = self.samples[self.position:self.position + self.samples_per_frame]
+        self.position += self.samples_per_frame
+        return frame
+
+
+class DecimatingFrameProvider(FrameProvider):
+    """Wraps another frame provider, handing out its frames at 1/`factor` of the sample rate
+    """
+    def __init__(self, source: FrameProvider, factor: int) -> None:
+        super(DecimatingFrameProvider, self).__init__(source.sample_rate / factor, source.samples_per_frame // factor)
+        self.source = source
+        self.decimator = Decimator(factor)
+
+    def has_frames(self) -> bool:
+        return self.source.has_frames()
+
+    def get_frame(self) -> np.array:
+        frame = self.source.get_frame()
+        self.last_capture_time = self.source.last_capture_time
+        return self.decimator.process(frame)
+
+
+class MultiChannelWavFileFrameProvider(WavFileFrameProvider):
+    """Every channel of a WAV file, as (channels, samples) frames
+    """
+    def __init__(self, filename, samples_per_frame: int):
+        super(MultiChannelWavFileFrameProvider, self).__init__(filename, samples_per_frame)
+        self.channels = self.wav.getnchannels()
 
     def get_frame(self) -> np.array:
-        return np.fromstring(self.wav.readframes(self.samples_per_frame), np.int16)
+        self.last_capture_time = time.monotonic()
+        return deinterleave(self.wav.readframes(self.samples_per_frame), self.channels)
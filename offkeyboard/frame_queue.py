@@ -0,0 +1,41 @@
+import collections
+import queue
+import threading
+from typing import Any, Optional
+
+
+class FrameQueue:
+    """Bounded single-producer/single-consumer queue which never blocks the producer
+
+    Appending to and popping from a deque are atomic, so the producer (typically an audio callback) never takes a
+    lock. When the queue is full the oldest item is thrown away to make room, and counted in `dropped`.
+    """
+    def __init__(self, maxlen: int) -> None:
+        self._items = collections.deque(maxlen=maxlen)
+        self._ready = threading.Event()
+        self.dropped = 0
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def put(self, item: Any) -> None:
+        if len(self._items) == self._items.maxlen:
+            self.dropped += 1
+        self._items.append(item)
+        self._ready.set()
+
+    def get(self, timeout: Optional[float] = None) -> Any:
+        """Pop the oldest item, waiting up to `timeout` seconds for one to arrive
+        Raises queue.Empty if nothing arrived in time.
+        """
+        while True:
+            try:
+                return self._items.popleft()
+            except IndexError:
+                pass
+            self._ready.clear()
+            # An item may have arrived between the failed pop and clearing the event
+            if self._items:
+                continue
+            if not self._ready.wait(timeout):
+                raise queue.Empty
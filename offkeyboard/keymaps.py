@@ -1,4 +1,5 @@
-from typing import List, Optional, Union
+from collections import namedtuple
+from typing import Dict, FrozenSet, List, Optional, Tuple, Union
 
 from config import (
     ESC_NOTE,
@@ -10,6 +11,7 @@ from config import (
     STRAFE_DOWN_NOTE,
     STRAFE_RIGHT_NOTE,
     COMBO_KEYS_TO_NOTES,
+    CHORD_KEYS_TO_NOTES,
 
     PICK_BLOCK_NOTE,
     PLACE_BLOCK_NOTE,
@@ -32,7 +34,8 @@ from config import (
     ZERO_NOTE
 )
 
-from mouse import MOUSE_UP_KEY, MOUSE_DOWN_KEY, MOUSE_LEFT_KEY, MOUSE_RIGHT_KEY, MOUSE_CLICK_KEY
+from mouse import MOUSE_KEYS
+from note_utils import NOTE_NUMBERS, format_note
 
 
 class Keymap:
@@ -54,6 +57,11 @@ class Keymap:
             return any(x in self.held_keys for x in key_or_key_list)
         return key_or_key_list in self.held_keys
 
+    def keys_for_chords(self) -> Dict[Tuple[str, ...], Union[str, List]]:
+        """Chords (tuples of note names) and the key or keys each one presses
+        """
+        return {}
+
 
 class Keymap1(Keymap):
     def __init__(self):
@@ -104,6 +112,38 @@ class Keymap2(Keymap):
 
 
 class MinecraftMap(Keymap):
+    CONFIG_KEYS = {
+        ESC_NOTE: 'esc',
+        JUMP_NOTE: ' ',
+        CRAFT_NOTE: 'e',
+        ATTACK_NOTE: 'p',
+
+        PICK_BLOCK_NOTE: 'z',
+        PLACE_BLOCK_NOTE: 'i',
+
+        STRAFE_LEFT_NOTE: 'left',
+        STRAFE_RIGHT_NOTE: 'right',
+        STRAFE_UP_NOTE: 'up',
+        STRAFE_DOWN_NOTE: 'down',
+
+        # MOUSE_LEFT_NOTE: MOUSE_LEFT_KEY,
+        # MOUSE_RIGHT_NOTE: MOUSE_RIGHT_KEY,
+        # MOUSE_UP_NOTE: MOUSE_UP_KEY,
+        # MOUSE_DOWN_NOTE: MOUSE_DOWN_KEY,
+        # MOUSE_CLICK_NOTE: MOUSE_CLICK_KEY,
+
+        ONE_NOTE: 'a',
+        TWO_NOTE: '2',
+        THREE_NOTE: '3',
+        FOUR_NOTE: '4',
+        FIVE_NOTE: '5',
+        SIX_NOTE: '6',
+        SEVEN_NOTE: '7',
+        EIGHT_NOTE: '8',
+        NINE_NOTE: '9',
+        ZERO_NOTE: '0'
+    }
+
     def __init__(self):
         # When playing Minecraft, we want to hold down the movement keys instead of quickly pressing them.
         held_keys = [' ', 'left', 'down', 'up', 'right', MinecraftMap.key_for_note(ATTACK_NOTE)]
@@ -111,43 +151,30 @@ class MinecraftMap(Keymap):
 
     @classmethod
     def key_for_note(cls, note: str) -> Optional[str]:
-        config_keys = {
-            ESC_NOTE: 'esc',
-            JUMP_NOTE: ' ',
-            CRAFT_NOTE: 'e',
-            ATTACK_NOTE: 'p',
-
-            PICK_BLOCK_NOTE: 'z',
-            PLACE_BLOCK_NOTE: 'i',
-
-            STRAFE_LEFT_NOTE: 'left',
-            STRAFE_RIGHT_NOTE: 'right',
-            STRAFE_UP_NOTE: 'up',
-            STRAFE_DOWN_NOTE: 'down',
-
-            # MOUSE_LEFT_NOTE: MOUSE_LEFT_KEY,
-            # MOUSE_RIGHT_NOTE: MOUSE_RIGHT_KEY,
-            # MOUSE_UP_NOTE: MOUSE_UP_KEY,
-            # MOUSE_DOWN_NOTE: MOUSE_DOWN_KEY,
-            # MOUSE_CLICK_NOTE: MOUSE_CLICK_KEY,
-
-            ONE_NOTE: 'a',
-            TWO_NOTE: '2',
-            THREE_NOTE: '3',
-            FOUR_NOTE: '4',
-            FIVE_NOTE: '5',
-            SIX_NOTE: '6',
-            SEVEN_NOTE: '7',
-            EIGHT_NOTE: '8',
-            NINE_NOTE: '9',
-            ZERO_NOTE: '0'
-        }
-        if note in config_keys:
-            return config_keys[note]
-        return None
+        return cls.CONFIG_KEYS.get(note)
 
 
 class MarioMap(Keymap):
+    CONFIG_KEYS = {
+        ESC_NOTE: 'esc',
+
+        STRAFE_LEFT_NOTE: 'left',
+        STRAFE_RIGHT_NOTE: 'right',
+        STRAFE_UP_NOTE: 'up',
+        STRAFE_DOWN_NOTE: 'down',
+
+        ONE_NOTE: 'a',
+        TWO_NOTE: '2',
+        THREE_NOTE: '3',
+        FOUR_NOTE: '4',
+        FIVE_NOTE: '5',
+        SIX_NOTE: '6',
+        SEVEN_NOTE: '7',
+        EIGHT_NOTE: '8',
+        NINE_NOTE: '9',
+        ZERO_NOTE: '0'
+    }
+
     def __init__(self):
         # When playing Mario, we want to hold down the movement keys instead of quickly pressing them.
         held_keys = [' ', 'left', 'down', 'up', 'right', MinecraftMap.key_for_note(ATTACK_NOTE)]
@@ -155,27 +182,87 @@ class MarioMap(Keymap):
 
     @classmethod
     def key_for_note(cls, note: str) -> Optional[Union[str, List]]:
-        config_keys = {
-            ESC_NOTE: 'esc',
-
-            STRAFE_LEFT_NOTE: 'left',
-            STRAFE_RIGHT_NOTE: 'right',
-            STRAFE_UP_NOTE: 'up',
-            STRAFE_DOWN_NOTE: 'down',
-
-            ONE_NOTE: 'a',
-            TWO_NOTE: '2',
-            THREE_NOTE: '3',
-            FOUR_NOTE: '4',
-            FIVE_NOTE: '5',
-            SIX_NOTE: '6',
-            SEVEN_NOTE: '7',
-            EIGHT_NOTE: '8',
-            NINE_NOTE: '9',
-            ZERO_NOTE: '0'
-        }
-        if note in config_keys:
-            return config_keys[note]
+        if note in cls.CONFIG_KEYS:
+            return cls.CONFIG_KEYS[note]
         if note in COMBO_KEYS_TO_NOTES:
             return COMBO_KEYS_TO_NOTES[note]
         return None
+
+    def keys_for_chords(self) -> Dict[Tuple[str, ...], Union[str, List]]:
+        return CHORD_KEYS_TO_NOTES
+
+
+# What to do when a note is played, with everything resolved up front:
+# `key` is the key (or '+'-joined key combo) to send, `hold` says whether to hold it for as long as the note rings
+# rather than tapping it, and `mouse` marks the virtual mouse keys.
+KeyAction = namedtuple('KeyAction', ['key', 'combo', 'hold', 'mouse'])
+
+
+class CompiledKeymap:
+    """Immutable note -> KeyAction lookup table, built once from a Keymap
+
+    Actions can be looked up by MIDI note number (a single tuple index) or by note name (a single dict lookup).
+    Unmapped notes, and silence, have no action.
+
+    Each chord is given a number of its own, counting up from 128, so that it can be handled just like a note once
+    chord_number() has picked it out of a set of notes.
+    """
+    def __init__(self,
+                 by_number: Tuple[Optional[KeyAction], ...],
+                 by_name: Dict[str, KeyAction],
+                 chords: Tuple[Tuple[FrozenSet[int], int], ...] = ()) -> None:
+        self.by_number = by_number
+        self.by_name = by_name
+        # (notes, chord number) pairs, biggest chords first
+        self.chords = chords
+        self.chord_names = {number: '+'.join(format_note(n) for n in sorted(notes)) for notes, number in chords}
+
+    def chord_number(self, notes: Tuple[int, ...]) -> Optional[int]:
+        """The number of the biggest chord whose notes were all heard, if any
+        """
+        heard = frozenset(notes)
+        for chord_notes, number in self.chords:
+            if chord_notes <= heard:
+                return number
+        return None
+
+    def name_for_number(self, n: int) -> str:
+        """Human-readable name of a note or chord number, for logging
+        """
+        return self.chord_names.get(n) or format_note(n)
+
+    def action_for_number(self, n: int) -> Optional[KeyAction]:
+        if 0 <= n < len(self.by_number):
+            return self.by_number[n]
+        return None
+
+    def action_for_note(self, note: str) -> Optional[KeyAction]:
+        return self.by_name.get(note)
+
+
+def _key_action(keymap: Keymap, key_or_key_list: Union[str, List]) -> KeyAction:
+    combo = isinstance(key_or_key_list, list)
+    key = "+".join(key_or_key_list) if combo else key_or_key_list
+    return KeyAction(key=key,
+                     combo=combo,
+                     hold=bool(keymap.should_hold_key(key_or_key_list)),
+                     mouse=not combo and key in MOUSE_KEYS)
+
+
+def compile_keymap(keymap: Keymap) -> CompiledKeymap:
+    by_number: List[Optional[KeyAction]] = [None] * 128
+    by_name = {}
+    for name, n in NOTE_NUMBERS.items():
+        key_or_key_list = keymap.key_for_note(name)
+        if key_or_key_list is None:
+            continue
+        action = _key_action(keymap, key_or_key_list)
+        by_number[n] = action
+        by_name[name] = action
+
+    chords = []
+    for chord, key_or_key_list in keymap.keys_for_chords().items():
+        chords.append((frozenset(NOTE_NUMBERS[name] for name in chord), len(by_number)))
+        by_number.append(_key_action(keymap, key_or_key_list))
+    chords.sort(key=lambda chord: len(chord[0]), reverse=True)
+    return CompiledKeymap(tuple(by_number), by_name, tuple(chords))
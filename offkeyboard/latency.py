@@ -0,0 +1,171 @@
+"""Per-stage latency instrumentation
+
+Each frame is timed through every stage between the microphone and the OS input call:
+
+    buffering   the frame finished arriving -> the DSP loop picked it up (queueing, reading, decimation)
+    estimate    pitch estimation
+    reader      the NoteReader deciding what to do with the note
+    output      the NoteReader emitting a key/mouse event -> the OS call returning (including any output queue)
+    end_to_end  the frame finished arriving -> the OS call returning, for frames which led to an event
+
+Timings go into log-linear histograms, which hold latencies from 1us to over an hour to within about 3%, in a fixed
+few KB and with O(1) recording. AudioProcessor only creates a LatencyStats when LATENCY_STATS is set, and otherwise
+skips the instrumentation with a single check per stage.
+"""
+import json
+import time
+from typing import Callable, Dict, List, Optional
+
+from output import OutputBackend
+
+
+STAGES = ('buffering', 'estimate', 'reader', 'output', 'end_to_end')
+
+
+class LatencyHistogram:
+    """Histogram of latencies in whole microseconds, bucketed in the style of HdrHistogram
+
+    Values below 2**sub_bucket_bits get a bucket each. Above that, every power of two is split into 2**sub_bucket_bits
+    equal buckets, so a value's bucket is always within 1/2**sub_bucket_bits of it.
+    """
+    def __init__(self, sub_bucket_bits: int = 5, max_exponent: int = 40) -> None:
+        self.sub_bucket_bits = sub_bucket_bits
+        self.sub_bucket_count = 1 << sub_bucket_bits
+        self.counts = [0] * ((max_exponent + 1) << sub_bucket_bits)
+        self.total_count = 0
+        self.total_us = 0
+        self.max_us = 0
+
+    def bucket_index(self, value_us: int) -> int:
+        if value_us < self.sub_bucket_count:
+            return max(0, value_us)
+        shift = value_us.bit_length() - self.sub_bucket_bits - 1
+        index = ((shift + 1) << self.sub_bucket_bits) + (value_us >> shift) - self.sub_bucket_count
+        return min(index, len(self.counts) - 1)
+
+    def bucket_value(self, index: int) -> float:
+        """The value in the middle of a bucket
+        """
+        if index < self.sub_bucket_count:
+            return float(index)
+        shift = (index >> self.sub_bucket_bits) - 1
+        low = ((index & (self.sub_bucket_count - 1)) + self.sub_bucket_count) << shift
+        return low + ((1 << shift) - 1) / 2
+
+    def record(self, seconds: float) -> None:
+        value_us = int(seconds * 1e6)
+        self.counts[self.bucket_index(value_us)] += 1
+        self.total_count += 1
+        self.total_us += value_us
+        if value_us > self.max_us:
+            self.max_us = value_us
+
+    def percentile(self, percent: float) -> float:
+        """The latency, in microseconds, which `percent`% of the recorded latencies are at or below
+        """
+        if not self.total_count:
+            return 0.0
+        target = max(1, percent / 100 * self.total_count)
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(self.bucket_value(index), float(self.max_us))
+        return float(self.max_us)
+
+    @property
+    def mean(self) -> float:
+        return self.total_us / self.total_count if self.total_count else 0.0
+
+    def to_dict(self) -> Dict:
+        return {
+            'count': self.total_count,
+            'mean_us': self.mean,
+            'max_us': self.max_us,
+            'percentiles_us': {str(p): self.percentile(p) for p in (50, 90, 99, 99.9)},
+            # Only the buckets with anything in them, as [bucket value, count] pairs
+            'buckets': [[self.bucket_value(i), count] for i, count in enumerate(self.counts) if count],
+        }
+
+
+class LatencyStats:
+    """Times frames through the pipeline stages, and reports on them
+
+    The DSP loop calls start_frame() as it picks each frame up, and lap() after each stage. Events are timed by
+    wrapping the NoteReader's output backend with wrap_output(), which works whether events are sent inline or from a
+    worker thread.
+    """
+    def __init__(self, report_interval: float = 10.0) -> None:
+        self.histograms: Dict[str, LatencyHistogram] = {stage: LatencyHistogram() for stage in STAGES}
+        self.report_interval = report_interval
+        self.last_report = time.monotonic()
+        # When the frame being processed finished arriving, and when its last stage finished
+        self.frame_captured = 0.0
+        self.lap_start = 0.0
+
+    def start_frame(self, capture_time: Optional[float] = None) -> None:
+        now = time.monotonic()
+        self.frame_captured = capture_time or now
+        self.histograms['buffering'].record(now - self.frame_captured)
+        self.lap_start = now
+
+    def lap(self, stage: str) -> None:
+        now = time.monotonic()
+        self.histograms[stage].record(now - self.lap_start)
+        self.lap_start = now
+
+    def wrap_output(self, output: OutputBackend) -> OutputBackend:
+        """Wrap a NoteReader's output backend so the events sent through it are timed. Log lines aren't timed
+        """
+        return TimedBackend(self, output)
+
+    def record_output(self, captured: float, emitted: float) -> None:
+        """Record an event emitted at `emitted` for the frame captured at `captured`, which has just been sent
+        """
+        now = time.monotonic()
+        self.histograms['output'].record(now - emitted)
+        self.histograms['end_to_end'].record(now - captured)
+
+    def summary_line(self) -> str:
+        stages: List[str] = []
+        for stage, histogram in self.histograms.items():
+            if histogram.total_count:
+                stages.append(f'{stage} {histogram.percentile(50) / 1000:.1f}/{histogram.percentile(99) / 1000:.1f}/'
+                              f'{histogram.max_us / 1000:.1f}')
+        return 'latency ms p50/p99/max\t' + '\t'.join(stages)
+
+    def maybe_report(self, output: OutputBackend) -> None:
+        """Log a summary line if report_interval has passed since the last one
+        """
+        now = time.monotonic()
+        if now - self.last_report >= self.report_interval:
+            self.last_report = now
+            output.log(self.summary_line())
+
+    def dump(self, filename: str) -> None:
+        """Write every stage's histogram to a JSON file
+        """
+        with open(filename, 'w') as f:
+            json.dump({stage: histogram.to_dict() for stage, histogram in self.histograms.items()}, f, indent=2)
+
+
+class TimedBackend(OutputBackend):
+    """Passes events on to another backend, timing how long each takes to be sent
+    """
+    def __init__(self, stats: LatencyStats, backend: OutputBackend) -> None:
+        self.stats = stats
+        self.backend = backend
+
+    def emit(self, kind: str, key: str = '') -> None:
+        captured, emitted = self.stats.frame_captured, time.monotonic()
+        self.backend.emit(kind, key)
+        self.backend.when_sent(self.stats.record_output, captured, emitted)
+
+    def log(self, message: str) -> None:
+        self.backend.log(message)
+
+    def when_sent(self, func: Callable, *args) -> None:
+        self.backend.when_sent(func, *args)
+
+    def close(self) -> None:
+        self.backend.close()
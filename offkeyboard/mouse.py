@@ -1,14 +1,8 @@
-import foohid
-from config import MOUSE_SPEED
+import threading
+import time
+from typing import Callable, Optional
 
-from Quartz.CoreGraphics import CGEventCreateMouseEvent
-from Quartz.CoreGraphics import CGEventPost
-from Quartz.CoreGraphics import kCGEventMouseMoved
-from Quartz.CoreGraphics import kCGEventLeftMouseDown
-from Quartz.CoreGraphics import kCGEventLeftMouseDown
-from Quartz.CoreGraphics import kCGEventLeftMouseUp
-from Quartz.CoreGraphics import kCGMouseButtonLeft
-from Quartz.CoreGraphics import kCGHIDEventTap
+from config import MOUSE_MOTION_RATE, MOUSE_MIN_SPEED, MOUSE_MAX_SPEED, MOUSE_ACCEL_TIME, MOUSE_ACCEL_EXPONENT
 
 
 MOUSE_UP_KEY = 'mouse_up_key'
@@ -20,10 +14,22 @@ MOUSE_KEYS = [MOUSE_UP_KEY, MOUSE_DOWN_KEY, MOUSE_LEFT_KEY, MOUSE_RIGHT_KEY, MOU
 
 
 class VirtualMouse:
-    _CALLBACK = None
+    """Sends mouse events to the OS
+    Quartz and foohid are only imported once an event is actually sent, so the mouse keys can be mapped (and the
+    pipeline run headless) on machines without them.
+    """
 
     @staticmethod
     def left_click():
+        from Quartz.CoreGraphics import (
+            CGEventCreateMouseEvent,
+            CGEventPost,
+            kCGEventLeftMouseDown,
+            kCGEventLeftMouseUp,
+            kCGMouseButtonLeft,
+            kCGHIDEventTap,
+        )
+
         def mouse_event(type, posx, posy):
             event = CGEventCreateMouseEvent(None, type, (posx, posy), kCGMouseButtonLeft)
             CGEventPost(kCGHIDEventTap, event)
@@ -35,42 +41,126 @@ class VirtualMouse:
         mouse_click(500, 500)
 
     @staticmethod
-    def _move_down():
-        foohid.move_mouse(0, 1 * MOUSE_SPEED)
-
-    @staticmethod
-    def _move_up():
-        foohid.move_mouse(0, -1 * MOUSE_SPEED)
-
-    @staticmethod
-    def _move_left():
-        foohid.move_mouse(-1 * MOUSE_SPEED, 0)
-
-    @staticmethod
-    def _move_right():
-        foohid.move_mouse(1 * MOUSE_SPEED, 0)
-
-    @classmethod
-    def hold_down(cls):
-        cls._CALLBACK = VirtualMouse._move_down
-
-    @classmethod
-    def hold_up(cls):
-        cls._CALLBACK = VirtualMouse._move_up
-
-    @classmethod
-    def hold_left(cls):
-        cls._CALLBACK = VirtualMouse._move_left
-
-    @classmethod
-    def hold_right(cls):
-        cls._CALLBACK = VirtualMouse._move_right
-
-    @classmethod
-    def clear(cls):
-        cls._CALLBACK = None
-
-    @classmethod
-    def run_callback(cls):
-        if cls._CALLBACK:
-            cls._CALLBACK()
+    def move(dx: int, dy: int) -> None:
+        import foohid
+        foohid.move_mouse(dx, dy)
+
+
+class MotionEngine:
+    """Moves the mouse at a fixed rate on its own thread, however long pitch estimation takes
+
+    Held mouse notes only steer it, by setting the direction to move in. The cursor starts out at `min_speed` pixels a
+    second and speeds up to `max_speed` over `accel_time` seconds, along a power curve: an exponent of 1 speeds up
+    evenly, and higher ones stay slow for longer, for finer aiming. Each tick moves the cursor as far as it should have
+    gone since the last one, so a late tick doesn't slow it down, and fractions of a pixel carry over to the next tick.
+
+    The thread sleeps while the mouse isn't moving. While it is, `rate` is how many ticks a second it's managing, and
+    `jitter_rms` and `max_jitter` how far (in seconds) ticks have come after they were due.
+    """
+    def __init__(self,
+                 move: Callable[[int, int], None] = VirtualMouse.move,
+                 rate: float = MOUSE_MOTION_RATE,
+                 min_speed: float = MOUSE_MIN_SPEED,
+                 max_speed: float = MOUSE_MAX_SPEED,
+                 accel_time: float = MOUSE_ACCEL_TIME,
+                 accel_exponent: float = MOUSE_ACCEL_EXPONENT) -> None:
+        self.move = move
+        self.period = 1.0 / rate
+        self.min_speed = min_speed
+        self.max_speed = max_speed
+        self.accel_time = accel_time
+        self.accel_exponent = accel_exponent
+
+        self.lock = threading.Lock()
+        self.moving = threading.Event()
+        self.running = True
+        self.thread: Optional[threading.Thread] = None
+        # Unit direction to move in, when it was last changed, and the fractions of a pixel still to move
+        self.direction = (0, 0)
+        self.steered_at = 0.0
+        self.remainder = [0.0, 0.0]
+
+        self.ticks = 0
+        self.moving_time = 0.0
+        self.jitter_sum_sq = 0.0
+        self.max_jitter = 0.0
+
+    def speed(self, held_for: float) -> float:
+        """Pixels a second to move at, once a direction has been held for `held_for` seconds
+        """
+        progress = min(1.0, held_for / self.accel_time) if self.accel_time > 0 else 1.0
+        return self.min_speed + (self.max_speed - self.min_speed) * progress ** self.accel_exponent
+
+    def steer(self, dx: int, dy: int) -> None:
+        """Move in a direction, e.g. (1, 0) for right, until steered elsewhere. (0, 0) stops the mouse
+        """
+        with self.lock:
+            if (dx, dy) != self.direction:
+                self.direction = (dx, dy)
+                self.steered_at = time.monotonic()
+                self.remainder = [0.0, 0.0]
+        if dx or dy:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name='offkeyboard-mouse', daemon=True)
+                self.thread.start()
+            self.moving.set()
+        else:
+            self.moving.clear()
+
+    def stop(self) -> None:
+        self.steer(0, 0)
+
+    def tick(self, now: float, elapsed: float) -> None:
+        """Move the cursor as far as it goes in the `elapsed` seconds up to `now`
+        """
+        with self.lock:
+            dx, dy = self.direction
+            distance = self.speed(now - self.steered_at) * elapsed
+            self.remainder[0] += dx * distance
+            self.remainder[1] += dy * distance
+            move_x = int(self.remainder[0])
+            move_y = int(self.remainder[1])
+            self.remainder[0] -= move_x
+            self.remainder[1] -= move_y
+        if move_x or move_y:
+            self.move(move_x, move_y)
+
+    @property
+    def rate(self) -> float:
+        return self.ticks / self.moving_time if self.moving_time else 0.0
+
+    @property
+    def jitter_rms(self) -> float:
+        return (self.jitter_sum_sq / self.ticks) ** 0.5 if self.ticks else 0.0
+
+    def stats_line(self) -> str:
+        return (f'mouse motion: {self.rate:.1f} Hz\t'
+                f'jitter rms {self.jitter_rms * 1000:.2f} ms, max {self.max_jitter * 1000:.2f} ms')
+
+    def close(self) -> None:
+        self.running = False
+        self.moving.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run(self) -> None:
+        while self.running:
+            self.moving.wait()
+            last_tick = due = time.monotonic()
+            while self.running and self.moving.is_set():
+                # Ticks are due at fixed intervals, rather than a period after the last one ran, so they don't drift
+                due += self.period
+                delay = due - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+                now = time.monotonic()
+                jitter = now - due
+                if jitter > self.period:
+                    # Far behind, e.g. the machine was suspended: skip the ticks we missed rather than bunching them up
+                    due = now
+                self.ticks += 1
+                self.moving_time += now - last_tick
+                self.jitter_sum_sq += jitter * jitter
+                self.max_jitter = max(self.max_jitter, jitter)
+                self.tick(now, now - last_tick)
+                last_tick = now
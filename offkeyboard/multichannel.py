@@ -0,0 +1,89 @@
+"""Several instruments at once, one per input channel
+
+An audio interface's channels are captured as a single interleaved stream and de-interleaved into one frame per
+channel. Each channel has its own NoteDetector, decimator and NoteReader with its own keymap, so e.g. a guitar on one
+input and a bass on another can drive different keys.
+
+The channels' DSP runs in parallel on a thread pool (the FFTs and filters spend their time in numpy/scipy, outside the
+GIL), when there's more than one core to run it on. Once every channel has analyzed a frame, their notes are handed to
+the NoteReaders in channel order, all of which send their events to a single output backend, so key events come out in
+a deterministic order.
+"""
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+import numpy as np
+
+from config import DECIMATION_FACTOR, INPUT_CHANNELS
+from audio_processor import hand_off_note
+from dsp import Decimator
+from frame_provider import FrameProvider
+from keymaps import Keymap
+from note_detector import NoteDetector
+from note_reader import NoteReader
+from output import OutputBackend
+
+
+class Channel:
+    """All of the analysis and note reading state for one input channel
+    """
+    def __init__(self, note_reader: NoteReader) -> None:
+        self.note_detector = NoteDetector()
+        self.note_reader = note_reader
+        self.decimator = Decimator(DECIMATION_FACTOR) if DECIMATION_FACTOR > 1 else None
+
+    def analyze(self, audio_frame: np.ndarray) -> Optional[int]:
+        """Detect the note this channel's latest frame leaves us with. Safe to run alongside other channels
+        """
+        if self.decimator is not None:
+            audio_frame = self.decimator.process(audio_frame)
+        return self.note_detector.process_frame(audio_frame)
+
+
+class MultiChannelProcessor:
+    """Reads (channels, samples) frames and turns each channel's notes into key events with that channel's keymap
+
+    The first `channels` keymaps are used, one per channel in order, so there must be at least that many.
+    """
+    def __init__(self, frame_provider: FrameProvider, keymaps: List[Keymap], output: OutputBackend,
+                 channels: int = INPUT_CHANNELS) -> None:
+        if len(keymaps) < channels:
+            raise ValueError(f'{channels} input channels need a keymap each, but only {len(keymaps)} keymaps are '
+                             f'configured (CHANNEL_KEYMAPS)')
+        self.audio_frame_provider = frame_provider
+        self.output = output
+        self.channels = [Channel(NoteReader(output=output, keymap=keymap)) for keymap in keymaps[:channels]]
+        # A channel's DSP only takes a fraction of a millisecond, so with a single core, handing it to a thread costs
+        # more than it saves
+        workers = min(len(self.channels), os.cpu_count() or 1)
+        self.pool = None
+        if workers > 1:
+            self.pool = ThreadPoolExecutor(workers, thread_name_prefix='offkeyboard-channel')
+
+    def analyze_frames(self, audio_frames: np.ndarray) -> List[Optional[int]]:
+        """Detect every channel's note for one frame from each channel, in parallel
+        """
+        if self.pool is None:
+            return [channel.analyze(frame) for channel, frame in zip(self.channels, audio_frames)]
+        return list(self.pool.map(Channel.analyze, self.channels, audio_frames))
+
+    def process_frames(self, audio_frames: np.ndarray) -> None:
+        """Analyze one frame from every channel, then hand the notes to each channel's NoteReader in channel order
+        """
+        for channel, note in zip(self.channels, self.analyze_frames(audio_frames)):
+            # Not enough audio to analyze yet
+            if note is None:
+                continue
+            hand_off_note(channel.note_detector, channel.note_reader, note)
+
+    def process_audio_forever(self) -> None:
+        try:
+            while self.audio_frame_provider.has_frames():
+                self.process_frames(self.audio_frame_provider.get_frame())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.output.close()
+            if self.pool is not None:
+                self.pool.shutdown()
@@ -0,0 +1,177 @@
+from typing import Optional, Tuple
+
+import numpy as np
+
+from config import (
+    NOTE_MIN,
+    NOTE_MAX,
+    MIN_VOLUME,
+    PITCH_ESTIMATOR,
+    DECIMATION_FACTOR,
+    BANDPASS_FILTER,
+    ONSET_DETECTION,
+    ONSET_THRESHOLD,
+    POLYPHONIC,
+    MAX_CHORD_NOTES,
+    FRAMES_PER_YIN_WINDOW,
+    NOISE_GATE,
+    NOISE_GATE_WINDOW,
+    NOISE_GATE_OPEN_RATIO,
+    NOISE_GATE_CLOSE_RATIO,
+    NOISE_FLOOR_RISE,
+)
+from dsp import (
+    ANALYSIS_RATE,
+    ANALYSIS_SAMPLES_PER_FRAME,
+    FREQ_STEP,
+    SAMPLES_PER_FFT,
+    BandpassFilter,
+    NoiseGate,
+    OnsetDetector,
+    note_to_fftbin,
+)
+from note_utils import SILENCE_NOTE, nearest_note_number
+from pitch_engine import make_pitch_estimator
+from ring_buffer import AudioRingBuffer
+
+
+# Derive the frequencies which notes on the instrument will produce
+GUITAR_MIN_FREQ = max(0, int(np.floor(note_to_fftbin(NOTE_MIN-1))))
+GUITAR_MAX_FREQ = min(SAMPLES_PER_FFT, int(np.ceil(note_to_fftbin(NOTE_MAX+1))))
+
+
+class NoteDetector:
+    """Turns a stream of audio frames into a stream of detected notes
+    This is all of the analysis state for one audio source, with no knowledge of where the frames come from or what
+    the notes are used for.
+    """
+    def __init__(self,
+                 estimator: str = PITCH_ESTIMATOR,
+                 sample_rate: float = ANALYSIS_RATE,
+                 samples_per_frame: int = ANALYSIS_SAMPLES_PER_FRAME,
+                 polyphonic: bool = POLYPHONIC) -> None:
+        self.polyphonic = polyphonic
+        if polyphonic:
+            # Chords need an estimator which can pick out several notes at once
+            self.pitch_estimator = make_pitch_estimator('harmonic_sum', sample_rate, max_notes=MAX_CHORD_NOTES)
+        else:
+            self.pitch_estimator = make_pitch_estimator(estimator, sample_rate)
+        # How many samples the pitch estimator runs over
+        self.window_size = self.pitch_estimator.window_size
+        # Audio frame buffer which we'll run FFT on. It holds an extra frame so that estimators which update
+        # incrementally can see the samples which just left the analysis window. With the noise gate on, it also keeps
+        # a running sum of squares over the gate's window, so the gate's level costs nothing to find
+        self.noise_gate = None
+        energy_window = 0
+        if NOISE_GATE:
+            self.noise_gate = NoiseGate(sample_rate / samples_per_frame, MIN_VOLUME, NOISE_GATE_OPEN_RATIO,
+                                        NOISE_GATE_CLOSE_RATIO, NOISE_FLOOR_RISE)
+            energy_window = min(NOISE_GATE_WINDOW * samples_per_frame, self.window_size + samples_per_frame)
+        self.ring_buffer = AudioRingBuffer(self.window_size + samples_per_frame, energy_window=energy_window)
+        # Filter run in place over each frame as it lands in the ring buffer
+        self.frame_filter = None
+        if BANDPASS_FILTER:
+            # The GUITAR_*_FREQ bounds are FFT bins, so convert them back to Hz
+            bandpass = BandpassFilter(GUITAR_MIN_FREQ * FREQ_STEP, GUITAR_MAX_FREQ * FREQ_STEP, sample_rate)
+            self.frame_filter = bandpass.filter_in_place
+        # Frequency estimated for the most recent voiced frame
+        self.freq = 0.0
+        # How sure the pitch estimator was of the most recent note, or 0 if the frame was silent
+        self.confidence = 0.0
+        # In polyphonic mode, every note heard in the most recent frame, strongest first
+        self.notes: Tuple[int, ...] = ()
+        # Looks for picks in each frame, in blocks of a quarter of a frame
+        self.onset_detector = None
+        # Finds the pitch of the attack after an onset. A short YIN window holds little of the note before it
+        self.attack_estimator = None
+        if ONSET_DETECTION:
+            self.onset_detector = OnsetDetector(sample_rate, samples_per_frame // 4, ONSET_THRESHOLD)
+            self.attack_estimator = make_pitch_estimator('yin', sample_rate, samples_per_frame * FRAMES_PER_YIN_WINDOW)
+        # Whether a note was picked in the most recent frame
+        self.onset = False
+        # On the frame after an onset, the note heard in the newest audio alone, or None. While the analysis window
+        # still holds the note before the pick, this tells a re-pick of that note from a new one
+        self.attack_note: Optional[int] = None
+        # How loud the most recent frame was, on the scale MIN_VOLUME is set on
+        self.level = 0.0
+
+    @property
+    def audio_frame_buf(self) -> np.ndarray:
+        """Contiguous view of the samples the pitch estimator runs over, oldest sample first
+        """
+        return self.ring_buffer.latest(self.window_size)
+
+    @property
+    def commit_confidence(self) -> float:
+        """The confidence to hand a NoteReader: 0 if the estimator's confidence shouldn't commit notes early
+        """
+        return self.confidence if self.pitch_estimator.EARLY_COMMIT else 0.0
+
+    def volume(self, audio_frame: np.ndarray) -> float:
+        """How loud the newest audio is, on the scale MIN_VOLUME is set on
+        With the noise gate on, this is the mean over the gate's window of frames, otherwise just the newest frame's.
+        """
+        if self.noise_gate is not None:
+            frames = self.ring_buffer.energy_window / len(audio_frame)
+            norm = np.sqrt(self.ring_buffer.energy / frames)
+        else:
+            norm = np.linalg.norm(audio_frame)
+        # Decimated frames hold fewer samples, so scale the volume back up to what the full-rate frame would have had
+        return float(norm) * 10 * np.sqrt(DECIMATION_FACTOR)
+
+    def is_audio_silence(self, volume: float) -> bool:
+        if self.noise_gate is not None:
+            return not self.noise_gate.is_open
+        return volume < MIN_VOLUME
+
+    def write_frame(self, audio_frame: np.ndarray) -> None:
+        # band-pass the frame to remove data outside guitar frequencies, if enabled
+        self.ring_buffer.write(audio_frame, self.frame_filter)
+
+    def detect(self, frame_len: int) -> Optional[int]:
+        """Analyze the window once a new frame of `frame_len` samples has been committed to the ring buffer
+        Returns the detected note number, SILENCE_NOTE, or None if there isn't enough audio to analyze yet.
+        """
+        audio_frame = self.ring_buffer.latest(frame_len)
+        self.pitch_estimator.push_frame(self.ring_buffer.latest(self.window_size + frame_len), frame_len)
+        after_onset = self.onset
+        self.attack_note = None
+        if self.onset_detector is not None:
+            self.onset = self.onset_detector.process(audio_frame)
+        volume = self.volume(audio_frame)
+        self.level = volume
+        # The gate keeps learning the noise floor while the window fills
+        if self.noise_gate is not None:
+            self.noise_gate.update(volume, self.confidence)
+
+        # If we don't have enough frames to run FFT yet, keep waiting
+        if self.ring_buffer.samples_written < self.window_size:
+            return None
+
+        self.confidence = 0.0
+        self.notes = ()
+        # Note when we get an audio frame which is below a volume threshold, without estimating its pitch
+        if self.is_audio_silence(volume):
+            return SILENCE_NOTE
+
+        freq = self.pitch_estimator.estimate(self.audio_frame_buf)
+        # The estimator couldn't find any periodicity in the window
+        if freq <= 0:
+            return SILENCE_NOTE
+        self.freq = float(freq)
+        self.confidence = self.pitch_estimator.confidence
+        if self.polyphonic:
+            self.notes = self.pitch_estimator.notes
+        if after_onset:
+            attack_freq = self.attack_estimator.estimate(self.ring_buffer.latest(self.attack_estimator.window_size))
+            if attack_freq > 0:
+                self.attack_note = nearest_note_number(attack_freq)
+
+        # Get the nearest note number
+        return nearest_note_number(freq)
+
+    def process_frame(self, audio_frame: np.ndarray) -> Optional[int]:
+        """Add a frame to the analysis window and detect the note it leaves us with
+        """
+        self.write_frame(audio_frame)
+        return self.detect(len(audio_frame))
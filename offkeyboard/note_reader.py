@@ -1,27 +1,43 @@
 import collections
-from typing import Optional, Union, List
+from typing import Optional, Tuple
 
-import keyboard
-
-from keymaps import MarioMap
+from config import NOTE_VOTE_WINDOW, NOTE_VOTES_TO_COMMIT, EARLY_COMMIT_CONFIDENCE, EARLY_COMMIT_FRAMES
+from keymaps import Keymap, KeyAction, MarioMap, compile_keymap
 from note_utils import SILENCE_NOTE
-from mouse import (
-    MOUSE_KEYS,
-    MOUSE_LEFT_KEY,
-    MOUSE_RIGHT_KEY,
-    MOUSE_UP_KEY,
-    MOUSE_DOWN_KEY,
-    MOUSE_CLICK_KEY,
-    VirtualMouse
-)
+from mouse import MOUSE_KEYS, MOUSE_CLICK_KEY
+from output import OutputBackend, os_backend
 
 
 class NoteReader:
-    def __init__(self):
-        self.ringbuf_size = 10
+    def __init__(self,
+                 output: OutputBackend = None,
+                 keymap: Keymap = None,
+                 ringbuf_size: int = NOTE_VOTE_WINDOW,
+                 votes_to_commit: int = NOTE_VOTES_TO_COMMIT,
+                 early_commit_confidence: float = EARLY_COMMIT_CONFIDENCE,
+                 early_commit_frames: int = EARLY_COMMIT_FRAMES):
+        # Every key/mouse event and log line goes to the output backend, which by default sends them to the OS from
+        # its own thread
+        self.output = output or os_backend()
+        # Resolve every note's action up front, so handling a note is a single lookup
+        self.keymap = compile_keymap(keymap or MarioMap())
+        self.ringbuf_size = ringbuf_size
+        # How many of the last `ringbuf_size` notes must agree before we press a key for it
+        self.votes_to_commit = votes_to_commit
         self.last_notes = collections.deque(maxlen=self.ringbuf_size)
+        # How many times each note (or chord) appears in last_notes, indexed by note - SILENCE_NOTE, so counting votes
+        # is O(1)
+        self.note_votes = [0] * (len(self.keymap.by_number) - SILENCE_NOTE)
+        # Notes estimated at least this confidently in `early_commit_frames` frames running are pressed straight away,
+        # without waiting for the rest of the votes
+        self.early_commit_confidence = early_commit_confidence
+        self.early_commit_frames = early_commit_frames
+        # The note the latest run of confident frames agreed on, and how long that run is
+        self.confident_note: Optional[int] = None
+        self.confident_frames = 0
+        # The note which was ringing when the latest onset came, until the frame after it says whether it was re-picked
+        self.ringing_note: Optional[int] = None
         self.last_pressed_note = None
-        self.keymap = MarioMap()
         self.currently_held_key: Optional[str] = None
 
     def release_held_key(self):
@@ -30,95 +46,127 @@ class NoteReader:
         if not self.currently_held_key:
 
             return
-        print(f'Releasing key: {self.currently_held_key}')
+        self.output.log(f'Releasing key: {self.currently_held_key}')
         if self.currently_held_key not in MOUSE_KEYS:
-            keyboard.release(self.currently_held_key)
+            self.output.release(self.currently_held_key)
         else:
-            VirtualMouse.clear()
+            self.output.release_mouse()
         self.currently_held_key = None
 
-    def hold_key(self, note: str, key_or_key_list: Union[str, List]) -> None:
+    def hold_key(self, note: int, action: KeyAction) -> None:
         """Start holding down a key
         """
         if note == SILENCE_NOTE:
             return
 
-        if isinstance(key_or_key_list, list):
-            combo = "+".join(key_or_key_list)
-            self.currently_held_key = combo
-            # print(f'Holding key-combo {combo}')
-            keyboard.press(combo)
-        else:
-            self.currently_held_key = key_or_key_list
-            # print(f'Holding single-key {key_or_key_list}')
-            keyboard.press(key_or_key_list)
+        self.currently_held_key = action.key
+        # print(f'Holding key {action.key}')
+        self.output.press(action.key)
 
-    def process_note(self, note: str):
-        key_or_key_list = self.keymap.key_for_note(note)
+    def vote(self, note: int) -> int:
+        """Add a note to the ring buffer, returning how many times it now appears there
+        """
+        if len(self.last_notes) == self.ringbuf_size:
+            self.note_votes[self.last_notes[0] - SILENCE_NOTE] -= 1
+        self.last_notes.append(note)
+        self.note_votes[note - SILENCE_NOTE] += 1
+        return self.note_votes[note - SILENCE_NOTE]
 
-        if key_or_key_list is not None and key_or_key_list == self.currently_held_key:
+    def fill_votes(self, note: int) -> None:
+        """Fill the entire ring buffer with `note`
+        """
+        for old_note in self.last_notes:
+            self.note_votes[old_note - SILENCE_NOTE] -= 1
+        self.last_notes.extend([note] * self.ringbuf_size)
+        self.note_votes[note - SILENCE_NOTE] = self.ringbuf_size
+
+    def process_notes(self, notes: Tuple[int, ...], confidence: float = 0.0, onset: bool = False,
+                      attack_note: Optional[int] = None):
+        """Handle the notes heard together in the latest frame, strongest first
+        If they make up one of the keymap's chords, the chord is handled like any other note. Otherwise, only the
+        strongest note is.
+        """
+        chord = self.keymap.chord_number(notes) if len(notes) > 1 else None
+        if chord is not None:
+            self.process_note(chord, confidence, onset, attack_note)
+        else:
+            self.process_note(notes[0] if notes else SILENCE_NOTE, confidence, onset, attack_note)
+
+    def process_note(self, note: int, confidence: float = 0.0, onset: bool = False,
+                     attack_note: Optional[int] = None):
+        """Handle the note detected in the latest frame
+        `confidence` is how sure the pitch estimator was of it, from 0 to 1. `onset` says a string was picked in this
+        frame, so the note should be pressed again even if it's the note we last pressed. On the frame after an onset,
+        `attack_note` is the note heard in the newest audio alone (see NoteDetector.attack_note).
+        """
+        action = self.keymap.action_for_number(note)
+
+        if action is not None and action.key == self.currently_held_key:
             return
-        if isinstance(key_or_key_list, list):
-            combo = "+".join(key_or_key_list)
-            if self.currently_held_key == combo:
-                return
 
         # clean up the key we were just pressing
         self.release_held_key()
 
         if note == SILENCE_NOTE and self.currently_held_key in MOUSE_KEYS:
-            VirtualMouse.clear()
+            self.output.release_mouse()
             return
 
         # If this is a key that should be pressed until the note changes, do so
-        if self.keymap.should_hold_key(key_or_key_list):
-            print(f'{note}\tHolding down "{key_or_key_list}"')
-            self.hold_key(note, key_or_key_list)
+        if action is not None and action.hold:
+            self.output.log(f'{self.keymap.name_for_number(note)}\tHolding down "{action.key}"')
+            self.hold_key(note, action)
             return
 
-        self.last_notes.append(note)
+        # Re-picking the note which was ringing needs no votes, once the newest audio confirms it's the same pitch:
+        # the analysis window can hold the old note for a while after a new one is picked, so `note` can't say
+        repick = attack_note is not None and attack_note == note == self.ringing_note
+        self.ringing_note = None
+        if onset and note != SILENCE_NOTE:
+            if self.last_pressed_note is not None and self.last_pressed_note != SILENCE_NOTE:
+                self.ringing_note = self.last_pressed_note
+            elif self.note_votes[note - SILENCE_NOTE] >= self.votes_to_commit:
+                self.ringing_note = note
+            # A new attack: forget what was ringing before, so whatever note this turns out to be gets pressed
+            self.fill_votes(SILENCE_NOTE)
+            self.last_pressed_note = None
+
+        votes = self.vote(note)
+        # While the window still holds the end of the last note, a frame can be confidently wrong (often by an octave,
+        # or at a pitch the two notes share), so an early commit needs a run of confident frames which agree
+        confident = confidence >= self.early_commit_confidence
+        if confident and note == self.confident_note:
+            self.confident_frames += 1
+        else:
+            self.confident_frames = int(confident)
+        self.confident_note = note if confident else None
+        confirmed = self.confident_frames >= self.early_commit_frames
         # should we register this note?
-        # If most of the notes in the ringbuffer are the same note, and this note is different from the last detected
-        # note, do a state transition
-        if self.last_notes.count(note) > 3 and note != self.last_pressed_note:
+        # If the estimate is unambiguous, or most of the notes in the ringbuffer are the same note, and this note is
+        # different from the last detected note, do a state transition
+        if (repick or confirmed or votes >= self.votes_to_commit) and note != self.last_pressed_note:
             # fill the entire buffer with whatever we just registered
-            for _ in range(self.ringbuf_size):
-                self.last_notes.append(note)
-            self.quick_press_key_for_note(note)
+            self.fill_votes(note)
+            self.quick_press_key_for_note(note, action)
 
-    def quick_press_key_for_note(self, note: str):
+    def quick_press_key_for_note(self, note: int, action: Optional[KeyAction]):
         self.last_pressed_note = note
 
-        key_or_key_list = self.keymap.key_for_note(note)
-        if key_or_key_list is None:
-            return
-
-        # Mouse keys are handled separately
-        if key_or_key_list in MOUSE_KEYS:
-            key = key_or_key_list
-            print(f'Ignoring mouse event: {key}')
+        if action is None:
             return
 
-            print(f'got a mouse event: {key}')
-            self.currently_held_key = key
-            if key == MOUSE_LEFT_KEY:
-                VirtualMouse.hold_left()
-            elif key == MOUSE_RIGHT_KEY:
-                VirtualMouse.hold_right()
-            elif key == MOUSE_UP_KEY:
-                VirtualMouse.hold_up()
-            elif key == MOUSE_DOWN_KEY:
-                VirtualMouse.hold_down()
-            elif key == MOUSE_CLICK_KEY:
-                self.currently_held_key = None
-                VirtualMouse.left_click()
+        # Mouse keys are handled separately: a direction steers the mouse for as long as the note rings
+        if action.mouse:
+            key = action.key
+            self.output.log(f'{self.keymap.name_for_number(note)}\tMouse "{key}"')
+            if key == MOUSE_CLICK_KEY:
+                self.output.click_mouse()
+            else:
+                self.currently_held_key = key
+                self.output.hold_mouse(key)
             return
 
-        if isinstance(key_or_key_list, list):
-            combo = "+".join(key_or_key_list)
-            print(f'{note}\tKey-combo {combo}')
-            keyboard.send(combo)
+        if action.combo:
+            self.output.log(f'{self.keymap.name_for_number(note)}\tKey-combo {action.key}')
         else:
-            key = key_or_key_list
-            print(f'{note}\tPressing "{key}"')
-            keyboard.send(key)
+            self.output.log(f'{self.keymap.name_for_number(note)}\tPressing "{action.key}"')
+        self.output.send(action.key)
@@ -1,3 +1,5 @@
+import bisect
+
 import numpy as np
 from config import (
     NOTE_MIN,
@@ -8,8 +10,9 @@ from config import (
 # https://newt.phys.unsw.edu.au/jw/notes.html
 
 
-# Special note that is sent when we detect silence
-SILENCE_NOTE = 'silence'
+# Notes are passed around as MIDI note numbers, and only turned into names when they're shown to a person.
+# Special note number that is sent when we detect silence
+SILENCE_NOTE = -1
 
 
 def freq_to_number(f):
@@ -23,3 +26,42 @@ def number_to_freq(n):
 def note_name(n):
     NOTE_NAMES = 'E F F# G G# A A# B C C# D D#'.split()
     return NOTE_NAMES[n % NOTE_MIN % len(NOTE_NAMES)] + str(int(n / 12 - 1))
+
+
+# note_name() only names notes correctly from NOTE_MIN up to (but not including) 2 * NOTE_MIN, so that's the range
+# note names can be looked up in
+NOTE_NUMBERS = {note_name(n): n for n in range(NOTE_MIN, 2 * NOTE_MIN)}
+
+
+def note_number(name):
+    return NOTE_NUMBERS[name]
+
+
+def format_note(n):
+    """Human-readable name of a note number, for logging
+    """
+    if n == SILENCE_NOTE:
+        return 'silence'
+    return note_name(n)
+
+
+# Frequencies halfway (in pitch) between each pair of adjacent MIDI notes. Any frequency between
+# NOTE_BOUNDARIES[i-1] and NOTE_BOUNDARIES[i] is nearest to note i.
+NOTE_BOUNDARIES = [number_to_freq(n + 0.5) for n in range(127)]
+LOWEST_NOTE_FREQ = number_to_freq(NOTE_MIN)
+
+
+def nearest_note_number(freq):
+    # Hot-fix for when we detect a fundamental frequency which is clearly too low to be correct
+    if freq < LOWEST_NOTE_FREQ:
+        # Double it and assume this is the fundamental :}
+        freq = freq*2
+    # Looking the frequency up in a precomputed table saves taking a logarithm on every frame
+    return bisect.bisect_right(NOTE_BOUNDARIES, freq)
+
+
+def nearest_note_numbers(freqs):
+    """nearest_note_number() over an array of frequencies at once
+    """
+    freqs = np.where(freqs < LOWEST_NOTE_FREQ, freqs*2, freqs)
+    return np.searchsorted(NOTE_BOUNDARIES, freqs, side='right')
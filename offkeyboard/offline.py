@@ -0,0 +1,280 @@
+"""Offline analysis of recorded WAV files
+
+Rather than feeding a recording through AudioProcessor a frame at a time in real time, the file is memory-mapped, every
+analysis window is taken as a strided view over it, and pitch is estimated for whole batches of windows at once. The
+detected notes are then run through the usual NoteReader logic, with key output disabled, to produce a note timeline.
+
+Usage:
+    python offkeyboard/offline.py recording.wav [-o timeline.csv | -o timeline.npz]
+"""
+import argparse
+import csv
+import sys
+import time
+from collections import namedtuple
+from typing import Callable, List, Optional, Tuple
+
+import numpy as np
+from scipy.io import wavfile
+
+from config import (
+    SAMPLES_PER_FRAME,
+    MIN_VOLUME,
+    PITCH_ESTIMATOR,
+    DECIMATION_FACTOR,
+    BANDPASS_FILTER,
+    POLYPHONIC,
+    MAX_CHORD_NOTES,
+    FRAMES_PER_YIN_WINDOW,
+    ONSET_DETECTION,
+    ONSET_THRESHOLD,
+    NOISE_GATE,
+    NOISE_GATE_WINDOW,
+    NOISE_GATE_OPEN_RATIO,
+    NOISE_GATE_CLOSE_RATIO,
+    NOISE_FLOOR_RISE,
+)
+from dsp import FREQ_STEP, BandpassFilter, Decimator, NoiseGate, OnsetDetector, strided_windows
+from note_detector import GUITAR_MIN_FREQ, GUITAR_MAX_FREQ
+from note_reader import NoteReader
+from note_utils import SILENCE_NOTE, format_note, nearest_note_number, nearest_note_numbers
+from output import OutputEvent, RecorderBackend
+from pitch_engine import PITCH_ESTIMATORS, make_pitch_estimator
+
+
+# Per-frame analysis results. Frame k's entry describes the window ending with that frame, and `time` is when the
+# frame would have finished arriving from a microphone, in seconds from the start of the recording. `volume` is the
+# loudness NoteDetector gates on, and `onset` whether a string was picked during the frame. `notes` holds every note
+# heard in the frame, strongest first, padded with SILENCE_NOTE: in polyphonic mode there can be several.
+# `attack_note` is NoteDetector.attack_note, with SILENCE_NOTE for None.
+Timeline = namedtuple('Timeline', ['time', 'freq', 'note', 'confidence', 'volume', 'onset', 'notes', 'attack_note'])
+
+def load_wav(filename: str) -> Tuple[int, np.ndarray]:
+    """Memory-map a WAV file, returning its sample rate and its first channel
+    """
+    sample_rate, samples = wavfile.read(filename, mmap=True)
+    if samples.ndim > 1:
+        samples = samples[:, 0]
+    return sample_rate, samples
+
+
+def analysis_estimator(estimator_name: str = PITCH_ESTIMATOR, polyphonic: bool = POLYPHONIC) -> str:
+    """The estimator NoteDetector really runs: chords need one which can pick out several notes at once
+    """
+    return 'harmonic_sum' if polyphonic else estimator_name
+
+
+def frame_volumes(samples: np.ndarray, samples_per_frame: int, chunk_frames: int = 4096) -> np.ndarray:
+    """The norm of each frame, computed a chunk at a time so the whole file is never converted to floats at once
+    """
+    frame_count = len(samples) // samples_per_frame
+    frames = samples[:frame_count * samples_per_frame].reshape(frame_count, samples_per_frame)
+    volumes = np.empty(frame_count)
+    for i in range(0, frame_count, chunk_frames):
+        chunk = frames[i:i + chunk_frames].astype(np.float64)
+        volumes[i:i + chunk_frames] = np.sqrt(np.einsum('ij,ij->i', chunk, chunk))
+    return volumes
+
+
+def prepare_samples(samples: np.ndarray, sample_rate: float, chunk_samples: int = 2**20) -> Tuple[np.ndarray, float]:
+    """Decimate and band-pass a recording as the live pipeline would, returning the samples and their sample rate
+    This is done a chunk at a time, carrying the filters' state across, so the whole file is never converted to
+    floats at once. A recording which needs neither is returned as it is.
+    """
+    if DECIMATION_FACTOR == 1 and not BANDPASS_FILTER:
+        return samples, sample_rate
+    decimator = Decimator(DECIMATION_FACTOR) if DECIMATION_FACTOR > 1 else None
+    sample_rate = sample_rate / DECIMATION_FACTOR
+    bandpass = None
+    if BANDPASS_FILTER:
+        # The GUITAR_*_FREQ bounds are FFT bins, so convert them back to Hz
+        bandpass = BandpassFilter(GUITAR_MIN_FREQ * FREQ_STEP, GUITAR_MAX_FREQ * FREQ_STEP, sample_rate)
+
+    prepared = np.empty(-(-len(samples) // DECIMATION_FACTOR), dtype=np.float32)
+    written = 0
+    for i in range(0, len(samples), chunk_samples):
+        chunk = samples[i:i + chunk_samples]
+        chunk = decimator.process(chunk) if decimator is not None else chunk.astype(np.float32)
+        if bandpass is not None:
+            bandpass.filter_in_place(chunk)
+        prepared[written:written + len(chunk)] = chunk
+        written += len(chunk)
+    return prepared[:written], sample_rate
+
+
+def gate_window_volumes(volumes: np.ndarray) -> np.ndarray:
+    """The volume of the last NOISE_GATE_WINDOW frames, for each frame, from the volume of each frame on its own
+    """
+    window_energy = np.convolve(volumes ** 2, np.ones(NOISE_GATE_WINDOW))[:len(volumes)]
+    return np.sqrt(window_energy / NOISE_GATE_WINDOW)
+
+
+def voiced_frames(volumes: np.ndarray, min_volume: float, frame_rate: float, confidences: np.ndarray) -> np.ndarray:
+    """Which frames NoteDetector would have estimated the pitch of, given their volumes and how confident the pitch
+    estimates of the louder ones are
+    """
+    if not NOISE_GATE:
+        return volumes >= min_volume
+    gate = NoiseGate(frame_rate, min_volume, NOISE_GATE_OPEN_RATIO, NOISE_GATE_CLOSE_RATIO, NOISE_FLOOR_RISE)
+    voiced = np.zeros(len(volumes), dtype=bool)
+    confidence = 0.0
+    for i, (volume, frame_confidence) in enumerate(zip(volumes.tolist(), confidences.tolist())):
+        voiced[i] = gate.update(volume, confidence)
+        confidence = frame_confidence if voiced[i] else 0.0
+    return voiced
+
+
+def analyze_samples(samples: np.ndarray,
+                    sample_rate: float,
+                    samples_per_frame: int = SAMPLES_PER_FRAME,
+                    estimator_name: str = PITCH_ESTIMATOR,
+                    min_volume: float = MIN_VOLUME,
+                    batch_windows: int = 256,
+                    window_size: Optional[int] = None,
+                    gate_frames: bool = True,
+                    polyphonic: bool = POLYPHONIC) -> Timeline:
+    """Detect the note for every frame of a recording, the same way NoteDetector would have in real time
+    `window_size` overrides the estimator's usual analysis window, in (possibly decimated) samples. With `gate_frames`
+    off, the pitch of every frame is estimated, however quiet.
+    """
+    samples, sample_rate = prepare_samples(samples, sample_rate)
+    samples_per_frame = samples_per_frame // DECIMATION_FACTOR
+
+    kwargs = {'max_notes': MAX_CHORD_NOTES} if polyphonic else {}
+    estimator = make_pitch_estimator(analysis_estimator(estimator_name, polyphonic), sample_rate, window_size, **kwargs)
+    window_size = estimator.window_size
+    frame_count = len(samples) // samples_per_frame
+
+    # The first frame which completes a full window, and where that window starts
+    first_frame = -(-window_size // samples_per_frame) - 1
+    first_start = (first_frame + 1) * samples_per_frame - window_size
+    windows = strided_windows(samples, window_size, samples_per_frame, first_start)[:max(0, frame_count - first_frame)]
+
+    # Decimated frames hold fewer samples, so scale the volume back up to what the full-rate frame would have had
+    volumes = frame_volumes(samples, samples_per_frame) * 10 * np.sqrt(DECIMATION_FACTOR)
+    if NOISE_GATE:
+        volumes = gate_window_volumes(volumes)
+    volumes = volumes[first_frame:]
+    # The gate can hold itself open a little below min_volume, but never opens for anything quieter than that
+    candidates = np.arange(len(volumes))
+    if gate_frames:
+        candidates = np.flatnonzero(volumes >= min_volume * (NOISE_GATE_CLOSE_RATIO if NOISE_GATE else 1))
+
+    freqs = np.zeros(len(windows))
+    confidences = np.zeros(len(windows))
+    chords = np.full((len(windows), MAX_CHORD_NOTES), SILENCE_NOTE) if polyphonic else None
+    if polyphonic:
+        # estimate_batch() only gives the strongest note, so windows are estimated one at a time to get all of them
+        for i in candidates.tolist():
+            freqs[i] = estimator.estimate(windows[i])
+            confidences[i] = estimator.confidence
+            chords[i, :len(estimator.notes)] = estimator.notes
+    else:
+        for i in range(0, len(candidates), batch_windows):
+            batch = candidates[i:i + batch_windows]
+            freqs[batch], confidences[batch] = estimator.estimate_batch(windows[batch])
+    if gate_frames:
+        # The gate's decisions depend on how sure the estimator was of the frames it let through
+        voiced = voiced_frames(volumes, min_volume, sample_rate / samples_per_frame, confidences)
+        freqs[~voiced] = 0
+        confidences[~voiced] = 0
+
+    # Onsets depend on everything that came before, so they're found a frame at a time
+    onsets = np.zeros(frame_count, dtype=bool)
+    if ONSET_DETECTION:
+        onset_detector = OnsetDetector(sample_rate, samples_per_frame // 4, ONSET_THRESHOLD)
+        for i in range(frame_count):
+            onsets[i] = onset_detector.process(samples[i * samples_per_frame:(i + 1) * samples_per_frame])
+
+    # The frames after onsets get the pitch of their newest audio alone, so re-picks can be told from new notes
+    attack_notes = np.full(len(windows), SILENCE_NOTE)
+    if ONSET_DETECTION:
+        attack_estimator = make_pitch_estimator('yin', sample_rate, samples_per_frame * FRAMES_PER_YIN_WINDOW)
+        after_onset = np.concatenate(([False], onsets[:-1]))[first_frame:]
+        for i in np.flatnonzero(after_onset & (freqs > 0)).tolist():
+            end = (first_frame + i + 1) * samples_per_frame
+            attack_freq = attack_estimator.estimate(samples[end - attack_estimator.window_size:end])
+            if attack_freq > 0:
+                attack_notes[i] = nearest_note_number(attack_freq)
+
+    notes = np.where(freqs > 0, nearest_note_numbers(np.maximum(freqs, 1e-9)), SILENCE_NOTE)
+    if polyphonic:
+        chords[freqs <= 0] = SILENCE_NOTE
+    else:
+        chords = notes[:, np.newaxis]
+    times = (np.arange(first_frame, frame_count) + 1) * samples_per_frame / sample_rate
+    return Timeline(times, freqs, notes, confidences, volumes, onsets[first_frame:], chords, attack_notes)
+
+
+def replay_notes(timeline: Timeline,
+                 note_reader_factory: Callable = NoteReader,
+                 early_commit: bool = True) -> List[OutputEvent]:
+    """Run the detected notes through a NoteReader, returning the key events it would have sent
+    Without `early_commit`, the NoteReader isn't given the confidences, as for estimators whose confidence can't be
+    trusted to commit notes early (see NoteDetector.commit_confidence).
+    """
+    recorder = RecorderBackend()
+    note_reader = note_reader_factory(output=recorder)
+    for t, note, confidence, onset, chord, attack_note in zip(timeline.time, timeline.note, timeline.confidence,
+                                                              timeline.onset, timeline.notes.tolist(),
+                                                              timeline.attack_note.tolist()):
+        recorder.time = float(t)
+        commit_confidence = float(confidence) if early_commit and note != SILENCE_NOTE else 0.0
+        # process_notes() handles a single note just as process_note() would, and picks out the keymap's chords
+        note_reader.process_notes(tuple(n for n in chord if n != SILENCE_NOTE), commit_confidence, bool(onset),
+                                  None if attack_note == SILENCE_NOTE else attack_note)
+    return recorder.events
+
+
+def write_timeline(filename: str, timeline: Timeline, events: List[OutputEvent]) -> None:
+    if filename.endswith('.npz'):
+        np.savez_compressed(filename,
+                            time=timeline.time,
+                            freq=timeline.freq,
+                            note=timeline.note,
+                            confidence=timeline.confidence,
+                            volume=timeline.volume,
+                            onset=timeline.onset,
+                            notes=timeline.notes,
+                            attack_note=timeline.attack_note,
+                            event_time=np.array([e.time for e in events]),
+                            event_kind=np.array([e.kind for e in events], dtype=str),
+                            event_key=np.array([e.key for e in events], dtype=str))
+        return
+
+    # Attach each key event to the row for the frame which caused it
+    events_at = {}
+    for event in events:
+        events_at.setdefault(event.time, []).append(f'{event.kind}:{event.key}')
+    with open(filename, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['time', 'freq', 'note', 'name', 'confidence', 'volume', 'onset', 'events'])
+        for t, freq, note, confidence, volume, onset, chord, _ in zip(*timeline):
+            # Every note heard, where the frame had more than one
+            name = ' '.join(format_note(int(n)) for n in chord if n != SILENCE_NOTE) or format_note(int(note))
+            writer.writerow([f'{t:.4f}', f'{freq:.2f}', int(note), name, f'{confidence:.3f}',
+                             f'{volume:.0f}', int(onset), ' '.join(events_at.get(float(t), []))])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Detect the notes played in a WAV recording')
+    parser.add_argument('wav', help='mono or multi-channel WAV file; only the first channel is analyzed')
+    parser.add_argument('-o', '--output', default='timeline.csv', help='.csv or .npz file to write the timeline to')
+    parser.add_argument('--estimator', default=PITCH_ESTIMATOR,
+                        help='pitch estimator to use (ignored with POLYPHONIC on, which always uses harmonic_sum)')
+    args = parser.parse_args(argv)
+
+    start = time.perf_counter()
+    sample_rate, samples = load_wav(args.wav)
+    timeline = analyze_samples(samples, sample_rate, estimator_name=args.estimator)
+    events = replay_notes(timeline, early_commit=PITCH_ESTIMATORS[analysis_estimator(args.estimator)].EARLY_COMMIT)
+    write_timeline(args.output, timeline, events)
+    elapsed = time.perf_counter() - start
+
+    duration = len(samples) / sample_rate
+    print(f'Analyzed {duration:.1f}s of audio ({len(timeline.time)} windows, {len(events)} key events) '
+          f'in {elapsed:.2f}s ({duration / elapsed:.0f}x real time). Wrote {args.output}')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
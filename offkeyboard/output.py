@@ -0,0 +1,269 @@
+"""Output backends: where the key and mouse events a NoteReader decides on end up
+
+Every event is a kind (one of EVENT_KINDS) and the key it's for. Backends only have to implement emit(), and can
+be stacked: os_backend() sends events to the OS keyboard and mouse from a worker thread, RecorderBackend keeps them in
+memory instead, and NullBackend throws them away, so the whole pipeline can run headless.
+
+The OS input modules are only imported once a backend which needs them is created.
+"""
+import collections
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from typing import Callable, List, Optional
+
+from mouse import MOUSE_UP_KEY, MOUSE_DOWN_KEY, MOUSE_LEFT_KEY, MOUSE_RIGHT_KEY, MotionEngine, VirtualMouse
+
+
+EVENT_KINDS = ('press', 'release', 'send', 'hold_mouse', 'release_mouse', 'click_mouse')
+
+# An event a RecorderBackend was sent, `time` seconds into the recording (or by time.monotonic())
+OutputEvent = namedtuple('OutputEvent', ['time', 'kind', 'key'])
+
+
+class OutputBackend(ABC):
+    """Protocol to send key and mouse events somewhere
+    """
+    @abstractmethod
+    def emit(self, kind: str, key: str = '') -> None:
+        """Send one event. `key` is the key (or '+'-joined key combo) for key events, or a MOUSE_*_KEY for hold_mouse
+        """
+        pass
+
+    def press(self, key: str) -> None:
+        self.emit('press', key)
+
+    def release(self, key: str) -> None:
+        self.emit('release', key)
+
+    def send(self, key: str) -> None:
+        """Tap a key, or a key combo
+        """
+        self.emit('send', key)
+
+    def hold_mouse(self, key: str) -> None:
+        """Keep moving the mouse in the direction of a MOUSE_*_KEY, until release_mouse()
+        """
+        self.emit('hold_mouse', key)
+
+    def release_mouse(self) -> None:
+        self.emit('release_mouse')
+
+    def click_mouse(self) -> None:
+        self.emit('click_mouse')
+
+    def log(self, message: str) -> None:
+        print(message)
+
+    def when_sent(self, func: Callable, *args) -> None:
+        """Run `func(*args)` once every event emitted so far has actually been sent
+        """
+        func(*args)
+
+    def close(self) -> None:
+        """Finish sending any events still waiting to go out
+        """
+        pass
+
+
+class NullBackend(OutputBackend):
+    """Sends nothing, and logs nothing
+    """
+    def emit(self, kind: str, key: str = '') -> None:
+        pass
+
+    def log(self, message: str) -> None:
+        pass
+
+
+class RecorderBackend(OutputBackend):
+    """Keeps every event as an OutputEvent, rather than sending it. Log lines are dropped
+    """
+    def __init__(self) -> None:
+        self.events: List[OutputEvent] = []
+        # Time to stamp events with, e.g. how far into a recording the frame being processed is. If None, events are
+        # stamped with time.monotonic()
+        self.time: Optional[float] = None
+
+    def emit(self, kind: str, key: str = '') -> None:
+        self.events.append(OutputEvent(time.monotonic() if self.time is None else self.time, kind, key))
+
+    def log(self, message: str) -> None:
+        pass
+
+
+class KeyboardBackend(OutputBackend):
+    """Key events, sent to the OS with the `keyboard` module. Mouse events are ignored
+    """
+    def __init__(self) -> None:
+        import keyboard
+        self.keyboard = keyboard
+
+    def emit(self, kind: str, key: str = '') -> None:
+        if kind == 'press':
+            self.keyboard.press(key)
+        elif kind == 'release':
+            self.keyboard.release(key)
+        elif kind == 'send':
+            self.keyboard.send(key)
+
+
+class MouseBackend(OutputBackend):
+    """Mouse events, sent to the OS by VirtualMouse, with held directions moving the mouse on a MotionEngine. Key
+    events are ignored
+    """
+    DIRECTIONS = {
+        MOUSE_UP_KEY: (0, -1),
+        MOUSE_DOWN_KEY: (0, 1),
+        MOUSE_LEFT_KEY: (-1, 0),
+        MOUSE_RIGHT_KEY: (1, 0),
+    }
+
+    def __init__(self, motion: MotionEngine = None) -> None:
+        self.motion = motion or MotionEngine()
+
+    def emit(self, kind: str, key: str = '') -> None:
+        if kind == 'hold_mouse':
+            self.motion.steer(*self.DIRECTIONS[key])
+        elif kind == 'release_mouse':
+            self.motion.stop()
+        elif kind == 'click_mouse':
+            VirtualMouse.left_click()
+
+    def close(self) -> None:
+        self.motion.close()
+        if self.motion.ticks:
+            self.log(self.motion.stats_line())
+
+
+class MultiBackend(OutputBackend):
+    """Sends every event to each of several backends
+    """
+    def __init__(self, backends: List[OutputBackend]) -> None:
+        self.backends = backends
+
+    def emit(self, kind: str, key: str = '') -> None:
+        for backend in self.backends:
+            backend.emit(kind, key)
+
+    def close(self) -> None:
+        for backend in self.backends:
+            backend.close()
+
+
+class ThreadedBackend(OutputBackend):
+    """Sends events through another backend on a worker thread, so a slow OS call never holds up the DSP loop
+
+    Events wait in a queue, where ones made redundant by a newer event are coalesced away before they're sent:
+    releasing a key and pressing it again leaves it held, a key pressed (or released) twice is only pressed once, and
+    only the latest of several mouse holds and releases counts. Log lines are sent in order with the events, but never
+    coalesced. If `queue_len` items are already waiting, the oldest log line (or latency callback) is dropped to make
+    room and counted in `dropped_events`. Key and mouse events are never dropped, since losing a release would leave a
+    key held: if nothing else is waiting, the caller waits for the worker to send one, counted in `stalls`.
+    """
+    # Kinds of event which only change what's held, so a newer one can make an older one redundant
+    STATE_KINDS = ('press', 'release', 'hold_mouse', 'release_mouse')
+
+    def __init__(self, backend: OutputBackend, queue_len: int = 256) -> None:
+        self.backend = backend
+        # (kind, key) pairs, plus ('log', message) and ('call', (func, args)) items
+        self.pending = collections.deque()
+        self.queue_len = queue_len
+        self.ready = threading.Condition()
+        self.running = True
+        self.dropped_events = 0
+        self.stalls = 0
+        self.coalesced_events = 0
+        self.thread = threading.Thread(target=self._run, name='offkeyboard-output', daemon=True)
+        self.thread.start()
+
+    def emit(self, kind: str, key: str = '') -> None:
+        with self.ready:
+            if not self._coalesce(kind, key):
+                self._put(kind, key)
+
+    def log(self, message: str) -> None:
+        with self.ready:
+            self._put('log', message)
+
+    def when_sent(self, func: Callable, *args) -> None:
+        with self.ready:
+            self._put('call', (func, args))
+
+    def close(self) -> None:
+        with self.ready:
+            self.running = False
+            self.ready.notify()
+        self.thread.join()
+        self.backend.close()
+
+    def _put(self, kind: str, payload) -> None:
+        if len(self.pending) >= self.queue_len:
+            self._make_room()
+        self.pending.append((kind, payload))
+        self.ready.notify()
+
+    def _make_room(self) -> None:
+        """Drop the oldest item which isn't a key or mouse event, or wait for the worker to send something
+        """
+        for i, (kind, _) in enumerate(self.pending):
+            if kind not in self.STATE_KINDS:
+                del self.pending[i]
+                self.dropped_events += 1
+                return
+        self.stalls += 1
+        while len(self.pending) >= self.queue_len and self.thread.is_alive():
+            self.ready.wait()
+
+    def _coalesce(self, kind: str, key: str) -> bool:
+        """Fold an event into the last one still waiting, if that makes either redundant
+        Returns whether the event was dealt with.
+        """
+        if kind not in self.STATE_KINDS:
+            return False
+        # Log lines don't hold anything down, so look past them
+        for i in range(len(self.pending) - 1, -1, -1):
+            last_kind, last_key = self.pending[i]
+            if last_kind in self.STATE_KINDS:
+                break
+            if last_kind != 'log' and last_kind != 'call':
+                return False
+        else:
+            return False
+
+        if (last_kind, last_key) == (kind, key):
+            self.coalesced_events += 1
+        elif (last_kind, kind) == ('release', 'press') and last_key == key:
+            del self.pending[i]
+            self.coalesced_events += 2
+        elif last_kind in ('hold_mouse', 'release_mouse') and kind in ('hold_mouse', 'release_mouse'):
+            self.pending[i] = (kind, key)
+            self.coalesced_events += 1
+        else:
+            return False
+        return True
+
+    def _run(self) -> None:
+        while True:
+            with self.ready:
+                while self.running and not self.pending:
+                    self.ready.wait()
+                if not self.pending:
+                    return
+                kind, payload = self.pending.popleft()
+                # Something may be waiting for room in the queue
+                self.ready.notify_all()
+            if kind == 'log':
+                self.backend.log(payload)
+            elif kind == 'call':
+                func, args = payload
+                func(*args)
+            else:
+                self.backend.emit(kind, payload)
+
+
+def os_backend() -> ThreadedBackend:
+    """The OS keyboard and mouse, sent to from a worker thread
+    """
+    return ThreadedBackend(MultiBackend([KeyboardBackend(), MouseBackend()]))
@@ -0,0 +1,43 @@
+"""Threaded capture -> DSP -> output pipeline
+
+Capture happens on PyAudio's callback thread, pitch estimation on a DSP worker, and key/mouse events and logging on
+a ThreadedBackend's worker. Each stage hands off to the next through a bounded queue, so a slow OS input call can delay
+key events, but can never stall capture or analysis.
+"""
+import threading
+
+from output import ThreadedBackend
+
+
+class Pipeline:
+    """Runs an AudioProcessor on a DSP worker thread, fed by a callback-driven capture provider
+    """
+    def __init__(self, processor, capture, output: ThreadedBackend, stats_interval: float = 10.0) -> None:
+        """`processor` must read its frames from `capture` (possibly through a decimator), and its NoteReader must
+        send its events to `output`
+        """
+        self.processor = processor
+        self.capture = capture
+        self.output = output
+        self.stats_interval = stats_interval
+        self.dsp_thread = threading.Thread(target=processor.process_audio_forever, name='offkeyboard-dsp', daemon=True)
+
+    def stats_line(self) -> str:
+        return (f'frames dropped: {self.capture.dropped_frames}\t'
+                f'late: {self.capture.late_frames}\t'
+                f'input overflows: {self.capture.input_overflows}\t'
+                f'output stalls: {self.output.stalls}\t'
+                f'log lines dropped: {self.output.dropped_events}\t'
+                f'coalesced: {self.output.coalesced_events}')
+
+    def run_forever(self) -> None:
+        self.dsp_thread.start()
+        try:
+            while self.dsp_thread.is_alive():
+                self.dsp_thread.join(self.stats_interval)
+                self.output.log(self.stats_line())
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.output.close()
+            print(self.stats_line())
@@ -0,0 +1,435 @@
+from abc import ABC, abstractmethod
+from typing import Callable, Dict, Optional, Tuple, Type
+
+import numpy as np
+from scipy.fft import rfft, irfft, next_fast_len
+
+from config import NOTE_MIN, NOTE_MAX, FRAMES_PER_YIN_WINDOW, YIN_THRESHOLD
+from dsp import SAMPLES_PER_FFT, ANALYSIS_SAMPLES_PER_FRAME, autocorr_peak
+from parabolic import parabolic
+from note_utils import number_to_freq
+
+# The range of fundamentals the instrument can produce, padded by a semitone on either side so notes at the very
+# edges of the range still have a peak (and its neighbours) inside the search window
+INSTRUMENT_MIN_FREQ = number_to_freq(NOTE_MIN - 1)
+INSTRUMENT_MAX_FREQ = number_to_freq(NOTE_MAX + 1)
+
+
+def periodicity(height, lag, energy, window_size: int):
+    """How periodic a window is, from 0 to 1, given the height of its autocorrelation peak at `lag` and its energy
+    A biased autocorrelation only sums `window_size - lag` products at that lag, so without rescaling even a perfectly
+    periodic window could never score more than (window_size - lag) / window_size, which is far below 1 for low notes
+    in short windows. Rescaling makes the score mean the same thing at every window size. Works on arrays too.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.clip(height / energy * window_size / np.maximum(window_size - lag, 1), 0.0, 1.0)
+
+
+class PitchEstimator(ABC):
+    """Protocol for turning a window of audio samples into a fundamental frequency
+    Implementations can keep whatever state they like between calls.
+    """
+    # How many samples the estimator looks at, unless told otherwise
+    DEFAULT_WINDOW_SIZE = SAMPLES_PER_FFT
+    # Whether the estimator's confidence is reliable enough for NoteReader to commit a note on it, without votes
+    EARLY_COMMIT = True
+
+    def __init__(self, sample_rate: float, window_size: int) -> None:
+        self.sample_rate = sample_rate
+        self.window_size = window_size
+        # How sure the estimator was about its last estimate, from 0 (noise) to 1 (perfectly periodic)
+        self.confidence = 0.0
+
+    @abstractmethod
+    def estimate(self, sig: np.ndarray) -> float:
+        """Estimate the fundamental frequency (in Hz) of a window of `window_size` samples
+        """
+        pass
+
+    def push_frame(self, history: np.ndarray, frame_len: int) -> None:
+        """Called for every frame that enters the analysis window, whether or not it is estimated
+        `history` holds `window_size + frame_len` samples: the frame that just left the window, then the current
+        window (which ends with the frame that just arrived). Stateless estimators ignore this.
+        """
+        pass
+
+    def estimate_batch(self, windows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Estimate the fundamental of each row of a 2D array of windows, for offline analysis
+        Returns an array of frequencies and an array of confidences. Estimators which can vectorize this should.
+        """
+        freqs = np.empty(len(windows))
+        confidences = np.empty(len(windows))
+        for i, window in enumerate(windows):
+            freqs[i] = self.estimate(window)
+            confidences[i] = self.confidence
+        return freqs, confidences
+
+
+PITCH_ESTIMATORS: Dict[str, Type[PitchEstimator]] = {}
+
+
+def register_estimator(name: str) -> Callable[[Type[PitchEstimator]], Type[PitchEstimator]]:
+    """Class decorator which makes an estimator available as `name`, to make_pitch_estimator() and PITCH_ESTIMATOR
+    """
+    def register(estimator_cls: Type[PitchEstimator]) -> Type[PitchEstimator]:
+        if name in PITCH_ESTIMATORS:
+            raise ValueError(f'A pitch estimator named {name} is already registered')
+        PITCH_ESTIMATORS[name] = estimator_cls
+        return estimator_cls
+    return register
+
+
+@register_estimator('autocorr')
+class AutocorrEstimator(PitchEstimator):
+    """The original full-length autocorrelation estimator
+
+    It takes the highest peak as the period, so while the window still holds the end of the last note, it can settle
+    confidently on an octave, or a pitch the two notes share, for several frames. Its confidence still drives the noise
+    gate, but is never used to commit notes early.
+    """
+    EARLY_COMMIT = False
+    def estimate(self, sig: np.ndarray) -> float:
+        px, py, energy = autocorr_peak(sig)
+        self.confidence = float(periodicity(py, px, energy, len(sig))) if energy > 0 else 0.0
+        return self.sample_rate / px
+
+
+@register_estimator('lag_window')
+class LagWindowAutocorrelator(PitchEstimator):
+    """Autocorrelation estimator which only computes and searches the lags the instrument can produce
+
+    The autocorrelation is computed as the inverse transform of the power spectrum. Since we only need lags up to
+    `max_lag`, the signal only has to be zero-padded by `max_lag` samples (rather than doubled in length) to keep
+    the circular correlation from wrapping around into the lags we look at. The transform length is fixed, so the
+    FFT plan is reused on every frame, and everything stays in float32.
+    """
+    def __init__(self,
+                 sample_rate: float,
+                 window_size: int,
+                 min_freq: float = INSTRUMENT_MIN_FREQ,
+                 max_freq: float = INSTRUMENT_MAX_FREQ,
+                 peak_threshold: float = 0.9) -> None:
+        super(LagWindowAutocorrelator, self).__init__(sample_rate, window_size)
+        # The earliest peak at least this close to the highest one is taken as the period
+        self.peak_threshold = peak_threshold
+        self.min_lag = max(1, int(np.floor(sample_rate / max_freq)))
+        self.max_lag = min(window_size - 2, int(np.ceil(sample_rate / min_freq)))
+        self.fft_size = next_fast_len(window_size + self.max_lag + 1, real=True)
+
+    def lag_window_autocorr(self, sig: np.ndarray) -> np.ndarray:
+        """Autocorrelation of `sig` for lags 0 through max_lag + 1
+        Also accepts a 2D array of windows, returning one row of lags per window.
+        """
+        spectrum = rfft(sig.astype(np.float32, copy=False), n=self.fft_size)
+        power = spectrum.real * spectrum.real + spectrum.imag * spectrum.imag
+        return irfft(power, n=self.fft_size)[..., :self.max_lag + 2]
+
+    def periods_from_autocorr(self, corr: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Pick the period out of each row of lags, returning (period in samples, confidence) arrays
+        Periods are 0 for rows with no energy.
+        """
+        rows = np.arange(len(corr))
+        lags = np.arange(corr.shape[1])
+        energy = corr[:, 0]
+
+        # Skip over the lobe around 0 lag: find the first low point, then the highest peak after it
+        rising = np.diff(corr, axis=1) > 0
+        first_rise = np.where(rising.any(axis=1), rising.argmax(axis=1), self.min_lag)
+        start = np.minimum(self.max_lag, np.maximum(self.min_lag, first_rise))
+        in_search = (lags >= start[:, np.newaxis]) & (lags <= self.max_lag)
+        highest = np.where(in_search, corr, -np.inf).argmax(axis=1)
+
+        # When a period spans only a few samples (as in decimated audio), the peak at twice the period can be sampled
+        # closer to its top than the real one, and come out higher. Prefer the earliest peak that's nearly as high.
+        middle = corr[:, 1:-1]
+        is_peak = (middle >= corr[:, :-2]) & (middle >= corr[:, 2:]) & (lags[1:-1] > start[:, np.newaxis]) \
+            & (lags[1:-1] <= self.max_lag) & (middle >= self.peak_threshold * corr[rows, highest][:, np.newaxis])
+        peak = np.where(is_peak.any(axis=1), np.minimum(highest, is_peak.argmax(axis=1) + 1), highest)
+
+        # Quadratic interpolation of the true peak position, as in parabolic()
+        left, centre, right = corr[rows, peak - 1], corr[rows, peak], corr[rows, peak + 1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            px = 0.5 * (left - right) / (left - 2 * centre + right) + peak
+            py = centre - 0.25 * (left - right) * (px - peak)
+        confidence = periodicity(py, px, energy, self.window_size)
+        voiced = energy > 0
+        return np.where(voiced, px, 0.0), np.where(voiced, confidence, 0.0)
+
+    def estimate(self, sig: np.ndarray) -> float:
+        # This follows the same steps as periods_from_autocorr(), but on a single window plain indexing is several
+        # times cheaper than the masked array operations
+        corr = self.lag_window_autocorr(sig)
+        if corr[0] <= 0:
+            self.confidence = 0.0
+            return 0.0
+
+        # Skip over the lobe around 0 lag: find the first low point, then the highest peak after it
+        rising = np.flatnonzero(np.diff(corr) > 0)
+        start = self.min_lag
+        if len(rising):
+            start = min(self.max_lag, max(start, rising[0]))
+        search = corr[start:self.max_lag + 2]
+        peak = int(np.argmax(search[:-1]))
+        # See periods_from_autocorr() for why we look for an earlier peak
+        is_peak = (search[1:-1] >= search[:-2]) & (search[1:-1] >= search[2:])
+        candidates = np.flatnonzero(is_peak & (search[1:-1] >= self.peak_threshold * search[peak]))
+        if len(candidates):
+            peak = min(peak, int(candidates[0]) + 1)
+        peak += start
+        px, py = parabolic(corr, peak)
+
+        self.confidence = float(periodicity(py, px, corr[0], self.window_size))
+        return self.sample_rate / px
+
+    def estimate_batch(self, windows: np.ndarray, batch_size: int = 64) -> Tuple[np.ndarray, np.ndarray]:
+        periods = np.empty(len(windows))
+        confidences = np.empty(len(windows))
+        # Transform a batch of windows at a time, to bound how much memory the spectra take up
+        for i in range(0, len(windows), batch_size):
+            batch = slice(i, i + batch_size)
+            periods[batch], confidences[batch] = self.periods_from_autocorr(self.lag_window_autocorr(windows[batch]))
+        with np.errstate(divide='ignore'):
+            freqs = np.where(periods > 0, self.sample_rate / periods, 0.0)
+        return freqs, confidences
+
+
+@register_estimator('sliding')
+class SlidingAutocorrelator(LagWindowAutocorrelator):
+    """Lag-window autocorrelator which updates its lag sums incrementally as frames slide through the window
+
+    Each incoming frame adds the products it forms with the samples before it, and the frame leaving the window
+    subtracts the products it formed with the samples after it, so the per-frame cost scales with the frame length
+    rather than the window length. Rounding errors accumulate in the running sums, so every `resync_interval` frames
+    they're thrown away and recomputed from scratch.
+    """
+    def __init__(self, sample_rate: float, window_size: int, resync_interval: int = 64, **kwargs) -> None:
+        super(SlidingAutocorrelator, self).__init__(sample_rate, window_size, **kwargs)
+        self.resync_interval = resync_interval
+        self.frames_since_resync = 0
+        self.lag_sums = np.zeros(self.max_lag + 2, dtype=np.float64)
+
+    def push_frame(self, history: np.ndarray, frame_len: int) -> None:
+        if frame_len == 0:
+            return
+        window = history[frame_len:]
+        self.frames_since_resync += 1
+        if self.frames_since_resync >= self.resync_interval:
+            self.resync(window)
+            return
+
+        lags = len(self.lag_sums) - 1
+        n = self.window_size
+        # Products between the expired frame and the samples that followed it
+        expired = history[:frame_len + lags].astype(np.float64)
+        self.lag_sums -= np.correlate(expired, expired[:frame_len], mode='valid')
+        # Products between the new frame and the samples that preceded it
+        arrived = history[n - lags:n + frame_len].astype(np.float64)
+        self.lag_sums += np.correlate(arrived, arrived[lags:], mode='valid')[::-1]
+
+    def resync(self, window: np.ndarray) -> None:
+        """Recompute the lag sums from scratch, discarding any accumulated drift
+        """
+        self.lag_sums[:] = super(SlidingAutocorrelator, self).lag_window_autocorr(window)
+        self.frames_since_resync = 0
+
+    def lag_window_autocorr(self, sig: np.ndarray) -> np.ndarray:
+        if sig.ndim > 1:
+            # Batches of windows don't arrive through push_frame, so compute them from scratch
+            return super(SlidingAutocorrelator, self).lag_window_autocorr(sig)
+        # The sums were already brought up to date by push_frame, so the window itself isn't needed
+        return self.lag_sums
+
+
+@register_estimator('yin')
+class YinEstimator(PitchEstimator):
+    """YIN estimator (de Cheveigné & Kawahara, 2002), which works on windows only a few periods long
+
+    The difference function d(t) = sum((x[j] - x[j+t])^2) is built from a cross-correlation plus running energies,
+    then normalized by its cumulative mean. The first dip below `threshold` is taken as the period, which avoids the
+    octave errors that picking the deepest dip would make. The depth of that dip gives the confidence, but a dip an
+    octave out can be just as deep, so it's never used to commit notes early.
+    """
+    DEFAULT_WINDOW_SIZE = ANALYSIS_SAMPLES_PER_FRAME * FRAMES_PER_YIN_WINDOW
+    EARLY_COMMIT = False
+
+    def __init__(self,
+                 sample_rate: float,
+                 window_size: int,
+                 min_freq: float = INSTRUMENT_MIN_FREQ,
+                 max_freq: float = INSTRUMENT_MAX_FREQ,
+                 threshold: float = YIN_THRESHOLD) -> None:
+        super(YinEstimator, self).__init__(sample_rate, window_size)
+        self.threshold = threshold
+        self.min_lag = max(2, int(np.floor(sample_rate / max_freq)))
+        self.max_lag = int(np.ceil(sample_rate / min_freq)) + 1
+        # Each lag compares `integration_size` samples with the same number of samples `lag` later
+        self.integration_size = window_size - self.max_lag - 1
+        if self.integration_size < self.max_lag:
+            raise ValueError(f'A window of {window_size} samples is too short to find periods of {self.max_lag} samples')
+        self.fft_size = next_fast_len(window_size, real=True)
+        self.lags = np.arange(self.max_lag + 1, dtype=np.float32)
+
+    def difference(self, sig: np.ndarray) -> np.ndarray:
+        """The YIN difference function of `sig` for lags 0 through max_lag
+        """
+        sig = sig.astype(np.float32, copy=False)
+        n = self.integration_size
+        lags = self.max_lag + 1
+        # Cross-correlation of the first n samples against the whole window
+        corr = irfft(np.conj(rfft(sig[:n], n=self.fft_size)) * rfft(sig, n=self.fft_size), n=self.fft_size)[:lags]
+        # Energy of each n-sample stretch starting at every lag
+        energy = np.cumsum(np.square(sig[:n + lags], dtype=np.float64))
+        energy_at_lag = energy[n - 1:n - 1 + lags] - np.concatenate(([0.0], energy[:lags - 1]))
+        return energy[n - 1] + energy_at_lag - 2 * corr
+
+    def estimate(self, sig: np.ndarray) -> float:
+        diff = self.difference(sig)
+        # Cumulative mean normalized difference
+        running = np.cumsum(diff[1:])
+        cmnd = np.ones_like(diff)
+        np.divide(diff[1:] * self.lags[1:], running, out=cmnd[1:], where=running > 0)
+
+        search = cmnd[self.min_lag:self.max_lag]
+        below = np.flatnonzero(search < self.threshold)
+        if len(below):
+            lag = int(below[0]) + self.min_lag
+            # Walk down to the bottom of this dip
+            while lag + 1 < self.max_lag and cmnd[lag + 1] < cmnd[lag]:
+                lag += 1
+        else:
+            lag = int(np.argmin(search)) + self.min_lag
+
+        self.confidence = float(min(1.0, max(0.0, 1.0 - cmnd[lag])))
+        if cmnd[lag] >= 1.0:
+            # Nothing in the window looks periodic
+            return 0.0
+        px, _ = parabolic(cmnd, lag)
+        return self.sample_rate / px
+
+
+@register_estimator('fft_peak')
+class FFTPeakEstimator(PitchEstimator):
+    """Takes the strongest spectral peak within the instrument's range as the fundamental
+
+    The window is tapered to keep leakage from burying quiet peaks, and the peak's position is refined by quadratic
+    interpolation of the log magnitude spectrum. This is the cheapest estimator, but on notes whose harmonics are
+    louder than the fundamental it will pick a harmonic, and so be an octave (or more) out.
+    """
+    def __init__(self,
+                 sample_rate: float,
+                 window_size: int,
+                 min_freq: float = INSTRUMENT_MIN_FREQ,
+                 max_freq: float = INSTRUMENT_MAX_FREQ) -> None:
+        super(FFTPeakEstimator, self).__init__(sample_rate, window_size)
+        self.taper = np.blackman(window_size).astype(np.float32)
+        self.fft_size = next_fast_len(window_size, real=True)
+        self.bin_width = sample_rate / self.fft_size
+        # Search these bins, plus one on either side so a peak at the edge still has neighbours to interpolate with
+        self.min_bin = max(1, int(np.floor(min_freq / self.bin_width)))
+        self.max_bin = min(self.fft_size // 2 - 1, int(np.ceil(max_freq / self.bin_width)))
+
+    def estimate(self, sig: np.ndarray) -> float:
+        spectrum = np.abs(rfft(sig.astype(np.float32, copy=False) * self.taper, n=self.fft_size)
+                          [self.min_bin - 1:self.max_bin + 2])
+        peak = int(np.argmax(spectrum[1:-1])) + 1
+        if spectrum[peak] <= 0:
+            self.confidence = 0.0
+            return 0.0
+
+        # How much of the in-range energy sits in the peak
+        power = np.square(spectrum[1:-1], dtype=np.float64)
+        self.confidence = float(min(1.0, np.sum(power[max(0, peak - 2):peak + 1]) / np.sum(power)))
+
+        px, _ = parabolic(np.log(spectrum[peak - 1:peak + 2] + 1e-12), 1)
+        return (self.min_bin - 1 + peak + px - 1) * self.bin_width
+
+
+@register_estimator('harmonic_sum')
+class HarmonicSumEstimator(PitchEstimator):
+    """Multi-pitch estimator which scores every note in the instrument's range by the sum of its harmonics' magnitudes
+
+    The best-scoring note is taken, its harmonics are cancelled out of the spectrum, and the notes are scored again
+    to find the next one, until `max_notes` are found or the best remaining score falls below `relative_threshold`
+    of the first note's. Every note's harmonic bins are worked out up front, so scoring is a single gather and a
+    matrix product, and a frame costs one forward FFT, less than the autocorrelation estimators.
+
+    A note an octave (or twelfth, or two octaves) above another shares all of its harmonics with the lower note, so
+    it is cancelled along with it and can't be detected.
+    """
+    def __init__(self,
+                 sample_rate: float,
+                 window_size: int,
+                 max_notes: int = 1,
+                 harmonics: int = 5,
+                 relative_threshold: float = 0.3,
+                 note_min: int = NOTE_MIN,
+                 note_max: int = NOTE_MAX) -> None:
+        super(HarmonicSumEstimator, self).__init__(sample_rate, window_size)
+        self.max_notes = max_notes
+        self.relative_threshold = relative_threshold
+        self.taper = np.hanning(window_size).astype(np.float32)
+        self.fft_size = next_fast_len(window_size, real=True)
+        self.bin_width = sample_rate / self.fft_size
+        self.candidates = np.arange(note_min, note_max + 1)
+
+        # For each candidate's harmonics, the bins within a quarter of a semitone of it. Ranges are padded to the same
+        # width by repeating their last bin, which doesn't change their maximum
+        tolerance = 2 ** (1 / 48)
+        centres = number_to_freq(self.candidates)[:, np.newaxis] * np.arange(1, harmonics + 1)
+        low = np.floor(centres / tolerance / self.bin_width).astype(int)
+        high = np.maximum(low, np.ceil(centres * tolerance / self.bin_width).astype(int))
+        width = int(np.max(high - low)) + 1
+        self.harmonic_bins = np.minimum(low[..., np.newaxis] + np.arange(width), high[..., np.newaxis])
+        self.harmonic_bins = np.minimum(self.harmonic_bins, self.fft_size // 2)
+        # The distinct bins each candidate's harmonics cover, to cancel once the candidate is found
+        self.cancel_bins = [np.unique(bins) for bins in self.harmonic_bins]
+        # Higher harmonics count for a little less, which keeps a note's sub-octave from outscoring it
+        self.weights = (1.0 / np.sqrt(np.arange(1, harmonics + 1))).astype(np.float32)
+        # The notes found in the last window, strongest first
+        self.notes: Tuple[int, ...] = ()
+
+    def estimate(self, sig: np.ndarray) -> float:
+        magnitude = np.abs(rfft(sig.astype(np.float32, copy=False) * self.taper, n=self.fft_size))
+        total = float(np.sum(magnitude[self.harmonic_bins[0, 0, 0]:self.harmonic_bins[-1, -1, -1] + 1]))
+        if total <= 0:
+            self.notes = ()
+            self.confidence = 0.0
+            return 0.0
+
+        notes = []
+        freq = 0.0
+        explained = 0.0
+        first_score = 0.0
+        for _ in range(self.max_notes):
+            peaks = magnitude[self.harmonic_bins].max(axis=2)
+            # A note has to have some energy at its fundamental, or a note's sub-octave would be found instead
+            scores = np.where(peaks[:, 0] > 0.1 * peaks.max(axis=1), peaks @ self.weights, 0.0)
+            best = int(np.argmax(scores))
+            if scores[best] <= 0 or scores[best] < self.relative_threshold * first_score:
+                break
+            if not notes:
+                first_score = scores[best]
+                # Refine the first note's frequency from its fundamental's peak
+                bins = self.harmonic_bins[best, 0]
+                peak_bin = int(bins[np.argmax(magnitude[bins])])
+                px, _ = parabolic(np.log(magnitude[peak_bin - 1:peak_bin + 2] + 1e-12), 1)
+                freq = (peak_bin + px - 1) * self.bin_width
+            notes.append(int(self.candidates[best]))
+            # Cancel out the note's harmonics before looking for the next one
+            cancelled = self.cancel_bins[best]
+            explained += float(np.sum(magnitude[cancelled]))
+            magnitude[cancelled] = 0.0
+
+        self.notes = tuple(notes)
+        # How much of the magnitude in the instrument's range the notes account for
+        self.confidence = min(1.0, explained / total)
+        return freq
+
+
+def make_pitch_estimator(name: str, sample_rate: float, window_size: Optional[int] = None, **kwargs) -> PitchEstimator:
+    """Create a registered estimator. Any keyword arguments are handed on to its constructor
+    """
+    if name not in PITCH_ESTIMATORS:
+        raise ValueError(f'Unknown pitch estimator {name}, choose from: {", ".join(PITCH_ESTIMATORS)}')
+    estimator_cls = PITCH_ESTIMATORS[name]
+    return estimator_cls(sample_rate, window_size or estimator_cls.DEFAULT_WINDOW_SIZE, **kwargs)
@@ -0,0 +1,91 @@
+from typing import Callable, Optional
+
+import numpy as np
+
+
+class AudioRingBuffer:
+    """Preallocated circular buffer holding the most recent audio samples
+
+    Storage is kept twice over (a "mirrored" ring), so the newest `n` samples are always available as a
+    contiguous view without shifting data around. Each write costs two copies of the written samples, no matter
+    how large the buffer is.
+
+    If `energy_window` is set, the sum of squares of the newest `energy_window` samples is kept up to date in
+    `energy`, by adding the samples each write brings in and taking out the ones it pushes out of the window.
+    """
+    def __init__(self, capacity: int, dtype=np.float32, energy_window: int = 0) -> None:
+        if energy_window > capacity:
+            raise ValueError(f'Cannot track the energy of {energy_window} samples in a ring buffer of {capacity} '
+                             f'samples')
+        self.capacity = capacity
+        self._storage = np.zeros(capacity * 2, dtype=dtype)
+        self._cursor = 0
+        # Total number of samples that have ever been committed to the buffer
+        self.samples_written = 0
+        self.energy_window = energy_window
+        self.energy = 0.0
+        # Samples committed since `energy` was last summed from scratch, to stop rounding errors building up
+        self._energy_age = 0
+
+    def writable(self, n: int) -> np.ndarray:
+        """Get a view of the next `n` slots of the buffer, so a producer can write into them directly.
+        The data becomes visible to readers once `commit(n)` is called.
+        """
+        if n > self.capacity:
+            raise ValueError(f'Cannot write {n} samples into a ring buffer of {self.capacity} samples')
+        return self._storage[self._cursor:self._cursor + n]
+
+    def commit(self, n: int) -> None:
+        """Publish `n` samples previously written into the view returned by `writable(n)`
+        """
+        start = self._cursor
+        end = start + n
+        cap = self.capacity
+        # Mirror the freshly written samples into the other half of the storage
+        if end <= cap:
+            self._storage[start + cap:end + cap] = self._storage[start:end]
+        else:
+            self._storage[start + cap:] = self._storage[start:cap]
+            self._storage[:end - cap] = self._storage[cap:end]
+        self._cursor = end % cap
+        self.samples_written += n
+        if self.energy_window:
+            self._update_energy(n)
+
+    def _update_energy(self, n: int) -> None:
+        self._energy_age += n
+        if self._energy_age >= self.capacity or self.energy_window + n > self.capacity:
+            # Every so often, or when the samples leaving the window have already been overwritten, start afresh
+            window = self.latest(self.energy_window)
+            self.energy = float(np.dot(window, window))
+            self._energy_age = 0
+            return
+        recent = self.latest(self.energy_window + n)
+        entered = recent[self.energy_window:]
+        left = recent[:n]
+        self.energy = max(0.0, self.energy + float(np.dot(entered, entered)) - float(np.dot(left, left)))
+
+    def write(self, samples: np.ndarray, transform: Optional[Callable[[np.ndarray], None]] = None) -> None:
+        """Copy a frame of samples into the buffer, converting it to the buffer's dtype on the way in
+        If given, `transform` is run in place over the written samples before they're committed.
+        """
+        n = len(samples)
+        slot = self.writable(n)
+        slot[:] = samples
+        if transform:
+            transform(slot)
+        self.commit(n)
+
+    def latest(self, n: int) -> np.ndarray:
+        """Contiguous view of the newest `n` samples, oldest first
+        """
+        if n > self.capacity:
+            raise ValueError(f'Cannot read {n} samples from a ring buffer of {self.capacity} samples')
+        end = self._cursor + self.capacity
+        return self._storage[end - n:end]
+
+    @property
+    def window(self) -> np.ndarray:
+        """Contiguous view of the entire buffer, oldest sample first
+        """
+        return self.latest(self.capacity)
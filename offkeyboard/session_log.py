@@ -0,0 +1,297 @@
+"""Always-on session log, to replay exactly what the pipeline heard and decided
+
+Every raw frame from the microphone is written to disk, along with what the NoteDetector made of it and the events
+the NoteReader sent in response. The log is split into segment files, and once they add up to more than `max_bytes`
+the oldest are deleted, so only the most recent audio is kept. Writing happens on a background thread: the
+DSP loop only copies the frame into a bounded queue, and if the disk falls behind, frames are dropped from the log
+(and counted) rather than holding up analysis.
+
+Segments are self-contained: each starts with a header giving the sample rate, followed by one record per frame:
+
+    capture time (f8), frequency (f4), confidence (f4), note (i2), event bytes (u2), samples (u4), events, samples
+
+Events are 'kind key' lines, padded to an even length so the int16 samples stay aligned. A record cut short by a
+crash is ignored. Replay the log as fast as the CPU allows, checking the notes come out the same, with:
+
+    python offkeyboard/session_log.py [directory]     # SESSION_LOG_DIR by default
+"""
+import os
+import queue
+import struct
+import sys
+import threading
+import time
+from collections import namedtuple
+from typing import Callable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+from frame_provider import FrameProvider
+from frame_queue import FrameQueue
+from output import OutputBackend
+
+
+SEGMENT_MAGIC = b'OKSL'
+SEGMENT_VERSION = 1
+SEGMENT_HEADER = struct.Struct('<4sHI')     # magic, version, sample rate
+RECORD_HEADER = struct.Struct('<dffhHI')    # capture time, frequency, confidence, note, event bytes, samples
+# Note recorded for frames the detector didn't analyze, because the window was still filling
+NO_NOTE = -32768
+
+# One frame from the log: the raw samples, and what the pipeline made of them. `note` is None for frames that weren't
+# analyzed, and `events` are (kind, key) pairs
+SessionFrame = namedtuple('SessionFrame', ['capture_time', 'freq', 'confidence', 'note', 'events', 'samples'])
+
+
+def segment_files(directory: str) -> List[str]:
+    """The log's segment files, oldest first
+    """
+    if not os.path.isdir(directory):
+        return []
+    names = sorted(name for name in os.listdir(directory) if name.startswith('session-') and name.endswith('.log'))
+    return [os.path.join(directory, name) for name in names]
+
+
+class SessionRecorder:
+    """Writes frames and the decisions made about them to a rotating, size-capped log in `directory`
+
+    Call start_frame() with each raw frame, add_event() for each event sent in response (or let the backend from
+    wrap_output() do it), then end_frame() once the frame has been analyzed.
+    """
+    def __init__(self,
+                 directory: str,
+                 sample_rate: int,
+                 max_bytes: int = 64 * 2**20,
+                 segment_bytes: int = 8 * 2**20,
+                 queue_frames: int = 256) -> None:
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.max_bytes = max_bytes
+        self.segment_bytes = segment_bytes
+        os.makedirs(directory, exist_ok=True)
+        existing = segment_files(directory)
+        # Carry on numbering from the last session, so segments sort oldest first
+        self.next_segment = int(os.path.basename(existing[-1])[len('session-'):-len('.log')]) + 1 if existing else 0
+        self.segment = None
+        self.segment_size = 0
+
+        self.records = FrameQueue(queue_frames)
+        self.frame: Optional[bytes] = None
+        self.capture_time = 0.0
+        self.events: List[str] = []
+        self.bytes_written = 0
+        self.running = True
+        self.thread = threading.Thread(target=self._run, name='offkeyboard-session-log', daemon=True)
+        self.thread.start()
+
+    @property
+    def dropped_frames(self) -> int:
+        """Frames left out of the log because the writer thread fell behind
+        """
+        return self.records.dropped
+
+    def wrap_output(self, output: OutputBackend) -> OutputBackend:
+        """Wrap a NoteReader's output backend, so the events it's sent are logged with the frame they were sent for
+        """
+        return SessionBackend(self, output)
+
+    def start_frame(self, frame: np.ndarray, capture_time: float) -> None:
+        self.frame = frame.astype(np.int16, copy=False).tobytes()
+        self.capture_time = capture_time
+        self.events = []
+
+    def add_event(self, kind: str, key: str) -> None:
+        self.events.append(f'{kind} {key}')
+
+    def end_frame(self, note: Optional[int], freq: float = 0.0, confidence: float = 0.0) -> None:
+        """Queue the current frame to be written, with the note detected in it (None if it wasn't analyzed)
+        """
+        if self.frame is None:
+            return
+        events = '\n'.join(self.events).encode()
+        events += b'\n' * (len(events) % 2)
+        header = RECORD_HEADER.pack(self.capture_time, freq, confidence, NO_NOTE if note is None else note,
+                                    len(events), len(self.frame) // 2)
+        self.records.put(header + events + self.frame)
+        self.frame = None
+
+    def close(self) -> None:
+        """Write out every frame still queued, and close the log
+        """
+        self.running = False
+        self.thread.join()
+
+    def _open_segment(self) -> None:
+        if self.segment is not None:
+            self.segment.close()
+        path = os.path.join(self.directory, f'session-{self.next_segment:06d}.log')
+        self.next_segment += 1
+        self.segment = open(path, 'wb')
+        self.segment.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, SEGMENT_VERSION, self.sample_rate))
+        self.segment_size = SEGMENT_HEADER.size
+        self._enforce_limit()
+
+    def _enforce_limit(self) -> None:
+        """Delete the oldest segments until the log would still fit in max_bytes once the segment being written is full
+        """
+        segments = segment_files(self.directory)[:-1]
+        total = sum(os.path.getsize(path) for path in segments) + self.segment_bytes
+        for path in segments:
+            if total <= self.max_bytes:
+                break
+            total -= os.path.getsize(path)
+            os.remove(path)
+
+    def _write(self, record: bytes) -> None:
+        if self.segment is None or self.segment_size + len(record) > self.segment_bytes:
+            self._open_segment()
+        self.segment.write(record)
+        self.segment_size += len(record)
+        self.bytes_written += len(record)
+
+    def _run(self) -> None:
+        while self.running or len(self.records):
+            try:
+                self._write(self.records.get(timeout=0.1))
+            except queue.Empty:
+                # Nothing to write for now, so let what's been written so far reach the disk
+                if self.segment is not None:
+                    self.segment.flush()
+        if self.segment is not None:
+            self.segment.close()
+
+
+class SessionBackend(OutputBackend):
+    """Passes events on to another backend, logging each one with the frame it was sent for
+    """
+    def __init__(self, recorder: SessionRecorder, backend: OutputBackend) -> None:
+        self.recorder = recorder
+        self.backend = backend
+
+    def emit(self, kind: str, key: str = '') -> None:
+        self.recorder.add_event(kind, key)
+        self.backend.emit(kind, key)
+
+    def log(self, message: str) -> None:
+        self.backend.log(message)
+
+    def when_sent(self, func: Callable, *args) -> None:
+        self.backend.when_sent(func, *args)
+
+    def close(self) -> None:
+        self.backend.close()
+
+
+class RecordingFrameProvider(FrameProvider):
+    """Wraps another frame provider, handing each of its frames to a SessionRecorder on the way through
+    """
+    def __init__(self, source: FrameProvider, recorder: SessionRecorder) -> None:
+        super(RecordingFrameProvider, self).__init__(source.sample_rate, source.samples_per_frame)
+        self.source = source
+        self.recorder = recorder
+
+    def has_frames(self) -> bool:
+        return self.source.has_frames()
+
+    def get_frame(self) -> np.array:
+        frame = self.source.get_frame()
+        self.last_capture_time = self.source.last_capture_time
+        self.recorder.start_frame(frame, self.last_capture_time)
+        return frame
+
+
+def read_segment(path: str) -> Tuple[int, Iterator[SessionFrame]]:
+    """Read a whole segment file, returning its sample rate and its frames
+    The frames' samples are views onto the file's contents, rather than copies.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    magic, version, sample_rate = SEGMENT_HEADER.unpack_from(data)
+    if magic != SEGMENT_MAGIC or version != SEGMENT_VERSION:
+        raise ValueError(f'{path} is not a version {SEGMENT_VERSION} session log segment')
+
+    def frames() -> Iterator[SessionFrame]:
+        offset = SEGMENT_HEADER.size
+        while offset + RECORD_HEADER.size <= len(data):
+            capture_time, freq, confidence, note, event_bytes, samples = RECORD_HEADER.unpack_from(data, offset)
+            offset += RECORD_HEADER.size
+            end = offset + event_bytes + samples * 2
+            if end > len(data):
+                return
+            lines = data[offset:offset + event_bytes].decode().split('\n')
+            events = tuple(tuple(line.split(' ', 1)) for line in lines if line)
+            yield SessionFrame(capture_time, freq, confidence, None if note == NO_NOTE else note, events,
+                               np.frombuffer(data, np.int16, samples, offset + event_bytes))
+            offset = end
+
+    return sample_rate, frames()
+
+
+def read_session(path: str) -> Iterator[SessionFrame]:
+    """Every frame in a session log directory, oldest first, or in a single segment file
+    """
+    for segment in segment_files(path) if os.path.isdir(path) else [path]:
+        yield from read_segment(segment)[1]
+
+
+class SessionReplayFrameProvider(FrameProvider):
+    """Frames read back from a session log, as fast as they're asked for
+    `current` is the SessionFrame most recently handed out, to compare against what the replay makes of it.
+    """
+    def __init__(self, path: str) -> None:
+        segments = segment_files(path) if os.path.isdir(path) else [path]
+        if not segments:
+            raise FileNotFoundError(f'No session log segments in {path}')
+        sample_rate, _ = read_segment(segments[0])
+        self.frames = read_session(path)
+        self.current: Optional[SessionFrame] = None
+        self.next: Optional[SessionFrame] = next(self.frames, None)
+        super(SessionReplayFrameProvider, self).__init__(sample_rate, len(self.next.samples) if self.next else 0)
+
+    def has_frames(self) -> bool:
+        return self.next is not None
+
+    def get_frame(self) -> np.array:
+        self.current, self.next = self.next, next(self.frames, None)
+        self.last_capture_time = time.monotonic()
+        return self.current.samples
+
+
+def replay(path: str) -> None:
+    """Run a session log back through the pipeline, reporting how fast it went and any frames whose note differs
+    """
+    from audio_processor import get_frame_provider, hand_off_note
+    from note_detector import NoteDetector
+    from note_reader import NoteReader
+    from output import RecorderBackend
+
+    source = SessionReplayFrameProvider(path)
+    provider = get_frame_provider(source=source)
+    detector = NoteDetector()
+    note_reader = NoteReader(output=RecorderBackend())
+    frames = filling = mismatches = 0
+    audio_seconds = 0.0
+    start = time.perf_counter()
+    while provider.has_frames():
+        note = detector.detect(provider.read_into(detector.ring_buffer, detector.frame_filter))
+        if note is not None:
+            hand_off_note(detector, note_reader, note)
+        recorded = source.current
+        # Unless the log goes back to the start of the session, the replay's analysis window starts out empty
+        if note is None:
+            filling += 1
+        elif note != recorded.note:
+            mismatches += 1
+            if mismatches <= 10:
+                print(f'frame {frames}: replay detected {note}, the session detected {recorded.note}')
+        frames += 1
+        audio_seconds += len(recorded.samples) / source.sample_rate
+    elapsed = time.perf_counter() - start
+    print(f'{frames} frames ({audio_seconds:.1f}s of audio) in {elapsed:.2f}s, {audio_seconds / elapsed:.0f}x real '
+          f'time. {mismatches} frames detected a different note ({filling} spent filling the analysis window), '
+          f'{len(note_reader.output.events)} events sent')
+
+
+if __name__ == '__main__':
+    from config import SESSION_LOG_DIR
+    replay(sys.argv[1] if len(sys.argv) > 1 else SESSION_LOG_DIR)
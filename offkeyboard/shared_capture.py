@@ -0,0 +1,310 @@
+"""One capture, shared by any number of processes
+
+A capture server reads the microphone and runs pitch estimation once, then publishes every frame, along with what
+the NoteDetector made of it, into a ring of slots in shared memory. The keymapper, a tuner overlay, a stats logger, or
+anything else reads the ring through a SharedMemoryFrameProvider, rather than opening its own stream and running its
+own FFT, so capture and analysis cost the same however many consumers are attached.
+
+The ring is a header, then a metadata record per slot, then the slots' samples:
+
+    header    magic, version, sample rate, samples per frame, slots, closed flag, frames written
+    metadata  sequence number, capture time, frequency, confidence, level, note, attack note, onset, analyzed
+
+Frame n goes into slot n % slots. The server marks the slot's sequence number invalid, writes the frame, stamps the
+slot with n, and only then counts the frame as written. Readers get the frame's samples as a view straight onto the
+ring, and check the slot's sequence number again once they've copied the frame out, so a frame the server overwrote
+while it was being read is counted as torn rather than silently used. A reader which falls more than a ring behind
+skips ahead to the newest frame, counting the frames it missed as dropped.
+
+    python offkeyboard/shared_capture.py serve      # capture and analyze
+    python offkeyboard/shared_capture.py keys       # send key events for the notes the server detects
+    python offkeyboard/shared_capture.py monitor    # print each new note, and how loud it was
+"""
+import sys
+import time
+from collections import namedtuple
+from multiprocessing import resource_tracker, shared_memory
+from typing import Optional
+
+import numpy as np
+
+from config import SAMPLE_RATE, SAMPLES_PER_FRAME, SHARED_CAPTURE_NAME, SHARED_CAPTURE_SLOTS
+from frame_provider import FrameProvider
+from note_utils import SILENCE_NOTE
+
+
+SHARED_MAGIC = b'OKSC'
+SHARED_VERSION = 2
+HEADER_DTYPE = np.dtype([
+    ('magic', 'S4'),
+    ('version', '<u4'),
+    ('sample_rate', '<u4'),
+    ('samples_per_frame', '<u4'),
+    ('slots', '<u4'),
+    ('closed', '<u4'),
+    ('written', '<i8'),
+])
+SLOT_DTYPE = np.dtype([
+    ('sequence', '<i8'),
+    ('capture_time', '<f8'),
+    ('freq', '<f4'),
+    ('confidence', '<f4'),
+    ('level', '<f4'),
+    ('note', '<i2'),
+    ('attack_note', '<i2'),
+    ('onset', 'u1'),
+    ('analyzed', 'u1'),
+])
+
+# What the capture server's NoteDetector made of a frame. `note` is None if the frame wasn't analyzed, because the
+# server's analysis window was still filling. `attack_note` is NoteDetector.attack_note
+SharedAnalysis = namedtuple('SharedAnalysis', ['sequence', 'capture_time', 'freq', 'confidence', 'level', 'note',
+                                               'onset', 'attack_note'])
+
+
+class SharedFrameRing:
+    """Numpy views onto a ring of frames in shared memory, either created by the capture server or attached to
+    """
+    def __init__(self, name: str, create: bool = False, sample_rate: int = 0, samples_per_frame: int = 0,
+                 slots: int = 0) -> None:
+        if create:
+            size = HEADER_DTYPE.itemsize + slots * (SLOT_DTYPE.itemsize + samples_per_frame * 2)
+            try:
+                self.memory = shared_memory.SharedMemory(name, create=True, size=size)
+            except FileExistsError:
+                # Left behind by a server which didn't shut down cleanly
+                stale = shared_memory.SharedMemory(name)
+                stale.close()
+                stale.unlink()
+                self.memory = shared_memory.SharedMemory(name, create=True, size=size)
+        else:
+            self.memory = shared_memory.SharedMemory(name)
+            # Before Python 3.13, attaching registers the memory with this process's resource tracker, which would
+            # unlink it from under the server when we exit
+            resource_tracker.unregister(self.memory._name, 'shared_memory')
+
+        self.header = np.ndarray((), HEADER_DTYPE, self.memory.buf)
+        if create:
+            self.header['magic'] = SHARED_MAGIC
+            self.header['version'] = SHARED_VERSION
+            self.header['sample_rate'] = sample_rate
+            self.header['samples_per_frame'] = samples_per_frame
+            self.header['slots'] = slots
+            self.header['closed'] = 0
+            self.header['written'] = 0
+        elif self.header['magic'] != SHARED_MAGIC or self.header['version'] != SHARED_VERSION:
+            raise ValueError(f'{name} is not a version {SHARED_VERSION} offkeyboard capture ring')
+        self.slots = int(self.header['slots'])
+        self.samples_per_frame = int(self.header['samples_per_frame'])
+        self.meta = np.ndarray((self.slots,), SLOT_DTYPE, self.memory.buf, HEADER_DTYPE.itemsize)
+        self.samples = np.ndarray((self.slots, self.samples_per_frame), np.int16, self.memory.buf,
+                                  HEADER_DTYPE.itemsize + self.meta.nbytes)
+        if create:
+            self.meta['sequence'] = -1
+
+    @property
+    def written(self) -> int:
+        return int(self.header['written'])
+
+    @property
+    def closed(self) -> bool:
+        return bool(self.header['closed'])
+
+    def close(self) -> None:
+        # The views have to go before the memory they look onto can be unmapped
+        del self.header, self.meta, self.samples
+        self.memory.close()
+
+
+class CaptureServer:
+    """Reads frames from a frame provider, analyzes them, and publishes both to a SharedFrameRing called `name`
+    """
+    def __init__(self, frame_provider: FrameProvider, name: str = SHARED_CAPTURE_NAME,
+                 slots: int = SHARED_CAPTURE_SLOTS) -> None:
+        # Channel holds exactly the analysis state one input needs, decimator included
+        from multichannel import Channel
+
+        self.frame_provider = frame_provider
+        self.channel = Channel(note_reader=None)
+        self.ring = SharedFrameRing(name, create=True, sample_rate=int(frame_provider.sample_rate),
+                                    samples_per_frame=frame_provider.samples_per_frame, slots=slots)
+
+    def publish(self, frame: np.ndarray, capture_time: float, note: Optional[int]) -> None:
+        """Write a frame and what the server's NoteDetector made of it into the next slot
+        """
+        ring = self.ring
+        sequence = ring.written
+        slot = sequence % ring.slots
+        meta = ring.meta[slot]
+        meta['sequence'] = -1
+        ring.samples[slot] = frame
+        detector = self.channel.note_detector
+        voiced = note is not None and note != SILENCE_NOTE
+        meta['capture_time'] = capture_time
+        meta['freq'] = detector.freq if voiced else 0.0
+        # What a NoteReader should be given, so consumers commit notes early exactly as the server's estimator allows
+        meta['confidence'] = detector.commit_confidence
+        meta['level'] = detector.level
+        meta['note'] = SILENCE_NOTE if note is None else note
+        meta['attack_note'] = SILENCE_NOTE if detector.attack_note is None else detector.attack_note
+        meta['onset'] = detector.onset
+        meta['analyzed'] = note is not None
+        meta['sequence'] = sequence
+        ring.header['written'] = sequence + 1
+
+    def process_frame(self, frame: np.ndarray, capture_time: float = 0.0) -> None:
+        self.publish(frame, capture_time, self.channel.analyze(frame))
+
+    def serve_forever(self) -> None:
+        try:
+            while self.frame_provider.has_frames():
+                frame = self.frame_provider.get_frame()
+                self.process_frame(frame, self.frame_provider.last_capture_time)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.close()
+
+    def close(self) -> None:
+        """Tell readers no more frames are coming, and remove the ring. Attached readers keep their mapping
+        """
+        self.ring.header['closed'] = 1
+        memory = self.ring.memory
+        self.ring.close()
+        memory.unlink()
+
+
+class SharedMemoryFrameProvider(FrameProvider):
+    """Frames read from a capture server's ring, along with the server's analysis of each, in `analysis`
+
+    Frames are handed out as views onto the ring, which stay valid until the server wraps around to their slot again,
+    `slots` frames later. read_into() copies them straight into the reader's ring buffer, and checks they weren't
+    overwritten meanwhile.
+    """
+    def __init__(self, name: str = SHARED_CAPTURE_NAME, poll_interval: float = 0.001) -> None:
+        """Frames are waited for by checking the ring every `poll_interval` seconds, from just before the next is due
+        """
+        self.ring = SharedFrameRing(name)
+        super(SharedMemoryFrameProvider, self).__init__(int(self.ring.header['sample_rate']),
+                                                        self.ring.samples_per_frame)
+        self.poll_interval = poll_interval
+        self.frame_period = self.samples_per_frame / self.sample_rate
+        # Start from the newest frame, rather than whatever's left from before we attached
+        self.next_sequence = max(0, self.ring.written - 1)
+        self.sequence = -1
+        self.analysis: Optional[SharedAnalysis] = None
+        self.dropped_frames = 0
+        self.torn_frames = 0
+
+    def has_frames(self) -> bool:
+        return not self.ring.closed or self.ring.written > self.next_sequence
+
+    def _next_slot(self) -> int:
+        """Wait for the next frame, returning its slot
+        Raises EOFError if the server shut down first.
+        """
+        ring = self.ring
+        if ring.written <= self.next_sequence:
+            # Sleep through most of the wait for the next frame, so polling only starts just before it's due
+            time.sleep(max(0.0, self.last_capture_time + self.frame_period - self.poll_interval - time.monotonic()))
+        while True:
+            written = ring.written
+            if written > self.next_sequence:
+                break
+            if ring.closed:
+                raise EOFError('The capture server has shut down')
+            time.sleep(self.poll_interval)
+        # The slot after the newest one may be being overwritten right now
+        oldest = written - ring.slots + 1
+        if self.next_sequence < oldest:
+            self.dropped_frames += written - 1 - self.next_sequence
+            self.next_sequence = written - 1
+        self.sequence = self.next_sequence
+        self.next_sequence += 1
+        return self.sequence % ring.slots
+
+    def get_frame(self) -> np.array:
+        slot = self._next_slot()
+        meta = self.ring.meta[slot].copy()
+        if meta['sequence'] != self.sequence:
+            self.torn_frames += 1
+        self.last_capture_time = float(meta['capture_time'])
+        self.analysis = SharedAnalysis(self.sequence, self.last_capture_time, float(meta['freq']),
+                                       float(meta['confidence']), float(meta['level']),
+                                       int(meta['note']) if meta['analyzed'] else None, bool(meta['onset']),
+                                       None if meta['attack_note'] == SILENCE_NOTE else int(meta['attack_note']))
+        return self.ring.samples[slot]
+
+    def frame_intact(self) -> bool:
+        """Whether the frame most recently handed out is still in the ring, untouched
+        """
+        return self.ring.meta[self.sequence % self.ring.slots]['sequence'] == self.sequence
+
+    def read_into(self, ring_buffer, transform=None) -> int:
+        torn_frames = self.torn_frames
+        frame = self.get_frame()
+        ring_buffer.write(frame, transform)
+        # Don't count a frame get_frame() already found overwritten twice
+        if self.torn_frames == torn_frames and not self.frame_intact():
+            self.torn_frames += 1
+        return len(frame)
+
+
+def send_keys(provider: SharedMemoryFrameProvider, note_reader) -> None:
+    """Run a NoteReader on the notes the capture server detects, without analyzing any audio here
+    Only the strongest note of each frame is shared, so chords aren't recognized.
+    """
+    while provider.has_frames():
+        try:
+            provider.get_frame()
+        except EOFError:
+            break
+        analysis = provider.analysis
+        if analysis.note is not None:
+            note_reader.process_note(analysis.note, analysis.confidence, analysis.onset, analysis.attack_note)
+
+
+def monitor(provider: SharedMemoryFrameProvider) -> None:
+    """Print each new note the capture server detects, and how loud it was
+    """
+    from note_utils import format_note
+
+    last_note = None
+    while provider.has_frames():
+        try:
+            provider.get_frame()
+        except EOFError:
+            break
+        analysis = provider.analysis
+        if analysis.note is not None and analysis.note != last_note:
+            last_note = analysis.note
+            name = 'silence' if analysis.note == SILENCE_NOTE else format_note(analysis.note)
+            print(f'{name:<8}{analysis.freq:>8.1f} Hz  level {analysis.level:>10.0f}  '
+                  f'(dropped {provider.dropped_frames}, torn {provider.torn_frames})')
+
+
+def main() -> None:
+    mode = sys.argv[1] if len(sys.argv) > 1 else 'serve'
+    if mode == 'serve':
+        from frame_provider import CallbackMicrophoneFrameProvider
+        CaptureServer(CallbackMicrophoneFrameProvider(SAMPLE_RATE, SAMPLES_PER_FRAME)).serve_forever()
+    elif mode == 'keys':
+        from note_reader import NoteReader
+        note_reader = NoteReader()
+        try:
+            send_keys(SharedMemoryFrameProvider(), note_reader)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            note_reader.output.close()
+    elif mode == 'monitor':
+        try:
+            monitor(SharedMemoryFrameProvider())
+        except KeyboardInterrupt:
+            pass
+    else:
+        print(f'Unknown mode {mode}, choose from: serve, keys, monitor')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+"""Parameter sweep over the settings which trade detection latency against false presses
+
+MIN_VOLUME, FRAMES_PER_FFT and the NoteReader's debounce settings (NOTE_VOTE_WINDOW, NOTE_VOTES_TO_COMMIT and
+EARLY_COMMIT_CONFIDENCE) are swept over a grid, or a random sample of it, against a corpus of labelled recordings (see
+corpus.py for the label format).
+
+Only FRAMES_PER_FFT changes what the pitch estimator sees, so each recording is analyzed once per FRAMES_PER_FFT
+value, with no silence gate, and the per-frame estimates and volumes are cached on disk. Every combination is then
+scored by running the cached volumes through the silence gate with its MIN_VOLUME, and replaying the estimates the
+gate lets through a NoteReader with its vote settings, so a sweep of hundreds of combinations costs little more than
+the analysis itself. Both stages run in a process pool.
+
+The Pareto front of mean detection latency against false presses per minute is printed, and the front's fastest
+combination within `--max-false-rate` is written to tuned_config.json, which config.py loads on startup.
+
+Usage:
+    python offkeyboard/tuner.py path/to/corpus [--random 200] [-j processes] [--max-false-rate 1.0]
+"""
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from config import (
+    SAMPLES_PER_FRAME,
+    DECIMATION_FACTOR,
+    BANDPASS_FILTER,
+    SAMPLE_RATE,
+    MIN_VOLUME,
+    NOISE_GATE,
+    NOISE_GATE_WINDOW,
+    FRAMES_PER_FFT,
+    NOTE_VOTE_WINDOW,
+    NOTE_VOTES_TO_COMMIT,
+    EARLY_COMMIT_CONFIDENCE,
+    TUNED_CONFIG_FILE,
+)
+from corpus import Press, find_recordings, load_labels, recording_note_reader, score_presses, summarize
+from dsp import ANALYSIS_SAMPLES_PER_FRAME, SAMPLES_PER_FFT
+from note_utils import SILENCE_NOTE
+from offline import analysis_estimator, analyze_samples, load_wav, voiced_frames
+from pitch_engine import PITCH_ESTIMATORS
+
+
+DEFAULT_GRID = {
+    'MIN_VOLUME': [25000, 50000, 75000, 100000, 150000, 200000, 300000],
+    'FRAMES_PER_FFT': [4, 6, 8, 12, 16],
+    'NOTE_VOTE_WINDOW': [4, 6, 8, 10],
+    'NOTE_VOTES_TO_COMMIT': [1, 2, 3, 4, 5],
+    # Anything above 1 turns early commits off
+    'EARLY_COMMIT_CONFIDENCE': [0.9, 0.95, 0.98, 1.1],
+}
+
+# What's cached for each analysis, so caches written by older versions get rebuilt. ANALYSIS_VERSION is bumped
+# whenever a cached field changes meaning
+CACHED_FIELDS = ('time', 'note', 'confidence', 'volume', 'onset', 'notes', 'attack_note', 'duration', 'version')
+ANALYSIS_VERSION = 4
+
+# The cached analyses of each (recording, FRAMES_PER_FFT) pair, loaded once into every worker process
+_analyses: Dict[Tuple[str, int], Dict[str, np.ndarray]] = {}
+_labels: Dict[str, list] = {}
+
+
+def uses_frames_per_fft(estimator_name: str) -> bool:
+    """Whether an estimator's analysis window is set by FRAMES_PER_FFT. YIN, for one, sizes its own window
+    """
+    return PITCH_ESTIMATORS[estimator_name].DEFAULT_WINDOW_SIZE == SAMPLES_PER_FFT
+
+
+def cache_filename(cache_dir: str, wav_filename: str, estimator_name: str, frames_per_fft: int) -> str:
+    base = os.path.splitext(os.path.basename(wav_filename))[0]
+    gate_window = NOISE_GATE_WINDOW if NOISE_GATE else 0
+    bandpass = '-bandpass' if BANDPASS_FILTER else ''
+    return os.path.join(cache_dir, f'{base}-{estimator_name}-fft{frames_per_fft}-dec{DECIMATION_FACTOR}'
+                                   f'-gate{gate_window}{bandpass}.npz')
+
+
+def analyze_recording(job: Tuple[str, str, str, int]) -> str:
+    """Analyze a recording with a given FRAMES_PER_FFT, unless an up-to-date analysis is already cached
+    Returns the cache file's name.
+    """
+    wav_filename, cache_dir, estimator_name, frames_per_fft = job
+    filename = cache_filename(cache_dir, wav_filename, estimator_name, frames_per_fft)
+    if os.path.exists(filename) and os.path.getmtime(filename) >= os.path.getmtime(wav_filename):
+        with np.load(filename) as cached:
+            if set(CACHED_FIELDS) <= set(cached.files) and int(cached['version']) == ANALYSIS_VERSION:
+                return filename
+
+    sample_rate, samples = load_wav(wav_filename)
+    window_size = ANALYSIS_SAMPLES_PER_FRAME * frames_per_fft if uses_frames_per_fft(estimator_name) else None
+    # Estimate every frame, however quiet, so any MIN_VOLUME can be applied afterwards
+    timeline = analyze_samples(samples, sample_rate, estimator_name=estimator_name, window_size=window_size,
+                               gate_frames=False)
+    np.savez(filename,
+             time=timeline.time,
+             note=timeline.note,
+             confidence=np.where(timeline.note != SILENCE_NOTE, timeline.confidence, 0.0),
+             volume=timeline.volume,
+             onset=timeline.onset,
+             notes=timeline.notes,
+             attack_note=timeline.attack_note,
+             duration=len(samples) / sample_rate,
+             version=ANALYSIS_VERSION)
+    return filename
+
+
+def load_analyses(cache_files: Dict[Tuple[str, int], str], label_files: Dict[str, str]) -> None:
+    """Pool initializer which loads every cached analysis into the worker
+    """
+    for key, filename in cache_files.items():
+        with np.load(filename) as cached:
+            _analyses[key] = {name: cached[name] for name in cached.files}
+    for wav_filename, labels_filename in label_files.items():
+        _labels[wav_filename] = load_labels(labels_filename)
+
+
+def evaluate_params(params: Dict) -> Dict:
+    """Score one combination of settings against every recording in the corpus
+    """
+    results = []
+    duration = 0.0
+    early_commit = PITCH_ESTIMATORS[analysis_estimator()].EARLY_COMMIT
+    for wav_filename, labels in _labels.items():
+        analysis = _analyses[(wav_filename, params['FRAMES_PER_FFT'])]
+        voiced = voiced_frames(analysis['volume'], params['MIN_VOLUME'], SAMPLE_RATE / SAMPLES_PER_FRAME,
+                               analysis['confidence'])
+        notes = np.where(voiced, analysis['note'], SILENCE_NOTE)
+        chords = np.where(voiced[:, np.newaxis], analysis['notes'], SILENCE_NOTE)
+        attack_notes = np.where(voiced, analysis['attack_note'], SILENCE_NOTE)
+        # The gate uses the estimator's confidence either way, but the NoteReader only gets it if it can be trusted
+        confidences = np.where(voiced & early_commit, analysis['confidence'], 0.0)
+
+        presses: List[Press] = []
+        clock = [0.0]
+        note_reader = recording_note_reader(presses, clock,
+                                            ringbuf_size=params['NOTE_VOTE_WINDOW'],
+                                            votes_to_commit=params['NOTE_VOTES_TO_COMMIT'],
+                                            early_commit_confidence=params['EARLY_COMMIT_CONFIDENCE'])
+        for t, chord, confidence, onset, attack_note in zip(analysis['time'].tolist(), chords.tolist(),
+                                                            confidences.tolist(), analysis['onset'].tolist(),
+                                                            attack_notes.tolist()):
+            clock[0] = t
+            note_reader.process_notes(tuple(n for n in chord if n != SILENCE_NOTE), confidence, onset,
+                                      None if attack_note == SILENCE_NOTE else attack_note)
+
+        result = score_presses(labels, presses, float(analysis['duration']))
+        result['frames'] = len(notes)
+        results.append(result)
+        duration += float(analysis['duration'])
+
+    summary = summarize(results, elapsed=0)
+    return {
+        'params': params,
+        'accuracy': summary['accuracy'],
+        'false_presses': summary['false_presses'],
+        'false_presses_per_min': summary['false_presses'] / (duration / 60) if duration else 0.0,
+        'mean_latency_ms': summary['mean_latency_ms'],
+    }
+
+
+def parameter_grid(grid: Dict[str, List[int]], samples: Optional[int] = None, seed: int = 0) -> List[Dict]:
+    """Every valid combination of the grid's values, or a random sample of `samples` of them
+    """
+    names = list(grid)
+    combinations = [dict(zip(names, values)) for values in itertools.product(*grid.values())]
+    # A note can't collect more votes than the window holds
+    combinations = [c for c in combinations if c['NOTE_VOTES_TO_COMMIT'] <= c['NOTE_VOTE_WINDOW']]
+    if samples is not None and samples < len(combinations):
+        combinations = random.Random(seed).sample(combinations, samples)
+    return combinations
+
+
+def pareto_front(results: List[Dict], min_accuracy: float) -> List[Dict]:
+    """The results which no other result beats on both latency and false presses, fastest first
+    Results which detect fewer than `min_accuracy` of the labelled notes aren't considered at all.
+    """
+    candidates = [r for r in results if r['accuracy'] >= min_accuracy and r['mean_latency_ms'] is not None]
+    candidates.sort(key=lambda r: (r['mean_latency_ms'], r['false_presses_per_min'], -r['accuracy']))
+    front = []
+    for result in candidates:
+        if not front or result['false_presses_per_min'] < front[-1]['false_presses_per_min']:
+            front.append(result)
+    return front
+
+
+def choose(front: List[Dict], max_false_rate: float) -> Dict:
+    """The fastest result on the front with an acceptable false press rate, or failing that, the most precise one
+    """
+    acceptable = [r for r in front if r['false_presses_per_min'] <= max_false_rate]
+    return acceptable[0] if acceptable else front[-1]
+
+
+def number_list(value: str) -> List[float]:
+    return [float(v) if '.' in v else int(v) for v in value.split(',')]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Tune detection settings against a corpus of labelled recordings')
+    parser.add_argument('corpus', help='directory of .wav files, each with a .csv label file')
+    parser.add_argument('--random', type=int, metavar='N', help='score N random combinations rather than all of them')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--min-accuracy', type=float, default=0.8,
+                        help='ignore combinations which detect fewer of the labelled notes than this')
+    parser.add_argument('--max-false-rate', type=float, default=1.0,
+                        help='false presses per minute to accept in exchange for lower latency')
+    parser.add_argument('--cache', help='where to cache analyses (default: .tuner_cache in the corpus)')
+    parser.add_argument('--config', default=TUNED_CONFIG_FILE, help='where to write the chosen settings')
+    parser.add_argument('-o', '--output', default='tuner_report.json', help='where to write every score as JSON')
+    parser.add_argument('-j', '--processes', type=int, default=multiprocessing.cpu_count())
+    for name, values in DEFAULT_GRID.items():
+        parser.add_argument('--' + name.lower().replace('_', '-'), type=number_list, default=values,
+                            help=f'comma-separated values to try (default: {",".join(map(str, values))})')
+    args = parser.parse_args(argv)
+
+    recordings = find_recordings(args.corpus)
+    if not recordings:
+        print(f'No labelled recordings found in {args.corpus}')
+        return
+
+    grid = {name: getattr(args, name.lower()) for name in DEFAULT_GRID}
+    estimator_name = analysis_estimator()
+    if not uses_frames_per_fft(estimator_name):
+        print(f'The {estimator_name} estimator ignores FRAMES_PER_FFT, so it is left at {FRAMES_PER_FFT}')
+        grid['FRAMES_PER_FFT'] = [FRAMES_PER_FFT]
+    combinations = parameter_grid(grid, args.random, args.seed)
+    cache_dir = args.cache or os.path.join(args.corpus, '.tuner_cache')
+    os.makedirs(cache_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    jobs = [(wav, cache_dir, estimator_name, frames_per_fft)
+            for wav, _ in recordings for frames_per_fft in grid['FRAMES_PER_FFT']]
+    with multiprocessing.Pool(args.processes) as pool:
+        cache_files = dict(zip([(wav, frames_per_fft) for wav, _, _, frames_per_fft in jobs],
+                               pool.map(analyze_recording, jobs)))
+    analyzed = time.perf_counter()
+    print(f'Analyzed {len(recordings)} recordings at {len(grid["FRAMES_PER_FFT"])} window sizes '
+          f'in {analyzed - start:.1f}s')
+
+    with multiprocessing.Pool(args.processes, load_analyses, (cache_files, dict(recordings))) as pool:
+        results = pool.map(evaluate_params, combinations, chunksize=max(1, len(combinations) // (4 * args.processes)))
+    print(f'Scored {len(combinations)} combinations in {time.perf_counter() - analyzed:.1f}s')
+
+    front = pareto_front(results, args.min_accuracy)
+    with open(args.output, 'w') as f:
+        json.dump({'pareto_front': front, 'results': results}, f, indent=2)
+    if not front:
+        print(f'No combination detected at least {args.min_accuracy:.0%} of the labelled notes. Wrote {args.output}')
+        return
+
+    current = {'MIN_VOLUME': MIN_VOLUME, 'FRAMES_PER_FFT': FRAMES_PER_FFT,
+               'NOTE_VOTE_WINDOW': NOTE_VOTE_WINDOW, 'NOTE_VOTES_TO_COMMIT': NOTE_VOTES_TO_COMMIT,
+               'EARLY_COMMIT_CONFIDENCE': EARLY_COMMIT_CONFIDENCE}
+    chosen = choose(front, args.max_false_rate)
+    print(f'{"latency":>10}{"false/min":>11}{"accuracy":>10}  settings')
+    for r in front:
+        marker = '*' if r is chosen else ' '
+        settings = '  '.join(f'{name}={value}' for name, value in r['params'].items())
+        print(f'{r["mean_latency_ms"]:>8.0f}ms{r["false_presses_per_min"]:>11.2f}{r["accuracy"]:>10.1%} {marker}{settings}')
+    for r in results:
+        if r['params'] == current:
+            print(f'Current settings: {r["mean_latency_ms"] or float("nan"):.0f}ms, '
+                  f'{r["false_presses_per_min"]:.2f} false presses/min, {r["accuracy"]:.1%} accuracy')
+
+    with open(args.config, 'w') as f:
+        json.dump(chosen['params'], f, indent=2)
+    print(f'Wrote the settings marked * to {args.config} and every score to {args.output}')
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])